@@ -75,7 +75,13 @@ _C.TRAIN.CHECKPOINT_INFLATE = False
 # If True, reset epochs when loading checkpoint.
 _C.TRAIN.CHECKPOINT_EPOCH_RESET = False
 
-_C.TRAIN.MIXED_PRECISION = False  # ("backbone.",)
+# If True, train with autocast in TRAIN.MIXED_PRECISION_DTYPE, with dynamic loss
+# scaling for float16 on GPU.
+_C.TRAIN.MIXED_PRECISION = False
+
+# Autocast dtype of mixed precision training, "float16" or "bfloat16". Only
+# bfloat16 is fast on CPU.
+_C.TRAIN.MIXED_PRECISION_DTYPE = "float16"
 
 # If set, clear all layer names according to the pattern provided.
 _C.TRAIN.CHECKPOINT_CLEAR_NAME_PATTERN = ()  # ("backbone.",)
@@ -117,6 +123,57 @@ _C.TEST.NUM_SPATIAL_CROPS = 3
 _C.TEST.CHECKPOINT_TYPE = "pytorch"
 # Path to saving prediction results file.
 _C.TEST.SAVE_RESULTS_PATH = ""
+
+# Video list of tools/stream_net.py, `path [label]` per line. Defaults to the
+# test csv in DATA.PATH_TO_DATA_DIR.
+_C.TEST.STREAM_VIDEO_LIST = ""
+
+# Stride in decoded frames between two streaming windows, 0 for half of the
+# window span.
+_C.TEST.STREAM_WINDOW_STRIDE = 0
+
+# Maximum number of decoded windows waiting for the model.
+_C.TEST.STREAM_QUEUE_SIZE = 32
+
+# Number of videos decoded concurrently by streaming inference.
+_C.TEST.STREAM_NUM_DECODERS = 2
+
+# Number of frames decoded per pyav_decode_stream call when streaming.
+_C.TEST.STREAM_CHUNK_FRAMES = 256
+
+# If True, run evaluation and testing with autocast in
+# TEST.MIXED_PRECISION_DTYPE.
+_C.TEST.MIXED_PRECISION = False
+
+# Autocast dtype of mixed precision evaluation, "float16" or "bfloat16".
+_C.TEST.MIXED_PRECISION_DTYPE = "float16"
+
+# Inference backend of test_net: `pytorch`, `int8` for the CPU int8 model of
+# QUANT options or `onnxruntime` for the ONNX graph of ONNX options. The last
+# two require NUM_GPUS 0.
+_C.TEST.BACKEND = "pytorch"
+
+# If True, test_net runs a graph-compiled model, compiled once per input
+# signature (batch, T, H, W, dtype, device).
+_C.TEST.COMPILE = False
+
+# Compiler of TEST.COMPILE: `trace` (torch.jit.trace) or `inductor`
+# (torch.compile).
+_C.TEST.COMPILE_BACKEND = "trace"
+
+# On-disk cache of compiled models, shared by test jobs. Defaults to
+# OUTPUT_DIR/compile_cache.
+_C.TEST.COMPILE_CACHE_DIR = ""
+
+# Number of input signatures compiled, in order of appearance. Later
+# signatures, e.g. the last partial batch, run eagerly.
+_C.TEST.COMPILE_MAX_SHAPES = 1
+
+# Softmax confidence at which a clip leaves the VisionTransformer at one of the
+# exit heads of TIMESFORMER.EARLY_EXIT_BLOCKS, 0 runs every block. Applies to
+# the eager model in eval mode, traced and exported graphs run every block.
+_C.TEST.EARLY_EXIT_THRESHOLD = 0.0
+
 # -----------------------------------------------------------------------------
 # ResNet options
 # -----------------------------------------------------------------------------
@@ -225,6 +282,41 @@ _C.MODEL.VISUAL_MODEL = "dinov2"
 _C.MODEL.MOTION_MODEL = "raft"
 _C.MODEL.ST_MASKING = "arrow"
 _C.MODEL.TIME_AGGREGATION = "mean"
+
+# Steps kept in the key/value cache of MOOSE.forward_stream with
+# TIME_AGGREGATION causal, 0 for DATA.NUM_FRAMES - 1, the steps of a clip.
+_C.MODEL.CAUSAL_WINDOW = 0
+
+# Mamba implementation of TIME_AGGREGATION mamba: mamba_ssm (CUDA kernels),
+# pytorch (timesformer/models/mamba.py, runs on CPU and streams with
+# MOOSE.forward_stream) or auto, mamba_ssm when it is installed and a GPU is
+# available. Both load the same checkpoints.
+_C.MODEL.MAMBA_IMPL = "auto"
+
+# Number of threads computing OpenCV optical flow when MOTION_MODEL is
+# `opencv`, 0 for one per CPU core.
+_C.MODEL.FLOW_NUM_THREADS = 0
+
+# Maximum number of frame pairs per RAFT call in MOOSE_Encoder.motion_forward,
+# 0 to run all the (batch x time) pairs of a clip batch in one call.
+_C.MODEL.RAFT_MICRO_BATCH = 0
+
+# Activation checkpointing: recompute the activations of every k-th
+# VisionTransformer block, and of the MOOSE fusion cross attention and MLP, in
+# backward instead of storing them. 0 disables it, 1 checkpoints every block.
+_C.MODEL.ACTIVATION_CHECKPOINT = 0
+
+# Attention kernel used by vit.Attention: `naive` materializes the full
+# (B, heads, N, N) matrix, `sdpa` uses the fused scaled_dot_product_attention
+# and `chunked` runs an online softmax over blocks of ATTN_CHUNK_SIZE tokens.
+_C.MODEL.ATTN_BACKEND = "naive"
+_C.MODEL.ATTN_CHUNK_SIZE = 1024
+
+# If True, MOOSE reads the frozen encoder outputs (visual tokens and flow)
+# from DATA.FEATURE_CACHE_DIR, written by tools/extract_features.py, instead
+# of running the visual and motion backbones.
+_C.MODEL.USE_FEATURE_CACHE = False
+
 # Model name
 _C.MODEL.MODEL_NAME = "SlowFast"
 
@@ -279,6 +371,33 @@ _C.SLOWFAST.FUSION_KERNEL_SZ = 5
 _C.TIMESFORMER = CfgNode()
 _C.TIMESFORMER.ATTENTION_TYPE = 'divided_space_time'
 _C.TIMESFORMER.PRETRAINED_MODEL = ''
+# If True, use FusedBlock (persistent token layout + fused attention kernel)
+# for divided_space_time. Parameter names match Block.
+_C.TIMESFORMER.FUSED_BLOCK = False
+
+# If True, `time_only` models read the frozen Sapiens per-frame embeddings
+# from DATA.SPATIAL_CACHE_DIR, written by tools/extract_spatial_features.py,
+# instead of running Sapiens.
+_C.TIMESFORMER.USE_SPATIAL_CACHE = False
+
+# If True, `time_only` models run Sapiens one layer at a time in lockstep with
+# the blocks, so only one spatial layer is alive instead of all of them.
+_C.TIMESFORMER.INTERLEAVE_SPATIAL = False
+
+# Token merging (ToMe) for `divided_space_time`: number of spatial locations
+# merged, in every frame, after each block. 0 disables merging.
+_C.TIMESFORMER.TOME_R = 0
+
+# Per-block token merging schedule, one r per block. Overrides TOME_R if set.
+_C.TIMESFORMER.TOME_SCHEDULE = []
+
+# Blocks (0-based, before the last one) followed by an early exit head, for
+# `divided_space_time` and `joint_space_time`. Empty disables early exit.
+_C.TIMESFORMER.EARLY_EXIT_BLOCKS = []
+
+# Weight of the auxiliary training loss of the exit heads, the mean of their
+# losses, added to the loss of the final head.
+_C.TIMESFORMER.EARLY_EXIT_LOSS_WEIGHT = 0.3
 
 ## MixUp parameters
 _C.MIXUP = CfgNode()
@@ -365,6 +484,35 @@ _C.DATA.COLOR_JITTER = 0.
 _C.DATA.AUTO_AUGMENT = ''
 _C.DATA.RE_PROB = 0.0
 
+# Directory of the MOOSE feature cache, see MODEL.USE_FEATURE_CACHE.
+_C.DATA.FEATURE_CACHE_DIR = ""
+
+# Number of clips per feature cache shard file.
+_C.DATA.FEATURE_CACHE_SHARD_SIZE = 1024
+
+# Directory of the per-frame Sapiens store, see TIMESFORMER.USE_SPATIAL_CACHE.
+_C.DATA.SPATIAL_CACHE_DIR = ""
+
+# Number of frames per spatial feature store shard file.
+_C.DATA.SPATIAL_CACHE_SHARD_SIZE = 64
+
+# If set, read pre-sampled clips from the memory-mapped shards in this
+# directory, written by tools/convert_clip_store.py, instead of the per-clip
+# `*_light` pickles.
+_C.DATA.CLIP_STORE_DIR = ""
+
+# Storage dtype of the clip store, `uint8` (raw pixels, normalized with
+# DATA.MEAN and DATA.STD when collated or on device) or `float16` (normalized
+# frames).
+_C.DATA.CLIP_STORE_DTYPE = "uint8"
+
+# Maximum size of a clip store shard file in GB.
+_C.DATA.CLIP_STORE_SHARD_GB = 4.0
+
+# If True, the loaders keep frames as uint8 pixels and the batch is normalized
+# with DATA.MEAN and DATA.STD on the device, after the host to device copy.
+_C.DATA.NORMALIZE_ON_DEVICE = False
+
 # ---------------------------------------------------------------------------- #
 # Optimizer options
 # ---------------------------------------------------------------------------- #
@@ -467,6 +615,108 @@ _C.BENCHMARK.LOG_PERIOD = 100
 # If True, shuffle dataloader for epoch during benchmark.
 _C.BENCHMARK.SHUFFLE = True
 
+# Benchmark to run with tools/benchmark.py, see BENCHMARKS there.
+_C.BENCHMARK.TYPE = "data_loading"
+
+# Number of timed iterations for model micro-benchmarks.
+_C.BENCHMARK.NUM_ITERS = 10
+
+# Sequence lengths for the attention backend benchmark.
+_C.BENCHMARK.ATTN_SEQ_LENS = [197, 1569, 3137]
+
+# Batch sizes of the model memory benchmarks.
+_C.BENCHMARK.BATCH_SIZES = [1, 2, 3, 4]
+
+# Modules whose cold import time is measured by the startup benchmark.
+_C.BENCHMARK.STARTUP_MODULES = [
+    "timesformer.models",
+    "tools.run_net",
+    "tools.benchmark",
+]
+
+# Number of slowest imports reported per module by the startup benchmark.
+_C.BENCHMARK.STARTUP_TOP_K = 10
+
+# Values of TIMESFORMER.TOME_R compared by the token merging benchmark.
+_C.BENCHMARK.TOME_RS = [0, 4, 8, 16]
+
+# Values of TEST.EARLY_EXIT_THRESHOLD compared by the early exit benchmark.
+_C.BENCHMARK.EARLY_EXIT_THRESHOLDS = [0.0, 0.5, 0.7, 0.9]
+
+# Test batches used for the accuracy of each r, 0 for the whole test split.
+_C.BENCHMARK.NUM_EVAL_BATCHES = 50
+
+# Values of MODEL.ACTIVATION_CHECKPOINT compared by the activation
+# checkpointing benchmark.
+_C.BENCHMARK.ACTIVATION_CHECKPOINTS = [0, 1, 2, 4]
+
+# TEST.COMPILE_BACKEND values compared by the compile benchmark.
+_C.BENCHMARK.COMPILE_BACKENDS = ["trace", "inductor"]
+
+# Token counts of the cross attention benchmark, 257 for DINO and 4097 for
+# Sapiens embeddings.
+_C.BENCHMARK.CROSS_ATTN_TOKENS = [257, 4097]
+
+# Batch size, i.e. number of frames, of the cross attention benchmark.
+_C.BENCHMARK.CROSS_ATTN_BATCH_SIZE = 8
+
+# Embedding dimension of both sequences of the cross attention benchmark.
+_C.BENCHMARK.CROSS_ATTN_DIM = 384
+
+# Token counts of the block-sparse arrow attention scaling benchmark.
+_C.BENCHMARK.ARROW_ATTN_TOKENS = [257, 513, 1025, 2049, 4097]
+
+# Stream lengths, in steps, of the causal streaming benchmark.
+_C.BENCHMARK.STREAM_STEPS = [8, 64, 512, 2048]
+
+# Sequence lengths, in steps, of the pure PyTorch Mamba scan benchmark.
+_C.BENCHMARK.MAMBA_SEQ_LENS = [8, 64, 512, 2048]
+
+
+# ---------------------------------------------------------------------------- #
+# Int8 quantization options, see tools/quantize_net.py
+# ---------------------------------------------------------------------------- #
+_C.QUANT = CfgNode()
+
+# `dynamic` quantizes nn.Linear weights and, per batch, activations. `static`
+# also calibrates fixed activation ranges on validation batches.
+_C.QUANT.MODE = "dynamic"
+
+# Number of val batches used to calibrate `static` quantization.
+_C.QUANT.CALIBRATION_BATCHES = 10
+
+# Number of val batches of the int8 vs fp32 report of tools/quantize_net.py,
+# 0 for the whole val split.
+_C.QUANT.EVAL_BATCHES = 50
+
+# Quantized checkpoint written by tools/quantize_net.py, loaded by TEST.BACKEND
+# `int8`. If empty, the float checkpoint is quantized when testing.
+_C.QUANT.CHECKPOINT_FILE_PATH = ""
+
+
+# ---------------------------------------------------------------------------- #
+# ONNX options, see tools/export_onnx.py
+# ---------------------------------------------------------------------------- #
+_C.ONNX = CfgNode()
+
+# Opset of the exported graph.
+_C.ONNX.OPSET = 17
+
+# Graph written by tools/export_onnx.py and run by TEST.BACKEND `onnxruntime`.
+# Defaults to OUTPUT_DIR/<MODEL.MODEL_NAME>.onnx.
+_C.ONNX.FILE_PATH = ""
+
+# onnxruntime threads within an operator, 0 for the onnxruntime default.
+_C.ONNX.INTRA_OP_THREADS = 0
+
+# onnxruntime threads running independent operators, 0 for sequential
+# execution.
+_C.ONNX.INTER_OP_THREADS = 0
+
+# Max absolute difference of the exported graph to the PyTorch outputs
+# accepted by tools/export_onnx.py.
+_C.ONNX.PARITY_ATOL = 1e-3
+
 
 # ---------------------------------------------------------------------------- #
 # Common train/test data loader options
@@ -0,0 +1,234 @@
+# Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved.
+
+"""
+Sharded clip store. Pre-sampled clips are packed into a few large shard files
+that the reader memory-maps, instead of one pickle file per clip.
+
+Shard layout (little endian):
+    header (HEADER_SIZE bytes): magic, version, number of clips, index offset.
+    clip data: raw tensor bytes, every clip starting at an ALIGNMENT boundary.
+    index: one INDEX_ENTRY per clip, holding its offset, label, dtype and shape.
+Next to the shards, `{split}_index.npy` maps every dataset index of the split
+to a clip id, so the views of a video that share one clip are stored once.
+"""
+
+import glob
+import numpy as np
+import os
+import struct
+import torch
+import torch.utils.data
+
+import timesformer.utils.logging as logging
+
+logger = logging.get_logger(__name__)
+
+MAGIC = b"TSFCLIP\0"
+VERSION = 1
+HEADER = struct.Struct("<8sIIQ")
+HEADER_SIZE = 64
+ALIGNMENT = 64
+MAX_NDIM = 5
+# offset, label, dtype code, ndim, shape padded to MAX_NDIM.
+INDEX_ENTRY = struct.Struct("<QqBB6x{}Q".format(MAX_NDIM))
+DTYPES = {0: np.uint8, 1: np.float16, 2: np.float32}
+DTYPE_CODES = {np.dtype(v): k for k, v in DTYPES.items()}
+
+
+def get_shard_path(store_dir, split, shard_id):
+    return os.path.join(store_dir, "{}_{:05d}.clips".format(split, shard_id))
+
+
+def get_index_path(store_dir, split):
+    return os.path.join(store_dir, "{}_index.npy".format(split))
+
+
+def read_shard_index(path):
+    """
+    Read the header and index of a shard.
+    Args:
+        path (str): path to the shard file.
+    Returns:
+        entries (list): (offset, label, dtype, shape) of every clip.
+    """
+    with open(path, "rb") as f:
+        magic, version, num_clips, index_offset = HEADER.unpack(
+            f.read(HEADER.size)
+        )
+        assert magic == MAGIC, "{} is not a clip shard".format(path)
+        assert version == VERSION, "Unsupported clip shard version {}".format(
+            version
+        )
+        f.seek(index_offset)
+        raw = f.read(num_clips * INDEX_ENTRY.size)
+    entries = []
+    for i in range(num_clips):
+        offset, label, code, ndim, *shape = INDEX_ENTRY.unpack_from(
+            raw, i * INDEX_ENTRY.size
+        )
+        entries.append((offset, label, DTYPES[code], tuple(shape[:ndim])))
+    return entries
+
+
+class ClipShardWriter(object):
+    """
+    Append clips to shard files of at most `max_shard_bytes` bytes each.
+    """
+
+    def __init__(self, store_dir, split, max_shard_bytes=4 * 1024 ** 3):
+        """
+        Args:
+            store_dir (str): directory to write the shards to.
+            split (str): split name, used as file name prefix.
+            max_shard_bytes (int): a new shard is started once adding a clip
+                would grow the current one past this size.
+        """
+        self.store_dir = store_dir
+        self.split = split
+        self.max_shard_bytes = max_shard_bytes
+        self.num_clips = 0
+        self._shard_id = -1
+        self._file = None
+        self._entries = []
+        os.makedirs(store_dir, exist_ok=True)
+
+    def _pad(self):
+        self._file.write(b"\0" * (-self._file.tell() % ALIGNMENT))
+
+    def _open_shard(self):
+        self._shard_id += 1
+        self._file = open(
+            get_shard_path(self.store_dir, self.split, self._shard_id), "wb"
+        )
+        self._file.write(b"\0" * HEADER_SIZE)
+        self._entries = []
+
+    def _close_shard(self):
+        if self._file is None:
+            return
+        self._pad()
+        index_offset = self._file.tell()
+        self._file.write(b"".join(self._entries))
+        self._file.seek(0)
+        self._file.write(
+            HEADER.pack(MAGIC, VERSION, len(self._entries), index_offset)
+        )
+        self._file.close()
+        self._file = None
+
+    def add(self, frames, label):
+        """
+        Append one clip.
+        Args:
+            frames (tensor): clip tensor of dtype uint8, float16 or float32.
+            label (int): label of the clip.
+        Returns:
+            clip_id (int): id of the clip within the split.
+        """
+        array = np.ascontiguousarray(frames.numpy())
+        assert array.dtype in DTYPE_CODES, "Unsupported dtype {}".format(
+            array.dtype
+        )
+        assert array.ndim <= MAX_NDIM
+        if self._file is None or (
+            self._entries
+            and self._file.tell() + ALIGNMENT + array.nbytes
+            > self.max_shard_bytes
+        ):
+            self._close_shard()
+            self._open_shard()
+        self._pad()
+        shape = list(array.shape) + [0] * (MAX_NDIM - array.ndim)
+        self._entries.append(
+            INDEX_ENTRY.pack(
+                self._file.tell(),
+                int(label),
+                DTYPE_CODES[array.dtype],
+                array.ndim,
+                *shape
+            )
+        )
+        self._file.write(array.data)
+        self.num_clips += 1
+        return self.num_clips - 1
+
+    def close(self, index_map=None):
+        """
+        Finish the last shard and write the dataset index to clip id map.
+        Args:
+            index_map (list): clip id of every dataset index. Defaults to one
+                clip per dataset index, in insertion order.
+        """
+        self._close_shard()
+        if index_map is None:
+            index_map = range(self.num_clips)
+        np.save(
+            get_index_path(self.store_dir, self.split),
+            np.asarray(index_map, dtype=np.int64),
+        )
+        logger.info(
+            "Wrote {} {} clips into {} shards in {}".format(
+                self.num_clips, self.split, self._shard_id + 1, self.store_dir
+            )
+        )
+
+
+class ClipStore(torch.utils.data.Dataset):
+    """
+    Dataset over the shards written by `ClipShardWriter`. Only the shard
+    indices are read at construction; shards are memory-mapped lazily in
+    every loader worker, and clips are returned as zero-copy tensor views of
+    the mapping in the dtype they were stored with.
+    """
+
+    def __init__(self, cfg, mode):
+        """
+        Args:
+            cfg (CfgNode): configs. The shards are read from
+                DATA.CLIP_STORE_DIR.
+            mode (string): Options includes `train`, `val`, or `test` mode.
+        """
+        assert mode in [
+            "train",
+            "val",
+            "test",
+        ], "Split '{}' not supported for the clip store".format(mode)
+        self.cfg = cfg
+        self.mode = mode
+        store_dir = cfg.DATA.CLIP_STORE_DIR
+        self._shard_paths = sorted(
+            glob.glob(os.path.join(store_dir, "{}_*.clips".format(mode)))
+        )
+        assert len(self._shard_paths) > 0, "No {} shards found in {}".format(
+            mode, store_dir
+        )
+        self._clips = []
+        for shard_id, path in enumerate(self._shard_paths):
+            for entry in read_shard_index(path):
+                self._clips.append((shard_id,) + entry)
+        self._index_map = np.load(get_index_path(store_dir, mode))
+        self._mmaps = {}
+        logger.info(
+            "Constructing clip store dataloader (size: {}, clips: {}) "
+            "from {}".format(len(self._index_map), len(self._clips), store_dir)
+        )
+
+    def _get_mmap(self, shard_id):
+        if shard_id not in self._mmaps:
+            # Copy-on-write keeps the views writable without touching the file.
+            self._mmaps[shard_id] = np.memmap(
+                self._shard_paths[shard_id], dtype=np.uint8, mode="c"
+            )
+        return self._mmaps[shard_id]
+
+    def __getitem__(self, index):
+        shard_id, offset, label, dtype, shape = self._clips[
+            self._index_map[index]
+        ]
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        frames = self._get_mmap(shard_id)[offset:offset + nbytes]
+        frames = np.asarray(frames).view(dtype).reshape(shape)
+        return torch.from_numpy(frames), label, index, {}
+
+    def __len__(self):
+        return len(self._index_map)
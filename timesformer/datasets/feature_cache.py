@@ -0,0 +1,314 @@
+# Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved.
+
+"""Sharded, memory-mapped store for the outputs of the frozen MOOSE encoder."""
+
+import json
+import numpy as np
+import os
+import torch
+import torch.utils.data
+from fvcore.common.file_io import PathManager
+
+import timesformer.utils.logging as logging
+
+logger = logging.get_logger(__name__)
+
+# Order in which cached tensors are returned to the model.
+FEATURE_KEYS = ("visual", "flow")
+
+
+def get_index_path(cache_dir, split):
+    return os.path.join(cache_dir, "{}_index.json".format(split))
+
+
+def get_shard_path(cache_dir, split, key, shard_id):
+    return os.path.join(
+        cache_dir, "{}_{}_{:05d}.npy".format(split, key, shard_id)
+    )
+
+
+class FeatureCacheWriter(object):
+    """
+    Write per-clip feature tensors into `.npy` shards of `shard_size` clips.
+    Every feature key (e.g. `visual`, `flow`) gets its own shard files, and a
+    json index records the label, shard and row of every clip. Clips must be
+    added in dataset order, the i-th added clip is served as index i.
+    """
+
+    def __init__(self, cache_dir, split, shard_size=1024, dtype=np.float16):
+        """
+        Args:
+            cache_dir (str): directory to write the shards and index to.
+            split (str): split name, used as file name prefix.
+            shard_size (int): number of clips per shard file.
+            dtype (np.dtype): storage dtype of the features.
+        """
+        self.cache_dir = cache_dir
+        self.split = split
+        self.shard_size = shard_size
+        self.dtype = np.dtype(dtype)
+        self._shapes = None
+        self._shards = {}
+        self._clips = []
+        PathManager.mkdirs(cache_dir)
+
+    def _open_shards(self, shard_id):
+        self._shards = {
+            key: np.lib.format.open_memmap(
+                get_shard_path(self.cache_dir, self.split, key, shard_id),
+                mode="w+",
+                dtype=self.dtype,
+                shape=(self.shard_size,) + shape,
+            )
+            for key, shape in self._shapes.items()
+        }
+
+    def _flush(self):
+        for shard in self._shards.values():
+            shard.flush()
+        self._shards = {}
+
+    def add(self, label, **features):
+        """
+        Append one clip.
+        Args:
+            label (int): label of the clip.
+            features (tensor): feature tensors of the clip, keyed by name.
+                `None` values are skipped.
+        """
+        features = {k: v for k, v in features.items() if v is not None}
+        shapes = {k: tuple(v.shape) for k, v in features.items()}
+        if self._shapes is None:
+            self._shapes = shapes
+        assert shapes == self._shapes, "Feature shapes {} != {}".format(
+            shapes, self._shapes
+        )
+
+        shard_id, row = divmod(len(self._clips), self.shard_size)
+        if row == 0:
+            self._flush()
+            self._open_shards(shard_id)
+        for key, value in features.items():
+            self._shards[key][row] = value.detach().float().cpu().numpy()
+        self._clips.append({"label": int(label), "shard": shard_id, "row": row})
+
+    def close(self):
+        """
+        Flush the open shards and write the index.
+        """
+        self._flush()
+        with PathManager.open(
+            get_index_path(self.cache_dir, self.split), "w"
+        ) as f:
+            json.dump(
+                {
+                    "dtype": self.dtype.name,
+                    "shapes": {k: list(v) for k, v in self._shapes.items()},
+                    "clips": self._clips,
+                },
+                f,
+            )
+        logger.info(
+            "Wrote {} {} clips to {}".format(
+                len(self._clips), self.split, self.cache_dir
+            )
+        )
+
+
+class FeatureCache(torch.utils.data.Dataset):
+    """
+    Dataset over a feature cache written by `FeatureCacheWriter`. Shards are
+    memory-mapped lazily, so every loader worker maps its own view and only
+    the rows that are read are paged in. Items are returned in the same
+    `(inputs, label, index, meta)` format as the video datasets, with
+    `inputs` being the list of cached tensors in FEATURE_KEYS order.
+    """
+
+    def __init__(self, cfg, mode):
+        """
+        Args:
+            cfg (CfgNode): configs. The cache is read from
+                DATA.FEATURE_CACHE_DIR.
+            mode (string): Options includes `train`, `val`, or `test` mode.
+        """
+        assert mode in [
+            "train",
+            "val",
+            "test",
+        ], "Split '{}' not supported for the feature cache".format(mode)
+        self.cfg = cfg
+        self.mode = mode
+        self._cache_dir = cfg.DATA.FEATURE_CACHE_DIR
+        path_to_index = get_index_path(self._cache_dir, mode)
+        assert PathManager.exists(path_to_index), "{} not found".format(
+            path_to_index
+        )
+        with PathManager.open(path_to_index, "r") as f:
+            index = json.load(f)
+        self._keys = [k for k in FEATURE_KEYS if k in index["shapes"]]
+        self._clips = index["clips"]
+        self._shards = {}
+        logger.info(
+            "Constructing feature cache dataloader (size: {}) from {}".format(
+                len(self._clips), self._cache_dir
+            )
+        )
+
+    def _get_shard(self, key, shard_id):
+        if (key, shard_id) not in self._shards:
+            self._shards[(key, shard_id)] = np.load(
+                get_shard_path(self._cache_dir, self.mode, key, shard_id),
+                mmap_mode="r",
+            )
+        return self._shards[(key, shard_id)]
+
+    def __getitem__(self, index):
+        clip = self._clips[index]
+        features = [
+            torch.from_numpy(np.array(self._get_shard(key, clip["shard"])[clip["row"]]))
+            for key in self._keys
+        ]
+        return features, clip["label"], index, {}
+
+    def __len__(self):
+        return len(self._clips)
+
+
+def get_frame_index_path(cache_dir):
+    return os.path.join(cache_dir, "frames_index.json")
+
+
+def get_frame_shard_path(cache_dir, shard_id):
+    return os.path.join(cache_dir, "frames_{:05d}.npy".format(shard_id))
+
+
+class FrameFeatureWriter(object):
+    """
+    Write per-frame feature tensors into `.npy` shards of `shard_size` frames,
+    keyed by (video, frame index) in a json index. Frames that are already in
+    the store are skipped, so the frames shared by several clips or splits
+    are stored once.
+    """
+
+    def __init__(self, cache_dir, shard_size=256, dtype=np.float16):
+        """
+        Args:
+            cache_dir (str): directory to write the shards and index to.
+            shard_size (int): number of frames per shard file.
+            dtype (np.dtype): storage dtype of the features.
+        """
+        self.cache_dir = cache_dir
+        self.shard_size = shard_size
+        self.dtype = np.dtype(dtype)
+        self._shape = None
+        self._shard = None
+        self._num_frames = 0
+        self._videos = {}
+        PathManager.mkdirs(cache_dir)
+
+    def __contains__(self, key):
+        video, frame_idx = key
+        return str(frame_idx) in self._videos.get(video, {})
+
+    def add(self, video, frame_idx, features):
+        """
+        Append the features of one frame.
+        Args:
+            video (str): key of the video.
+            frame_idx (int): index of the frame in the video.
+            features (tensor): features of the frame.
+        """
+        if (video, frame_idx) in self:
+            return
+        shape = tuple(features.shape)
+        if self._shape is None:
+            self._shape = shape
+        assert shape == self._shape, "Feature shape {} != {}".format(
+            shape, self._shape
+        )
+        shard_id, row = divmod(self._num_frames, self.shard_size)
+        if row == 0:
+            if self._shard is not None:
+                self._shard.flush()
+            self._shard = np.lib.format.open_memmap(
+                get_frame_shard_path(self.cache_dir, shard_id),
+                mode="w+",
+                dtype=self.dtype,
+                shape=(self.shard_size,) + shape,
+            )
+        self._shard[row] = features.detach().float().cpu().numpy()
+        self._videos.setdefault(video, {})[str(frame_idx)] = [shard_id, row]
+        self._num_frames += 1
+
+    def close(self):
+        """
+        Flush the open shard and write the index.
+        """
+        if self._shard is not None:
+            self._shard.flush()
+            self._shard = None
+        with PathManager.open(get_frame_index_path(self.cache_dir), "w") as f:
+            json.dump(
+                {
+                    "dtype": self.dtype.name,
+                    "shape": list(self._shape or []),
+                    "videos": self._videos,
+                },
+                f,
+            )
+        logger.info(
+            "Wrote {} frames of {} videos to {}".format(
+                self._num_frames, len(self._videos), self.cache_dir
+            )
+        )
+
+
+class SpatialFeatureDataset(torch.utils.data.Dataset):
+    """
+    Wrap a dataset of pre-sampled clips and return, with the frames of every
+    clip, the per-frame features read from a store written by
+    `FrameFeatureWriter`. The clip of index i is keyed by
+    `dataset.get_light_path(i)` and its t-th frame by frame index t. Items are
+    `([frames, features], label, index, meta)`, features being
+    `num frames` x `feature shape`.
+    """
+
+    def __init__(self, dataset, cache_dir):
+        """
+        Args:
+            dataset (Dataset): dataset with a `get_light_path` method.
+            cache_dir (str): directory of the frame feature store.
+        """
+        assert hasattr(dataset, "get_light_path"), (
+            "The spatial feature cache needs a dataset of pre-sampled clips"
+        )
+        self.dataset = dataset
+        self._cache_dir = cache_dir
+        path_to_index = get_frame_index_path(cache_dir)
+        assert PathManager.exists(path_to_index), "{} not found".format(
+            path_to_index
+        )
+        with PathManager.open(path_to_index, "r") as f:
+            self._videos = json.load(f)["videos"]
+        self._shards = {}
+
+    def _get_shard(self, shard_id):
+        if shard_id not in self._shards:
+            self._shards[shard_id] = np.load(
+                get_frame_shard_path(self._cache_dir, shard_id), mmap_mode="r"
+            )
+        return self._shards[shard_id]
+
+    def __getitem__(self, index):
+        frames, label, index, meta = self.dataset[index]
+        rows = self._videos[self.dataset.get_light_path(index)]
+        features = np.stack(
+            [
+                self._get_shard(rows[str(t)][0])[rows[str(t)][1]]
+                for t in range(frames.shape[1])
+            ]
+        )
+        return [frames, torch.from_numpy(features)], label, index, meta
+
+    def __len__(self):
+        return len(self.dataset)
@@ -407,8 +407,10 @@ class Kinetics(torch.utils.data.Dataset):
         # Try to decode and sample a clip from a video. If the video can not be
         # decoded, repeatly find a random video replacement that can be decoded.
         for i_try in range(self._num_retries):
-            save_path = self._path_to_videos[index].split('k400')[0] + 'k400_light' + self._path_to_videos[index].split('k400')[-1].split('.')[0] + '.pkl'
+            save_path = self.get_light_path(index)
             frames, label, _ = load_tensors_from_pickle(save_path)
+            if frames is not None:
+                frames = utils.light_clip_frames(frames, self.cfg)
             # If decoding failed (wrong format, video is too short, and etc),
             # select another video.
             if frames is None:
@@ -438,20 +440,34 @@ class Kinetics(torch.utils.data.Dataset):
             (int): the number of videos in the dataset.
         """
         return len(self._path_to_videos)
+
+    def get_light_path(self, index):
+        """
+        Returns:
+            (str): path of the pre-sampled `k400_light` pickle of the video.
+        """
+        return self._path_to_videos[index].split('k400')[0] + 'k400_light' + self._path_to_videos[index].split('k400')[-1].split('.')[0] + '.pkl'
     
 import pickle
 # import torch
 
-def save_tensors_to_pickle(filename, frames, label, index):
+def save_tensors_to_pickle(filename, frames, label, index, mean=None, std=None):
     """
     Saves the given tensors (frames, label, index) into a pickle file.
+    Frames are stored as uint8 pixels, normalized float frames are converted
+    back with `mean` and `std`.
 
     Args:
         filename (str): The name of the pickle file to save to.
         frames (torch.Tensor): The tensor representing the frames.
         label (torch.Tensor): The tensor representing the label.
         index (torch.Tensor): The tensor representing the index.
+        mean (list): DATA.MEAN the float frames were normalized with.
+        std (list): DATA.STD the float frames were normalized with.
     """
+    if frames.dtype != torch.uint8:
+        assert mean is not None and std is not None, "Normalized frames need mean and std"
+        frames = utils.tensor_to_uint8(frames, mean, std)
     try:
         # Create a dictionary to hold the tensors
         data = {
@@ -792,10 +808,11 @@ class Rtmri75s(torch.utils.data.Dataset):
 
             label = self._labels[index]
 
-            # Perform color normalization.
-            frames = utils.tensor_normalize(
-                frames, self.cfg.DATA.MEAN, self.cfg.DATA.STD
-            )
+            # Perform color normalization, unless it is done on the device.
+            if not self.cfg.DATA.NORMALIZE_ON_DEVICE:
+                frames = utils.tensor_normalize(
+                    frames, self.cfg.DATA.MEAN, self.cfg.DATA.STD
+                )
 
             # T H W C -> C T H W.
             frames = frames.permute(3, 0, 1, 2)
@@ -5,6 +5,7 @@
 import itertools
 import numpy as np
 import torch
+from functools import partial
 from torch.utils.data._utils.collate import default_collate
 from torch.utils.data.distributed import DistributedSampler
 from torch.utils.data.sampler import RandomSampler
@@ -13,6 +14,8 @@ from timesformer.datasets.multigrid_helper import ShortCycleBatchSampler
 # import torch_xla.distributed.parallel_loader as pl
 from . import utils as utils
 from .build import build_dataset
+from .clip_store import ClipStore
+from .feature_cache import FeatureCache, SpatialFeatureDataset
 # import torch_xla.core.xla_model as xm
 
 def multiple_samples_collate(batch, fold=False):
@@ -79,6 +82,40 @@ def detection_collate(batch):
 
     return inputs, labels, video_idx, time, collated_extra_data
 
+def clip_store_collate(batch, mean, std, normalize=True):
+    """
+    Collate function for the clip store. The zero-copy clip views are copied
+    straight into one preallocated batch. float16 clips were stored
+    normalized; uint8 clips are color normalized into a float32 batch, or
+    kept as uint8 if `normalize` is False (DATA.NORMALIZE_ON_DEVICE).
+    Args:
+        batch (tuple or list): data batch to collate.
+        mean (list): per channel mean of DATA.MEAN.
+        std (list): per channel std of DATA.STD.
+        normalize (bool): if False, uint8 clips are not normalized.
+    Returns:
+        (tuple): collated data batch.
+    """
+    frames, labels, video_idx, extra_data = zip(*batch)
+    keep_uint8 = frames[0].dtype == torch.uint8 and not normalize
+    inputs = torch.empty(
+        (len(frames),) + tuple(frames[0].shape),
+        dtype=torch.uint8 if keep_uint8 else torch.float32,
+    )
+    for i, clip in enumerate(frames):
+        inputs[i].copy_(clip)
+    if frames[0].dtype == torch.uint8 and normalize:
+        # Clips are `channel` x `num frames` x `height` x `width`.
+        mean = torch.tensor(mean).view(1, -1, 1, 1, 1) * 255.0
+        std = torch.tensor(std).view(1, -1, 1, 1, 1) * 255.0
+        inputs.sub_(mean).div_(std)
+    return (
+        inputs,
+        default_collate(labels),
+        default_collate(video_idx),
+        default_collate(extra_data),
+    )
+
 # def detection_collate(batch):
 #     """
 #     Collate function for detection task. Concatanate bboxes, labels and
@@ -143,7 +180,14 @@ def construct_loader(cfg, split, device='cpu', is_precise_bn=False):
         drop_last = False
 
     # Construct the dataset
-    dataset = build_dataset(dataset_name, cfg, split)
+    if cfg.MODEL.USE_FEATURE_CACHE:
+        dataset = FeatureCache(cfg, split)
+    elif cfg.DATA.CLIP_STORE_DIR != "":
+        dataset = ClipStore(cfg, split)
+    else:
+        dataset = build_dataset(dataset_name, cfg, split)
+    if cfg.TIMESFORMER.USE_SPATIAL_CACHE:
+        dataset = SpatialFeatureDataset(dataset, cfg.DATA.SPATIAL_CACHE_DIR)
 
     if cfg.MULTIGRID.SHORT_CYCLE and split in ["train"] and not is_precise_bn:
         # print('Create a sampler for multi-process training MULTIGRID.SHORT_CYCLE')
@@ -167,6 +211,13 @@ def construct_loader(cfg, split, device='cpu', is_precise_bn=False):
             collate_func = detection_collate
         elif cfg.TRAIN.DATASET == 'ava':
             collate_func = detection_collate
+        elif isinstance(dataset, ClipStore):
+            collate_func = partial(
+                clip_store_collate,
+                mean=cfg.DATA.MEAN,
+                std=cfg.DATA.STD,
+                normalize=not cfg.DATA.NORMALIZE_ON_DEVICE,
+            )
         else:
             collate_func = None
         # print('Create a sampler for multi-process training')
@@ -532,9 +532,10 @@ class Ssv2(torch.utils.data.Dataset):
         #          ).long(),
         #     )
 
-        save_path = self._path_to_videos[index][0].split('frames')[0] + 'SSv2_light/' + self._path_to_videos[index][0].split('frames')[-1].split('/')[1] + '.pkl'
+        save_path = self.get_light_path(index)
         # print(self._path_to_videos[index][0].split('frames')[0] + 'SSv2_light/' + self._path_to_videos[index][0].split('frames')[-1].split('/')[1] + '.pkl' , label)
         frames, label, _ = load_tensors_from_pickle(save_path)
+        frames = utils.light_clip_frames(frames, self.cfg)
         return frames, label, index, {}
 
     def __len__(self):
@@ -544,17 +545,31 @@ class Ssv2(torch.utils.data.Dataset):
         """
         return len(self._path_to_videos)
 
+    def get_light_path(self, index):
+        """
+        Returns:
+            (str): path of the pre-sampled `SSv2_light` pickle of the video.
+        """
+        return self._path_to_videos[index][0].split('frames')[0] + 'SSv2_light/' + self._path_to_videos[index][0].split('frames')[-1].split('/')[1] + '.pkl'
+
 import pickle
-def save_tensors_to_pickle(filename, frames, label, index):
+def save_tensors_to_pickle(filename, frames, label, index, mean=None, std=None):
     """
     Saves the given tensors (frames, label, index) into a pickle file.
+    Frames are stored as uint8 pixels, normalized float frames are converted
+    back with `mean` and `std`.
 
     Args:
         filename (str): The name of the pickle file to save to.
         frames (torch.Tensor): The tensor representing the frames.
         label (torch.Tensor): The tensor representing the label.
         index (torch.Tensor): The tensor representing the index.
+        mean (list): DATA.MEAN the float frames were normalized with.
+        std (list): DATA.STD the float frames were normalized with.
     """
+    if frames.dtype != torch.uint8:
+        assert mean is not None and std is not None, "Normalized frames need mean and std"
+        frames = utils.tensor_to_uint8(frames, mean, std)
     try:
         # Create a dictionary to hold the tensors
         data = {
@@ -0,0 +1,103 @@
+# Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved.
+
+"""
+Streaming decoding of long videos into overlapping clip windows. Frames are
+decoded chunk by chunk and only the frames of the current window are kept, so
+memory does not depend on the video length.
+"""
+
+import torch
+from collections import deque
+
+import timesformer.utils.logging as logging
+
+from . import decoder as decoder
+from . import transform as transform
+from . import utils as utils
+
+logger = logging.get_logger(__name__)
+
+
+def iter_video_frames(video_container, chunk_frames=256):
+    """
+    Decode a video in presentation order, `chunk_frames` frames at a time
+    with `decoder.pyav_decode_stream`.
+    Args:
+        video_container (container): PyAV container.
+        chunk_frames (int): number of frames decoded per chunk.
+    Returns:
+        (generator): decoded frames as `height` x `width` x `channel` uint8
+            ndarrays.
+    """
+    stream = video_container.streams.video[0]
+    pts_per_frame = max(
+        int(round(1.0 / (float(stream.average_rate) * float(stream.time_base)))),
+        1,
+    )
+    start_pts = stream.start_time or 0
+    while True:
+        end_pts = start_pts + chunk_frames * pts_per_frame - 1
+        frames, _ = decoder.pyav_decode_stream(
+            video_container, start_pts, end_pts, stream, {"video": 0}
+        )
+        # pyav_decode_stream also returns the first frame past end_pts, if
+        # any; it starts the next chunk.
+        next_pts = None
+        if frames and frames[-1].pts > end_pts:
+            next_pts = frames.pop().pts
+        for frame in frames:
+            yield frame.to_rgb().to_ndarray()
+        if next_pts is None:
+            return
+        start_pts = next_pts
+
+
+def iter_video_windows(cfg, video_container):
+    """
+    Slide a window of DATA.NUM_FRAMES frames, DATA.SAMPLING_RATE frames
+    apart, over a video with a stride of TEST.STREAM_WINDOW_STRIDE frames.
+    Every frame is resized to DATA.TEST_CROP_SIZE and center cropped once,
+    when it is decoded. Videos shorter than one window give a single window
+    padded with their last frame.
+    Args:
+        cfg (CfgNode): configs.
+        video_container (container): PyAV container.
+    Returns:
+        (generator): tuples of the index of the first frame of the window and
+            the list of uint8 pathway tensors of the window, each
+            `channel` x `num frames` x `height` x `width`. Frames are not
+            normalized, see `utils.normalize_on_device`.
+    """
+    span = (cfg.DATA.NUM_FRAMES - 1) * cfg.DATA.SAMPLING_RATE + 1
+    stride = cfg.TEST.STREAM_WINDOW_STRIDE
+    if stride <= 0:
+        stride = max(span // 2, 1)
+    size = cfg.DATA.TEST_CROP_SIZE
+
+    def _window(frames):
+        clip = torch.stack(list(frames)[:: cfg.DATA.SAMPLING_RATE], dim=1)
+        if cfg.MODEL.ARCH not in ["vit"]:
+            return utils.pack_pathway_output(cfg, clip)
+        return [clip]
+
+    buffer = deque(maxlen=span)
+    num_frames = 0
+    num_windows = 0
+    for frame in iter_video_frames(
+        video_container, cfg.TEST.STREAM_CHUNK_FRAMES
+    ):
+        # H W C -> 1 C H W.
+        frame = torch.from_numpy(frame).permute(2, 0, 1).unsqueeze(0)
+        frame, _ = transform.random_short_side_scale_jitter(frame, size, size)
+        frame, _ = transform.uniform_crop(frame, size, 1)
+        # Copy the crop out of the resized frame, only the crop is kept.
+        buffer.append(frame[0].contiguous())
+        num_frames += 1
+        start = num_frames - span
+        if start >= 0 and start % stride == 0:
+            num_windows += 1
+            yield start, _window(buffer)
+    if num_windows == 0 and len(buffer) > 0:
+        while len(buffer) < span:
+            buffer.append(buffer[-1])
+        yield 0, _window(buffer)
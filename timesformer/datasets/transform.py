@@ -51,6 +51,15 @@ def random_short_side_scale_jitter(
         if boxes is not None:
             boxes = boxes * float(new_width) / width
 
+    if images.dtype == torch.uint8:
+        # Bilinear interpolation needs floating point input.
+        images = torch.nn.functional.interpolate(
+            images.float(),
+            size=(new_height, new_width),
+            mode="bilinear",
+            align_corners=False,
+        )
+        return images.round_().clamp_(0, 255).to(torch.uint8), boxes
     return (
         torch.nn.functional.interpolate(
             images,
@@ -355,6 +355,71 @@ def revert_tensor_normalize(tensor, mean, std):
     return tensor
 
 
+def tensor_to_uint8(tensor, mean, std):
+    """
+    Convert a tensor normalized with `tensor_normalize` back to uint8 pixels.
+    Args:
+        tensor (tensor): normalized frames, `channel` x `num frames` x
+            `height` x `width`.
+        mean (list): mean value that was subtracted.
+        std (list): std that was divided by.
+    Returns:
+        tensor (tensor): uint8 frames in [0, 255].
+    """
+    mean = torch.tensor(mean).view(-1, 1, 1, 1)
+    std = torch.tensor(std).view(-1, 1, 1, 1)
+    tensor = torch.addcmul(mean * 255.0, tensor.float(), std * 255.0)
+    return tensor.round_().clamp_(0, 255).to(torch.uint8)
+
+
+def light_clip_frames(frames, cfg):
+    """
+    Frames of a `*_light` pickle in the dtype the loader yields: uint8 with
+    DATA.NORMALIZE_ON_DEVICE, normalized float32 otherwise. The pickles hold
+    uint8 frames; pickles written before that hold normalized float32 frames
+    and are converted on every load until tools/convert_light_pickles.py
+    rewrites them.
+    Args:
+        frames (tensor): frames of the pickle, `channel` x `num frames` x
+            `height` x `width`.
+        cfg (CfgNode): configs.
+    Returns:
+        frames (tensor): frames for the loader.
+    """
+    if cfg.DATA.NORMALIZE_ON_DEVICE:
+        if frames.dtype != torch.uint8:
+            frames = tensor_to_uint8(frames, cfg.DATA.MEAN, cfg.DATA.STD)
+        return frames
+    return normalize_on_device(frames.unsqueeze(0), cfg.DATA.MEAN, cfg.DATA.STD)[0]
+
+
+def normalize_on_device(inputs, mean, std):
+    """
+    Normalize a batch of uint8 frames on the device they are on, with a single
+    fused multiply-add per pathway. Inputs that are not uint8 are returned as
+    they are, as they were normalized by the loader already.
+    Args:
+        inputs (tensor or list): batch of frames, `batch` x `channel` x
+            `num frames` x `height` x `width`, or a list of such pathways.
+        mean (list): per channel mean of DATA.MEAN.
+        std (list): per channel std of DATA.STD.
+    Returns:
+        inputs (tensor or list): normalized float32 frames.
+    """
+    if isinstance(inputs, (list,)):
+        return [normalize_on_device(x, mean, std) for x in inputs]
+    if inputs.dtype != torch.uint8:
+        return inputs
+    # (x / 255 - mean) / std == x * scale + shift.
+    scale = 1.0 / (torch.tensor(std, device=inputs.device) * 255.0)
+    shift = -torch.tensor(mean, device=inputs.device) * scale * 255.0
+    return torch.addcmul(
+        shift.view(1, -1, 1, 1, 1),
+        inputs.float(),
+        scale.view(1, -1, 1, 1, 1),
+    )
+
+
 def create_sampler(dataset, shuffle, cfg):
     """
     Create sampler for the given dataset.
@@ -51,7 +51,7 @@ def build_model(cfg, gpu_id=None):
                 module=model, gradient_as_bucket_view=True
             )
         
-    else:
+    elif cfg.NUM_GPUS:
         if gpu_id is None:
             # Determine the GPU used by the current process
             cur_device = torch.cuda.current_device()
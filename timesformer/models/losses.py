@@ -20,3 +20,23 @@ def get_loss_func(loss_name):
     if loss_name not in _LOSSES.keys():
         raise NotImplementedError("Loss {} is not supported".format(loss_name))
     return _LOSSES[loss_name]
+
+
+def early_exit_loss(model, loss_fun, labels):
+    """
+    Auxiliary loss of the early exit heads: the mean of `loss_fun` over the
+    exit head logits kept by the VisionTransformer of `model` in its last
+    training forward. 0 if the model has no exit heads.
+    Args:
+        model (nn.Module): the model, possibly wrapped by DistributedDataParallel.
+        loss_fun (callable): loss of the final predictions.
+        labels (tensor): labels of the final predictions.
+    """
+    exit_preds = [
+        preds
+        for module in model.modules()
+        for preds in getattr(module, "exit_preds", [])
+    ]
+    if len(exit_preds) == 0:
+        return 0.0
+    return sum(loss_fun(preds, labels) for preds in exit_preds) / len(exit_preds)
@@ -0,0 +1,140 @@
+# Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved.
+
+"""
+Pure PyTorch Mamba block, a drop-in for mamba_ssm.Mamba on CPU. Parameters
+have the names and shapes of mamba_ssm.Mamba, so the same state dict loads
+into either.
+"""
+
+import math
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from einops import rearrange, repeat
+
+
+def selective_scan_ref(u, delta, A, B, C, D, z, delta_bias):
+    """ Sequential selective scan, one step at a time, as selective_scan_ref of mamba_ssm.
+    u, delta, z: (b, d, l), A: (d, n), B, C: (b, n, l), D, delta_bias: (d). Returns y: (b, d, l). """
+    delta = F.softplus(delta + delta_bias[..., None])
+    h = u.new_zeros(u.shape[0], u.shape[1], A.shape[1])
+    ys = []
+    for i in range(u.shape[2]):
+        h = torch.exp(torch.einsum('bd,dn->bdn', delta[:, :, i], A)) * h \
+            + torch.einsum('bd,bn,bd->bdn', delta[:, :, i], B[:, :, i], u[:, :, i])
+        ys.append(torch.einsum('bdn,bn->bd', h, C[:, :, i]))
+    y = torch.stack(ys, dim=2) + u * D[:, None]
+    return y * F.silu(z)
+
+
+def selective_scan(u, delta, A, B, C, D, z, delta_bias, chunk_size=8):
+    """ selective_scan_ref computed with a parallel (Hillis-Steele) scan of the recurrence h_t = a_t h_{t-1} + b_t:
+    log2(chunk_size) vectorized steps within chunks of chunk_size steps, each combining every step with the one
+    offset steps before it, then the last state of the previous chunk carried over by the cumulative products of a.
+    The (b, d, chunk_size, n) tensors of a chunk stay in cache, scanning the whole sequence at once is memory bound. """
+    delta = F.softplus(delta + delta_bias[..., None])
+    ys = []
+    h_last = None
+    for start in range(0, u.shape[2], chunk_size):
+        delta_c, u_c, B_c, C_c = (t[:, :, start:start + chunk_size] for t in (delta, u, B, C))
+        a = torch.exp(torch.einsum('bdl,dn->bdln', delta_c, A))
+        h = torch.einsum('bdl,bnl,bdl->bdln', delta_c, B_c, u_c)
+        offset = 1
+        while offset < a.shape[2]:
+            h = torch.cat((h[:, :, :offset], torch.addcmul(h[:, :, offset:], a[:, :, offset:], h[:, :, :-offset])), 2)
+            a = torch.cat((a[:, :, :offset], a[:, :, offset:] * a[:, :, :-offset]), 2)
+            offset *= 2
+        if h_last is not None:
+            h = torch.addcmul(h, a, h_last[:, :, None])
+        h_last = h[:, :, -1]
+        ys.append(torch.einsum('bdln,bnl->bdl', h, C_c))
+    y = torch.cat(ys, dim=2) + u * D[:, None]
+    return y * F.silu(z)
+
+
+class Mamba(nn.Module):
+    """ Mamba block with the parameters of mamba_ssm.Mamba. forward runs a parallel selective scan over chunks of
+    scan_chunk_size steps, forward_step runs the recurrence one step at a time for streaming. """
+
+    def __init__(self, d_model, d_state=16, d_conv=4, expand=2, dt_rank="auto", dt_min=0.001, dt_max=0.1,
+                 dt_init="random", dt_scale=1.0, dt_init_floor=1e-4, conv_bias=True, bias=False, device=None,
+                 dtype=None, scan_chunk_size=8, **kwargs):
+        factory_kwargs = {"device": device, "dtype": dtype}
+        super().__init__()
+        self.d_model = d_model
+        self.d_state = d_state
+        self.d_conv = d_conv
+        self.scan_chunk_size = scan_chunk_size
+        self.d_inner = int(expand * d_model)
+        self.dt_rank = math.ceil(d_model / 16) if dt_rank == "auto" else dt_rank
+
+        self.in_proj = nn.Linear(d_model, self.d_inner * 2, bias=bias, **factory_kwargs)
+        self.conv1d = nn.Conv1d(self.d_inner, self.d_inner, kernel_size=d_conv, groups=self.d_inner,
+                                padding=d_conv - 1, bias=conv_bias, **factory_kwargs)
+        self.act = nn.SiLU()
+        self.x_proj = nn.Linear(self.d_inner, self.dt_rank + d_state * 2, bias=False, **factory_kwargs)
+        self.dt_proj = nn.Linear(self.dt_rank, self.d_inner, bias=True, **factory_kwargs)
+
+        # initialization of mamba_ssm: dt_proj keeps softplus(bias) in [dt_min, dt_max]
+        dt_init_std = self.dt_rank ** -0.5 * dt_scale
+        if dt_init == "constant":
+            nn.init.constant_(self.dt_proj.weight, dt_init_std)
+        elif dt_init == "random":
+            nn.init.uniform_(self.dt_proj.weight, -dt_init_std, dt_init_std)
+        else:
+            raise NotImplementedError
+        dt = torch.exp(torch.rand(self.d_inner, **factory_kwargs) * (math.log(dt_max) - math.log(dt_min))
+                       + math.log(dt_min)).clamp(min=dt_init_floor)
+        inv_dt = dt + torch.log(-torch.expm1(-dt))
+        with torch.no_grad():
+            self.dt_proj.bias.copy_(inv_dt)
+
+        A = repeat(torch.arange(1, d_state + 1, dtype=torch.float32, device=device), 'n -> d n', d=self.d_inner)
+        self.A_log = nn.Parameter(torch.log(A).contiguous())
+        self.D = nn.Parameter(torch.ones(self.d_inner, device=device))
+        self.out_proj = nn.Linear(self.d_inner, d_model, bias=bias, **factory_kwargs)
+
+    def _ssm_inputs(self, x):
+        """ delta (b, d, l), B, C (b, n, l) of the convolved inputs x (b, d, l) """
+        x_dbl = self.x_proj(rearrange(x, 'b d l -> b l d'))
+        dt, B, C = torch.split(x_dbl, [self.dt_rank, self.d_state, self.d_state], dim=-1)
+        delta = rearrange(F.linear(dt, self.dt_proj.weight), 'b l d -> b d l')
+        return delta, rearrange(B, 'b l n -> b n l'), rearrange(C, 'b l n -> b n l')
+
+    def forward(self, hidden_states, sequential=False):
+        """ hidden_states: (b, l, d_model), returns (b, l, d_model). sequential runs selective_scan_ref instead of the
+        parallel scan. """
+        L = hidden_states.shape[1]
+        xz = rearrange(self.in_proj(hidden_states), 'b l d -> b d l')
+        x, z = xz.chunk(2, dim=1)
+        x = self.act(self.conv1d(x)[..., :L])
+        delta, B, C = self._ssm_inputs(x)
+        A = -torch.exp(self.A_log.float())
+        if sequential:
+            y = selective_scan_ref(x, delta, A, B, C, self.D.float(), z, self.dt_proj.bias.float())
+        else:
+            y = selective_scan(x, delta, A, B, C, self.D.float(), z, self.dt_proj.bias.float(), self.scan_chunk_size)
+        return self.out_proj(rearrange(y, 'b d l -> b l d'))
+
+    def forward_step(self, hidden_states, state=None):
+        """ Recurrent forward for streaming: hidden_states (b, n, d_model) are the next n steps of the sequences whose
+        convolution and SSM states are in `state`, as returned by the previous call (None at the start of a stream).
+        Same outputs as forward over the whole sequence, O(1) per step. Returns (b, n, d_model) and the new state. """
+        b = hidden_states.shape[0]
+        if state is None:
+            state = (hidden_states.new_zeros(b, self.d_inner, self.d_conv),
+                     hidden_states.new_zeros(b, self.d_inner, self.d_state))
+        conv_state, ssm_state = state
+        A = -torch.exp(self.A_log.float())
+        outs = []
+        for i in range(hidden_states.shape[1]):
+            x, z = self.in_proj(hidden_states[:, i]).chunk(2, dim=-1)
+            conv_state = torch.cat((conv_state[:, :, 1:], x[:, :, None]), dim=-1)
+            x = self.act((conv_state * rearrange(self.conv1d.weight, 'd 1 w -> d w')).sum(-1) + self.conv1d.bias)
+            delta, B, C = (t[..., 0] for t in self._ssm_inputs(x[:, :, None]))
+            delta = F.softplus(delta + self.dt_proj.bias)
+            ssm_state = ssm_state * torch.exp(torch.einsum('bd,dn->bdn', delta, A)) \
+                + torch.einsum('bd,bn,bd->bdn', delta, B, x)
+            y = torch.einsum('bdn,bn->bd', ssm_state, C) + self.D * x
+            outs.append(self.out_proj(y * self.act(z)))
+        return torch.stack(outs, dim=1), (conv_state, ssm_state)
@@ -3,29 +3,17 @@ import sys
 
 import argparse
 import os
-import cv2
 import glob
 import numpy as np
 import torch
 from PIL import Image
 import torch.nn as nn
-from raft.raft import RAFT
-from raft.utils import flow_viz
-from raft.utils.utils import InputPadder
-from PIL import Image
+# RAFT (raft.raft.RAFT, raft.utils.utils.InputPadder), DINO `vision_transformer`,
+# cv2 and matplotlib are imported by the code that uses them, see vit.MOOSE_Encoder.
 from einops import rearrange
 from .build import MODEL_REGISTRY
-import matplotlib.pyplot as plt
-from matplotlib.patches import Polygon
-import torch
-import torch.nn as nn
-import torchvision
-from torchvision import transforms as pth_transforms
-import numpy as np
-from PIL import Image
 # sys.path.append('/data2/hongn/dino')
 # import utils
-import vision_transformer as vits
 import math
 import torch.nn.functional as F
 
@@ -229,6 +217,8 @@ def denomalizing_img(tensor_img, mean = [0.45, 0.45, 0.45], std = [0.225, 0.225,
 # from torch import nn
 from einops import rearrange
 from torch import einsum
+# fused attention kernel with an explicit fallback for torch versions without F.scaled_dot_product_attention
+from .vit import scaled_dot_product_attention
 
 def exists(val):
     return val is not None
@@ -263,14 +253,36 @@ def triage_matrix(n):
     Returns:
         np.ndarray: Boolean triage matrix.
     """
-    matrix = np.zeros((n, n), dtype=bool)
-    
     # Example pattern: Upper triangular matrix
-    for i in range(n):
-        for j in range(i, n):
-            matrix[i, j] = True  # Fill upper triangle with True
-    
-    return matrix
+    return np.triu(np.ones((n, n), dtype=bool))
+
+def mask_to_bias(mask, dtype):
+    """ Additive attention bias of the bool `mask` (True where attention is allowed), as taken by
+    vit.scaled_dot_product_attention. Masked entries get -finfo.max, as the masked_fill of the explicit path. """
+    return torch.zeros(mask.shape, dtype = dtype, device = mask.device).masked_fill(~mask, -torch.finfo(dtype).max)
+
+def arrow_attention(q, k, v, scale, n = 1, dropout_p = 0.):
+    """ Attention of q to k, v under the mask arrow_matrix(i, n), computing only the entries it keeps: the CLS query
+    (token 0) attends every key, the other queries attend the CLS key and the keys in the band of arrow_matrix.
+    Cost and memory are linear in the number of tokens. q, k, v: (b, h, i, d) with the same i. """
+    w = 2 * n - 1
+    cls_out = scaled_dot_product_attention(q[:, :, :1], k, v, scale, dropout_p = dropout_p)
+    q, k_cls, v_cls, k, v = q[:, :, 1:], k[:, :, :1], v[:, :, :1], k[:, :, 1:], v[:, :, 1:]
+    num_tokens = q.shape[2]
+    # (query, key) slices of every band offset -w..w, keys past either end are masked
+    bands = [(slice(max(-o, 0), num_tokens - max(o, 0)), slice(max(o, 0), num_tokens - max(-o, 0)))
+             for o in range(-w, w + 1)]
+    # similarities to the CLS key, then to the key at every offset
+    sim = q.new_full(q.shape[:3] + (2 * w + 2,), -torch.finfo(q.dtype).max)
+    sim[..., 0] = (q * k_cls).sum(-1) * scale
+    for idx, (qs, ks) in enumerate(bands, 1):
+        sim[:, :, qs, idx] = (q[:, :, qs] * k[:, :, ks]).sum(-1) * scale
+    attn = F.dropout(sim.softmax(dim = -1), p = dropout_p, training = dropout_p > 0)
+    out = attn[..., :1] * v_cls
+    for idx, (qs, ks) in enumerate(bands, 1):
+        out[:, :, qs] += attn[:, :, qs, idx:idx + 1] * v[:, :, ks]
+    return torch.cat((cls_out, out), dim = 2)
+
 # bidirectional cross attention - have two sequences attend to each other with 1 attention step
 
 class BidirectionalCrossAttention(nn.Module):
@@ -283,7 +295,9 @@ class BidirectionalCrossAttention(nn.Module):
         context_dim = None,
         dropout = 0.,
         talking_heads = False,
-        prenorm = False
+        prenorm = False,
+        fused = True,
+        block_sparse = True
     ):
         super().__init__()
         context_dim = default(context_dim, dim)
@@ -310,6 +324,31 @@ class BidirectionalCrossAttention(nn.Module):
         self.talking_heads = nn.Conv2d(heads, heads, 1, bias = False) if talking_heads else nn.Identity()
         self.context_talking_heads = nn.Conv2d(heads, heads, 1, bias = False) if talking_heads else nn.Identity()
 
+        # fused attention kernels (F.scaled_dot_product_attention) for both directions when no attention matrix
+        # is needed, False for the explicit similarity matrix
+        self.fused = fused
+        # arrow masks computed as band plus CLS row and column (arrow_attention) instead of a masked dense matrix
+        self.block_sparse = block_sparse
+        # attention matrix masks by (kind, i, j, device), plain tensors so forward never changes the module state
+        self._matrix_masks = {}
+
+    def _matrix_mask(self, kind, i, j, device):
+        """ Bool mask (1, 1, i, j) of `kind`, True where attention is allowed. Built once per (kind, i, j, device)
+        and kept in a dict rather than as a buffer, so it broadcasts over the batch without registering module
+        state in forward; a model moved to another device builds its masks there on first use. """
+        key = (kind, i, j, str(device))
+        matrix_mask = self._matrix_masks.get(key)
+        if matrix_mask is None:
+            if kind == 'arrow':
+                matrix_mask = arrow_matrix(i, 1).bool()
+            elif kind == 'triag':
+                matrix_mask = torch.from_numpy(triage_matrix(i))
+            else:
+                assert False, f"No matrix_mask {kind} found"
+            matrix_mask = rearrange(matrix_mask, 'i j -> 1 1 i j').to(device)
+            self._matrix_masks[key] = matrix_mask
+        return matrix_mask
+
     def forward(
         self,
         x,
@@ -334,55 +373,64 @@ class BidirectionalCrossAttention(nn.Module):
 
         qk, context_qk, v, context_v = map(lambda t: rearrange(t, 'b n (h d) -> b h n d', h = h), (qk, context_qk, v, context_v))
 
-        # get similarities
-
-        sim = einsum('b h i d, b h j d -> b h i j', qk, context_qk) * self.scale
-
-        # relative positional bias, if supplied
-
-        if exists(rel_pos_bias):
-            sim = sim + rel_pos_bias
+        fusable = not return_attn and not exists(rel_pos_bias) and \
+            isinstance(self.talking_heads, nn.Identity) and isinstance(self.context_talking_heads, nn.Identity)
+        dropout_p = self.dropout.p if self.training else 0.
+        sparse = self.block_sparse and fusable and matrix_mask == 'arrow' and \
+            (exists(mask) or exists(context_mask)) and i == j
 
-        # mask
+        # mask, (b or 1, 1, i, j) broadcast over batch and heads
 
-        if exists(mask) or exists(context_mask):
-            mask = default(mask, torch.ones((b, i), device = device, dtype = torch.bool))
-            context_mask = default(context_mask, torch.ones((b, j), device = device, dtype = torch.bool))
+        attn_mask = None
+        if (exists(mask) or exists(context_mask)) and not sparse:
             if(matrix_mask == None):
-                attn_mask = rearrange(mask, 'b i -> b 1 i 1') * rearrange(context_mask, 'b j -> b 1 1 j')
-            elif(matrix_mask == 'arrow'):
-                # print(i, j)
-                attn_mask = arrow_matrix(i, 1).unsqueeze(0).repeat(b, 1, 1).unsqueeze(1).bool().to(device)#rearrange(mask, 'b i -> b 1 i 1') * rearrange(context_mask, 'b j -> b 1 1 j')
-                # assert False, "Get Here"
-            elif(matrix_mask == 'triag'):
-                attn_mask = triage_matrix(i).unsqueeze(0).repeat(b, 1, 1).unsqueeze(1).to(device)#rearrange(mask, 'b i -> b 1 i 1') * rearrange(context_mask, 'b j -> b 1 1 j')
+                mask = default(mask, torch.ones((b, i), device = device, dtype = torch.bool))
+                context_mask = default(context_mask, torch.ones((b, j), device = device, dtype = torch.bool))
+                attn_mask = rearrange(mask, 'b i -> b 1 i 1') & rearrange(context_mask, 'b j -> b 1 1 j')
             else:
-                assert False, f"No matrix_mask {matrix_mask} found"
-            sim = sim.masked_fill(~attn_mask, -torch.finfo(sim.dtype).max)
+                attn_mask = self._matrix_mask(matrix_mask, i, j, device)
         elif(matrix_mask == 'triag'):
-            attn_mask = triage_matrix(i).unsqueeze(0).repeat(b, 1, 1).unsqueeze(1).to(device)#rearrange(mask, 'b i -> b 1 i 1') * rearrange(context_mask, 'b j -> b 1 1 j')
-            sim = sim.masked_fill(~attn_mask, -torch.finfo(sim.dtype).max)
+            attn_mask = self._matrix_mask(matrix_mask, i, j, device)
             assert False, "code get here!!"
-        # get attention along both sequence length and context length dimensions
-        # shared similarity matrix
 
-        attn = sim.softmax(dim = -1)
-        context_attn = sim.softmax(dim = -2)
+        if sparse:
+            # arrow_matrix is symmetric, the column softmax is the same arrow attention from the context side
+            out = arrow_attention(qk, context_qk, context_v, self.scale, dropout_p = dropout_p)
+            context_out = arrow_attention(context_qk, qk, v, self.scale, dropout_p = dropout_p)
+        elif self.fused and fusable:
+            # the row softmax attends sequence -> context, the column softmax is the row softmax of the transposed
+            # similarities, i.e. context -> sequence. Two fused attention calls, no (b, h, i, j) matrix is kept.
+            attn_bias = mask_to_bias(attn_mask, qk.dtype) if exists(attn_mask) else None
+            out = scaled_dot_product_attention(qk, context_qk, context_v, self.scale,
+                                               dropout_p = dropout_p, attn_bias = attn_bias)
+            context_out = scaled_dot_product_attention(context_qk, qk, v, self.scale, dropout_p = dropout_p,
+                                                       attn_bias = attn_bias.transpose(-1, -2) if exists(attn_bias) else None)
+        else:
+            # get similarities
 
-        # dropouts
+            sim = einsum('b h i d, b h j d -> b h i j', qk, context_qk) * self.scale
 
-        attn = self.dropout(attn)
-        context_attn = self.context_dropout(context_attn)
+            # relative positional bias, if supplied
 
-        # talking heads
+            if exists(rel_pos_bias):
+                sim = sim + rel_pos_bias
 
-        attn = self.talking_heads(attn)
-        context_attn = self.context_talking_heads(context_attn)
+            if exists(attn_mask):
+                sim = sim.masked_fill(~attn_mask, -torch.finfo(sim.dtype).max)
 
-        # src sequence aggregates values from context, context aggregates values from src sequence
+            # get attention along both sequence length and context length dimensions
+            # shared similarity matrix, one direction at a time
 
-        out = einsum('b h i j, b h j d -> b h i d', attn, context_v)
-        context_out = einsum('b h j i, b h j d -> b h i d', context_attn, v)
+            # src sequence aggregates values from context, context aggregates values from src sequence
+
+            attn = self.talking_heads(self.dropout(sim.softmax(dim = -1)))
+            out = einsum('b h i j, b h j d -> b h i d', attn, context_v)
+            if not return_attn:
+                del attn
+
+            context_attn = self.context_talking_heads(self.context_dropout(sim.softmax(dim = -2)))
+            del sim
+            context_out = einsum('b h j i, b h j d -> b h i d', context_attn, v)
 
         # merge heads and combine out
 
@@ -460,4 +508,44 @@ class CausalSelfAttention(nn.Module):
         # concatenate outputs from each attention head and linearly project
         y = y.transpose(1, 2).contiguous().view(B, T, self.d)
         y = self.resid_dropout(self.c_proj(y))
-        return y
\ No newline at end of file
+        return y
+
+    def forward_step(self, x, cache=None, window=None):
+        """
+        Incremental forward for streaming. x [B, n, d] are the next n steps of
+        the sequences whose earlier keys and values are in `cache`, as returned
+        by the previous call (None at the start of a stream). Each step attends
+        to itself and the window - 1 steps before it, or to every earlier step
+        if window is None, so a call costs O(n * window).
+        Returns the outputs [B, n, d] of the new steps and the cache, the keys
+        and values [B, H, <= window, d // H] of the last window steps.
+        """
+        B, T, _ = x.size()
+
+        q, k, v  = self.c_attn(x).split(self.d, dim=2)
+        k = k.view(B, T, self.H, self.d // self.H).transpose(1, 2)
+        q = q.view(B, T, self.H, self.d // self.H).transpose(1, 2)
+        v = v.view(B, T, self.H, self.d // self.H).transpose(1, 2)
+        if cache is not None:
+            k = torch.cat((cache[0], k), dim=2)
+            v = torch.cat((cache[1], v), dim=2)
+
+        # positions of the new queries and of all keys, counted from the oldest cached key
+        L = k.size(2)
+        q_pos = torch.arange(L - T, L, device=x.device)[:, None]
+        k_pos = torch.arange(L, device=x.device)
+        allowed = k_pos <= q_pos
+        if window is not None:
+            allowed = allowed & (q_pos - k_pos < window)
+
+        att = (q @ k.transpose(-2, -1)) * (1.0 / math.sqrt(k.size(-1))) # [B, H, n, L]
+        att = att.masked_fill(~allowed, float('-inf'))
+        att = F.softmax(att, dim=-1)
+        att = self.attn_dropout(att)
+        y = att @ v
+
+        y = y.transpose(1, 2).contiguous().view(B, T, self.d)
+        y = self.resid_dropout(self.c_proj(y))
+        if window is not None:
+            k, v = k[:, :, -window:], v[:, :, -window:]
+        return y, (k, v)
\ No newline at end of file
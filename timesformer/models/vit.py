@@ -8,6 +8,7 @@ from functools import partial
 import math
 import warnings
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 import numpy as np
 from torch import inf
 from timesformer.models.vit_utils import IMAGENET_DEFAULT_MEAN, IMAGENET_DEFAULT_STD
@@ -18,7 +19,11 @@ from .build import MODEL_REGISTRY
 from torch import einsum
 from einops import rearrange, reduce, repeat
 import sys
-from mmpretrain import FeatureExtractor, get_model
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+# Heavy backends (mmpretrain, RAFT, DINO, mamba_ssm, cv2, torchvision) are imported
+# when the model that needs them is built, not when the registry is populated.
 # import torch_xla.core.xla_model as xm
 # import torch_xla.core.xla_model as xm
 # device = xm.xla_device()
@@ -63,21 +68,89 @@ class Mlp(nn.Module):
         x = self.drop(x)
         return x
 
+def scaled_dot_product_attention(q, k, v, scale, dropout_p=0., attn_bias=None):
+    """
+    softmax(q @ k^T * scale + attn_bias) @ v over the last two dims of (..., N, d) tensors.
+    Dispatches to the fused `F.scaled_dot_product_attention` kernel when the
+    installed torch provides it, otherwise runs the explicit math.
+    `attn_bias` is an optional additive bias broadcastable to (..., N, N).
+    """
+    if hasattr(F, 'scaled_dot_product_attention'):
+        default_scale = q.size(-1) ** -0.5
+        if scale != default_scale:
+            q = q * (scale / default_scale)
+        if attn_bias is not None:
+            attn_bias = attn_bias.to(q.dtype)
+        return F.scaled_dot_product_attention(q, k, v, attn_mask=attn_bias, dropout_p=dropout_p)
+    attn = (q @ k.transpose(-2, -1)) * scale
+    if attn_bias is not None:
+        attn = attn + attn_bias
+    attn = attn.softmax(dim=-1)
+    if dropout_p > 0.:
+        attn = F.dropout(attn, p=dropout_p)
+    return attn @ v
+
+def chunked_attention(q, k, v, scale, chunk_size=1024, dropout_p=0., attn_bias=None):
+    """
+    Same result as `scaled_dot_product_attention`, but queries and keys are
+    processed in blocks of `chunk_size` with an online (running max/sum)
+    softmax, so at most a (chunk_size, chunk_size) score block per head is
+    alive at a time instead of the full (N, N) matrix. Works on any device.
+    `attn_bias` must broadcast over queries, i.e. have shape (..., 1, N).
+    """
+    num_keys = k.size(-2)
+    out = []
+    for q_start in range(0, q.size(-2), chunk_size):
+        q_chunk = q[..., q_start:q_start + chunk_size, :] * scale
+        for k_start in range(0, num_keys, chunk_size):
+            k_chunk = k[..., k_start:k_start + chunk_size, :]
+            v_chunk = v[..., k_start:k_start + chunk_size, :]
+            sim = q_chunk @ k_chunk.transpose(-2, -1)
+            if attn_bias is not None:
+                sim = sim + attn_bias[..., k_start:k_start + chunk_size]
+            sim_max = sim.amax(dim=-1, keepdim=True)
+            if k_start == 0:
+                running_max = sim_max
+                attn = torch.exp(sim - running_max)
+                running_sum = attn.sum(dim=-1, keepdim=True)
+                if dropout_p > 0.:
+                    attn = F.dropout(attn, p=dropout_p)
+                acc = attn @ v_chunk
+            else:
+                new_max = torch.maximum(running_max, sim_max)
+                correction = torch.exp(running_max - new_max)
+                attn = torch.exp(sim - new_max)
+                running_sum = running_sum * correction + attn.sum(dim=-1, keepdim=True)
+                if dropout_p > 0.:
+                    attn = F.dropout(attn, p=dropout_p)
+                acc = acc * correction + attn @ v_chunk
+                running_max = new_max
+        out.append(acc / running_sum)
+    return torch.cat(out, dim=-2)
+
+ATTN_BACKENDS = ['naive', 'sdpa', 'chunked']
+
 class Attention(nn.Module):
-    def __init__(self, dim, num_heads=8, qkv_bias=False, qk_scale=None, attn_drop=0., proj_drop=0., with_qkv=True):
+    def __init__(self, dim, num_heads=8, qkv_bias=False, qk_scale=None, attn_drop=0., proj_drop=0., with_qkv=True, backend='naive', chunk_size=1024):
         super().__init__()
+        assert backend in ATTN_BACKENDS, f"No attention backend {backend} found!"
         self.num_heads = num_heads
         head_dim = dim // num_heads
         self.scale = qk_scale or head_dim ** -0.5
         self.with_qkv = with_qkv
+        self.backend = backend
+        self.chunk_size = chunk_size
         if self.with_qkv:
            self.qkv = nn.Linear(dim, dim * 3, bias=qkv_bias)
            self.proj = nn.Linear(dim, dim)
            self.proj_drop = nn.Dropout(proj_drop)
         self.attn_drop = nn.Dropout(attn_drop)
 
-    def forward(self, x):
+    def forward(self, x, size=None):
+        """ `size` (B, N) is the number of patches each token stands for after token merging, if any.
+        Keys are then weighted by their size (proportional attention). """
         B, N, C = x.shape
+        attn_bias = None if size is None else size.log()[:, None, None, :].to(x.dtype)
         if self.with_qkv:
         #    print('[The qkc dimentions]', B, N, 3, self.num_heads, C // self.num_heads, C)
            qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
@@ -86,26 +159,104 @@ class Attention(nn.Module):
            qkv = x.reshape(B, N, self.num_heads, C // self.num_heads).permute(0, 2, 1, 3)
            q, k, v  = qkv, qkv, qkv
 
-        attn = (q @ k.transpose(-2, -1)) * self.scale
-        attn = attn.softmax(dim=-1)
-        attn = self.attn_drop(attn)
+        if self.backend == 'naive':
+            attn = (q @ k.transpose(-2, -1)) * self.scale
+            if attn_bias is not None:
+                attn = attn + attn_bias
+            attn = attn.softmax(dim=-1)
+            attn = self.attn_drop(attn)
+            x = attn @ v
+        else:
+            dropout_p = self.attn_drop.p if self.training else 0.
+            if self.backend == 'sdpa':
+                x = scaled_dot_product_attention(q, k, v, self.scale, dropout_p=dropout_p, attn_bias=attn_bias)
+            else:
+                x = chunked_attention(q, k, v, self.scale, chunk_size=self.chunk_size, dropout_p=dropout_p, attn_bias=attn_bias)
 
-        x = (attn @ v).transpose(1, 2).reshape(B, N, C)
+        x = x.transpose(1, 2).reshape(B, N, C)
         if self.with_qkv:
            x = self.proj(x)
            x = self.proj_drop(x)
         return x
 
+def maybe_checkpoint(fn, enabled, *args, **kwargs):
+    """ fn(*args, **kwargs), with the activations of `fn` recomputed in backward instead of stored when `enabled`
+    and gradients are needed. The RNG state is restored for the recomputation, so DropPath and dropout draw the
+    same masks and results reproduce. """
+    if enabled and torch.is_grad_enabled():
+        return checkpoint(fn, *args, use_reentrant=False, preserve_rng_state=True, **kwargs)
+    return fn(*args, **kwargs)
+
+def spatial_token_size(size, T):
+    """ Sizes (B, N) of the merged spatial tokens of a clip -> sizes (B*T, 1+N) of the per-frame spatial
+    attention inputs of `Block`, with the CLS token counting as one patch. None if nothing was merged. """
+    if size is None:
+        return None
+    size = torch.cat((size.new_ones(size.size(0), 1), size), 1)
+    return size.repeat_interleave(T, dim=0)
+
+def bipartite_merge_tubes(x, size, T, r):
+    """
+    ToMe bipartite soft matching on the spatial tokens of a `divided_space_time` sequence
+    x (B, 1 + N*T, M) in 'b (n t) m' order. Tokens of one spatial location across the T frames (a tube)
+    are matched by the cosine similarity of their time-averaged features; the r most similar tubes of
+    the even set are averaged, weighted by `size`, into their match of the odd set. The same locations
+    are merged in every frame, so temporal attention still sees aligned tokens. The CLS token is kept.
+    Args:
+        x (tensor): tokens, (B, 1 + N*T, M).
+        size (tensor or None): patches per tube, (B, N); None means all ones.
+        T (int): number of frames.
+        r (int): tubes to merge, at most N // 2.
+    Returns:
+        x (tensor): (B, 1 + (N-r)*T, M), tubes in unspecified spatial order.
+        size (tensor): (B, N-r).
+    """
+    B, L, M = x.shape
+    N = (L - 1) // T
+    r = min(r, N // 2)
+    cls_token, tubes = x[:, :1], x[:, 1:].reshape(B, N, T * M)
+    if size is None:
+        size = x.new_ones(B, N)
+    if r <= 0:
+        return x, size
+
+    with torch.no_grad():
+        metric = x[:, 1:].reshape(B, N, T, M).mean(2)
+        metric = metric / metric.norm(dim=-1, keepdim=True)
+        scores = metric[:, ::2] @ metric[:, 1::2].transpose(-2, -1)
+        node_max, node_idx = scores.max(dim=-1)
+        edge_idx = node_max.argsort(dim=-1, descending=True)[..., None]
+        unm_idx = edge_idx[:, r:]
+        src_idx = edge_idx[:, :r]
+        dst_idx = node_idx[..., None].gather(dim=1, index=src_idx)
+
+    def merge(t):
+        src, dst = t[:, ::2], t[:, 1::2]
+        C = t.size(-1)
+        unm = src.gather(dim=1, index=unm_idx.expand(-1, -1, C))
+        src = src.gather(dim=1, index=src_idx.expand(-1, -1, C))
+        dst = dst.scatter_reduce(1, dst_idx.expand(-1, -1, C), src, reduce='sum')
+        return torch.cat([unm, dst], dim=1)
+
+    size = size[..., None].to(x.dtype)
+    tubes = merge(tubes * size)
+    size = merge(size)
+    tubes = tubes / size
+    x = torch.cat((cls_token, tubes.reshape(B, -1, M)), dim=1)
+    return x, size[..., 0]
+
 class Block(nn.Module):
 
     def __init__(self, dim, num_heads, mlp_ratio=4., qkv_bias=False, qk_scale=None, drop=0., attn_drop=0.,
-                 drop_path=0.1, act_layer=nn.GELU, norm_layer=nn.LayerNorm, attention_type='divided_space_time', pretrain_attn = None, pretrain_spatial_embs = None):
+                 drop_path=0.1, act_layer=nn.GELU, norm_layer=nn.LayerNorm, attention_type='divided_space_time', pretrain_attn = None, pretrain_spatial_embs = None,
+                 attn_backend='naive', attn_chunk_size=1024):
         super().__init__()
         self.attention_type = attention_type
         assert(attention_type in ['divided_space_time', 'space_only','joint_space_time', 'time_only'])
         self.norm1 = norm_layer(dim)
         self.attn = Attention(
-           dim, num_heads=num_heads, qkv_bias=qkv_bias, qk_scale=qk_scale, attn_drop=attn_drop, proj_drop=drop)
+           dim, num_heads=num_heads, qkv_bias=qkv_bias, qk_scale=qk_scale, attn_drop=attn_drop, proj_drop=drop,
+           backend=attn_backend, chunk_size=attn_chunk_size)
         
         ## Pretrain LVm modules
         self.pretrain_attn = pretrain_attn
@@ -120,7 +271,8 @@ class Block(nn.Module):
         if self.attention_type in ['divided_space_time', 'time_only']:
             self.temporal_norm1 = norm_layer(dim)
             self.temporal_attn = Attention(
-              dim, num_heads=num_heads, qkv_bias=qkv_bias, qk_scale=qk_scale, attn_drop=attn_drop, proj_drop=drop)
+              dim, num_heads=num_heads, qkv_bias=qkv_bias, qk_scale=qk_scale, attn_drop=attn_drop, proj_drop=drop,
+              backend=attn_backend, chunk_size=attn_chunk_size)
             self.temporal_fc = nn.Linear(dim, dim)
 
         ## drop path
@@ -130,7 +282,7 @@ class Block(nn.Module):
         self.mlp = Mlp(in_features=dim, hidden_features=mlp_hidden_dim, act_layer=act_layer, drop=drop)
 
 
-    def forward(self, x, B, T, W, x_spatial = None):
+    def forward(self, x, B, T, W, x_spatial = None, size = None):
         num_spatial_tokens = (x.size(1) - 1) // T
         H = num_spatial_tokens // W
 
@@ -154,7 +306,7 @@ class Block(nn.Module):
             xs = xt
             xs = rearrange(xs, 'b (h w t) m -> (b t) (h w) m',b=B,h=H,w=W,t=T)
             xs = torch.cat((cls_token, xs), 1)
-            res_spatial = self.drop_path(self.attn(self.norm1(xs)))
+            res_spatial = self.drop_path(self.attn(self.norm1(xs), size=spatial_token_size(size, T)))
 
             ### Taking care of CLS token
             cls_token = res_spatial[:,0,:]
@@ -195,6 +347,67 @@ class Block(nn.Module):
             return x
 
 
+class FusedBlock(Block):
+    """ Drop-in replacement of `Block` for `divided_space_time` attention.
+    Patch tokens stay in a (b, hw, t, m) view of the input sequence between the
+    temporal and spatial passes, both passes go through
+    `scaled_dot_product_attention` (`chunked_attention` with the `chunked`
+    backend), and the CLS token is normalized/projected once and broadcast to
+    every frame instead of being repeated T times.
+    Parameters are identical to `Block`, so existing checkpoints load unchanged.
+    """
+
+    def _attend(self, attn, q, k, v, attn_bias=None):
+        """ Attention of q, k, v with the backend of `attn`; `naive` and `sdpa` both take the fused kernel """
+        dropout_p = attn.attn_drop.p if self.training else 0.
+        if attn.backend == 'chunked':
+            return chunked_attention(q, k, v, attn.scale, chunk_size=attn.chunk_size, dropout_p=dropout_p, attn_bias=attn_bias)
+        return scaled_dot_product_attention(q, k, v, attn.scale, dropout_p=dropout_p, attn_bias=attn_bias)
+
+    def forward(self, x, B, T, W, x_spatial = None, size = None):
+        if self.attention_type != 'divided_space_time':
+            return super().forward(x, B, T, W, x_spatial, size)
+
+        HW = (x.size(1) - 1) // T
+        M = x.size(2)
+        num_heads = self.attn.num_heads
+        head_dim = M // num_heads
+
+        ## Temporal, (b h w) t m is a free view of the (h w t) token order
+        init_cls_token = x[:, :1, :]
+        xt = x[:, 1:, :].reshape(B * HW, T, M)
+        qkv = self.temporal_attn.qkv(self.temporal_norm1(xt))
+        qkv = qkv.reshape(B * HW, T, 3, num_heads, head_dim).permute(2, 0, 3, 1, 4)
+        res_temporal = self._attend(self.temporal_attn, qkv[0], qkv[1], qkv[2])
+        res_temporal = res_temporal.transpose(1, 2).reshape(B * HW, T, M)
+        res_temporal = self.temporal_attn.proj_drop(self.temporal_attn.proj(res_temporal))
+        res_temporal = self.temporal_fc(self.drop_path(res_temporal))
+        xt = (xt + res_temporal).view(B, HW, T, M)
+
+        ## Spatial, the CLS q/k/v are computed once and broadcast over frames
+        cls_qkv = self.attn.qkv(self.norm1(init_cls_token)).view(B, 1, 3, num_heads, head_dim)
+        xs_qkv = self.attn.qkv(self.norm1(xt)).view(B, HW, T, 3, num_heads, head_dim)
+        qkv = xs_qkv.new_empty(3, B, T, num_heads, HW + 1, head_dim)
+        qkv[:, :, :, :, 0] = cls_qkv.permute(2, 0, 1, 3, 4)
+        qkv[:, :, :, :, 1:] = xs_qkv.permute(3, 0, 2, 4, 1, 5)
+        qkv = qkv.view(3, B * T, num_heads, HW + 1, head_dim)
+        spatial_size = spatial_token_size(size, T)
+        res_spatial = self._attend(
+            self.attn, qkv[0], qkv[1], qkv[2],
+            attn_bias=None if spatial_size is None else spatial_size.log()[:, None, None, :].to(qkv.dtype))
+        res_spatial = res_spatial.transpose(1, 2).reshape(B * T, HW + 1, M)
+        res_spatial = self.drop_path(self.attn.proj_drop(self.attn.proj(res_spatial)))
+
+        ### Taking care of CLS token
+        cls_token = res_spatial[:, 0, :].view(B, T, M).mean(1, True) ## averaging for every frame
+        res_spatial = res_spatial[:, 1:, :].view(B, T, HW, M).transpose(1, 2)
+
+        ## Mlp
+        x = torch.cat((init_cls_token + cls_token, (xt + res_spatial).reshape(B, HW * T, M)), 1)
+        x = x + self.drop_path(self.mlp(self.norm2(x)))
+        return x
+
+
 class PatchEmbed(nn.Module):
     """ Image to Patch Embedding
     """
@@ -257,7 +470,9 @@ class VisionTransformer(nn.Module):
     #              drop_path_rate=0.1, hybrid_backbone=None, norm_layer=nn.LayerNorm, num_frames=8, attention_type='divided_space_time', dropout=0.):
     def __init__(self, img_size=1024, patch_size=16, in_chans=3, num_classes=1000, embed_dim=1024, depth=12, pretrain_space_embs_path = "/data2/hongn/sapiens/pretrain/checkpoints/sapiens_0.3b/sapiens_0.3b_epoch_1600_clean.pth",
                 num_heads=12, mlp_ratio=4., qkv_bias=False, qk_scale=None, drop_rate=0., attn_drop_rate=0.,
-                drop_path_rate=0.1, hybrid_backbone=None, norm_layer=nn.LayerNorm, num_frames=8, attention_type='space_only', dropout=0.):
+                drop_path_rate=0.1, hybrid_backbone=None, norm_layer=nn.LayerNorm, num_frames=8, attention_type='space_only', dropout=0., fused_block=False,
+                attn_backend='naive', attn_chunk_size=1024, use_spatial_cache=False, interleave_spatial=False, tome_r=0,
+                activation_checkpoint=0, early_exit_blocks=(), early_exit_threshold=0.):
         super().__init__()
         self.attention_type = attention_type
         self.depth = depth
@@ -271,13 +486,13 @@ class VisionTransformer(nn.Module):
         # import time
         # from argparse import ArgumentParser
 
-        if(self.attention_type == 'time_only'):
+        ## With the spatial cache, the Sapiens embeddings come with the inputs
+        self.use_spatial_cache = use_spatial_cache
+        ## Run Sapiens layer by layer in lockstep with the blocks, keeping one spatial layer alive instead of all
+        self.interleave_spatial = interleave_spatial
+        if(self.attention_type == 'time_only' and not self.use_spatial_cache):
             assert self.pretrain_space_embs_path != None, "Please input pretrain_space_embs=path/to/pretrain_sapiens_models"
-            model_config = "/data2/hongn/sapiens/pretrain/configs/sapiens_mae/humans_300m_test/mae_sapiens_0.3b-p16_8xb512-coslr-1600e_humans_300m_test.py"
-            # checkpoint = "/mnt/c/Users/PCM/Documents/GitHub/VideoUnderstanding/sapiens/pretrain/checkpoints/sapiens_0.3b/sapiens_0.3b_epoch_1600_clean.pth"
-            with torch.no_grad():
-                self.pretrain_space_embs = get_model(model=model_config, pretrained=self.pretrain_space_embs_path, device='cpu', backbone=dict(out_indices=(0, 2, 4, 6, 8, 10, 12, 14, 16, 18, 20, 22, 24)))
-                self.pretrain_space_embs.requires_grad = False
+            self.pretrain_space_embs = get_sapiens_space_embs(self.pretrain_space_embs_path)
             # self.pretrain_space_embs.model.backbone.out_type = 'featmap'
             # results, inputs, outputs = self.pretrain_space_embs(image_path)
         ## Patch Embeddings
@@ -290,22 +505,42 @@ class VisionTransformer(nn.Module):
         self.cls_token = nn.Parameter(torch.zeros(1, 1, embed_dim))
         self.pos_embed = nn.Parameter(torch.zeros(1, num_patches+1, embed_dim))
         self.pos_drop = nn.Dropout(p=drop_rate)
+        ## Resized pos/time embeddings per input geometry, see _cached_embed
+        self._embed_cache = {}
         if self.attention_type != 'space_only':
             self.time_embed = nn.Parameter(torch.zeros(1, num_frames, embed_dim))
             self.time_drop = nn.Dropout(p=drop_rate)
 
         ## Attention Blocks
         dpr = [x.item() for x in torch.linspace(0, drop_path_rate, self.depth)]  # stochastic depth decay rule
+        block_layer = FusedBlock if fused_block else Block
         self.blocks = nn.ModuleList([
-            Block(
+            block_layer(
                 dim=embed_dim, num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale,
-                drop=drop_rate, attn_drop=attn_drop_rate, drop_path=dpr[i], norm_layer=norm_layer, attention_type=self.attention_type)
+                drop=drop_rate, attn_drop=attn_drop_rate, drop_path=dpr[i], norm_layer=norm_layer, attention_type=self.attention_type,
+                attn_backend=attn_backend, attn_chunk_size=attn_chunk_size)
             for i in range(self.depth)])
         self.norm = norm_layer(embed_dim)
+        self.set_tome_r(tome_r)
+        ## Recompute the activations of every k-th block in backward instead of storing them, 0 disables
+        self.activation_checkpoint = activation_checkpoint
 
         # Classifier head
         self.head = nn.Linear(embed_dim, num_classes) if num_classes > 0 else nn.Identity()
 
+        ## Early exit heads on the cls_token after the blocks in early_exit_blocks. At inference a clip leaves the
+        ## batch once the softmax confidence of an exit head reaches early_exit_threshold, 0 runs every block
+        assert not early_exit_blocks or self.attention_type in ['divided_space_time', 'joint_space_time'], \
+            "Early exit is only implemented for divided_space_time and joint_space_time attention"
+        assert all(0 <= idx < self.depth - 1 for idx in early_exit_blocks), "Early exit blocks must precede the last block"
+        self.exit_heads = nn.ModuleDict({
+            str(idx): nn.Sequential(norm_layer(embed_dim), nn.Linear(embed_dim, num_classes)) for idx in early_exit_blocks})
+        self.early_exit_threshold = early_exit_threshold
+        ## Exit head logits of the last training forward, for the auxiliary loss (losses.early_exit_loss)
+        self.exit_preds = []
+        ## Blocks run by every clip of the last early exit forward
+        self.exit_depth = None
+
         trunc_normal_(self.pos_embed, std=.02)
         trunc_normal_(self.cls_token, std=.02)
         self.apply(self._init_weights)
@@ -337,6 +572,97 @@ class VisionTransformer(nn.Module):
     def get_classifier(self):
         return self.head
 
+    def _resize_pos_embed(self, H, W):
+        """ pos_embed interpolated (nearest) to an H x W patch grid, CLS position unchanged """
+        pos_embed = self.pos_embed
+        cls_pos_embed = pos_embed[0,0,:].unsqueeze(0).unsqueeze(1)
+        other_pos_embed = pos_embed[0,1:,:].unsqueeze(0).transpose(1, 2)
+        P = int(other_pos_embed.size(2) ** 0.5)
+        other_pos_embed = other_pos_embed.reshape(1, pos_embed.size(2), P, P)
+        new_pos_embed = F.interpolate(other_pos_embed, size=(H, W), mode='nearest')
+        new_pos_embed = new_pos_embed.flatten(2)
+        new_pos_embed = new_pos_embed.transpose(1, 2)
+        return torch.cat((cls_pos_embed, new_pos_embed), 1)
+
+    def _resize_time_embed(self, T):
+        """ time_embed interpolated (nearest) to T frames """
+        time_embed = self.time_embed.transpose(1, 2)
+        new_time_embed = F.interpolate(time_embed, size=(T), mode='nearest')
+        return new_time_embed.transpose(1, 2)
+
+    def _cached_embed(self, name, geometry, param, resize):
+        """ resize(*geometry), reused across forward calls for the same geometry while `param` is unchanged.
+        Optimizer steps and load_state_dict update the parameter in place, which bumps its version counter and
+        invalidates the entry. Recomputed when gradients flow to `param`, the graph of a cached tensor is freed
+        by the first backward. """
+        if torch.is_grad_enabled() and param.requires_grad:
+            return resize(*geometry)
+        version = (param._version, param.data_ptr(), param.dtype, param.device)
+        entry = self._embed_cache.get((name,) + geometry)
+        if entry is None or entry[0] != version:
+            entry = (version, resize(*geometry).detach())
+            self._embed_cache[(name,) + geometry] = entry
+        return entry[1]
+
+    @torch.no_grad()
+    def resize_embeddings(self, img_size=None, num_frames=None):
+        """ Bake pos_embed / time_embed resized to a deployment geometry into the parameters, so a checkpoint
+        saved afterwards loads into a model built with img_size / num_frames and never interpolates at test time.
+        Values are the ones forward_features uses for inputs of that geometry. """
+        if img_size is not None:
+            img_size = to_2tuple(img_size)
+            patch_size = self.patch_embed.patch_size
+            H, W = img_size[0] // patch_size[0], img_size[1] // patch_size[1]
+            if H * W + 1 != self.pos_embed.size(1):
+                self.pos_embed = nn.Parameter(self._resize_pos_embed(H, W).clone())
+            self.patch_embed.img_size = img_size
+            self.patch_embed.num_patches = H * W
+        if num_frames is not None and self.attention_type != 'space_only' and num_frames != self.time_embed.size(1):
+            self.time_embed = nn.Parameter(self._resize_time_embed(num_frames).clone())
+        self._embed_cache.clear()
+
+    def _checkpoint_block(self, idx):
+        return self.training and self.activation_checkpoint > 0 and idx % self.activation_checkpoint == 0
+
+    def set_tome_r(self, tome_r):
+        """ Token merging schedule: tubes merged after every block, an int for all blocks or one int per block. """
+        if isinstance(tome_r, (list, tuple)):
+            assert len(tome_r) == self.depth, "Token merging needs one r per block, got {}".format(len(tome_r))
+            self.tome_r = list(tome_r)
+        else:
+            self.tome_r = [tome_r] * self.depth
+        assert max(self.tome_r) <= 0 or self.attention_type == 'divided_space_time', \
+            "Token merging is only implemented for divided_space_time attention"
+
+    def _early_exit_enabled(self):
+        return len(self.exit_heads) > 0 and not self.training and self.early_exit_threshold > 0 \
+            and not torch.jit.is_tracing()
+
+    def _early_exit(self, idx, x, remaining, exits):
+        """ Exit head of block idx on the cls_tokens of x. Keeps its logits for the auxiliary loss in training; with
+        early exit, appends (idx, indices in the batch, logits) of the confident clips to `exits` and returns the mask
+        of the clips that go on. Nothing is computed in evaluation without early exit. """
+        if self.training:
+            self.exit_preds.append(self.exit_heads[str(idx)](x[:, 0]))
+            return None
+        if not self._early_exit_enabled():
+            return None
+        logits = self.exit_heads[str(idx)](x[:, 0])
+        done = F.softmax(logits.float(), dim=-1).max(dim=-1)[0] >= self.early_exit_threshold
+        exits.append((idx, remaining[done], logits[done]))
+        return ~done
+
+    def _gather_exits(self, preds, remaining, exits):
+        """ Logits of the whole batch in input order from those of the clips that ran every block and of the exits """
+        batch_size = len(remaining) + sum(len(index) for _, index, _ in exits)
+        out = preds.new_empty(batch_size, preds.size(1))
+        out[remaining] = preds
+        self.exit_depth = remaining.new_full((batch_size,), self.depth)
+        for idx, index, logits in exits:
+            out[index] = logits.to(out.dtype)
+            self.exit_depth[index] = idx + 1
+        return out
+
     def reset_classifier(self, num_classes, global_pool=''):
         self.num_classes = num_classes
         self.head = nn.Linear(self.embed_dim, num_classes) if num_classes > 0 else nn.Identity()
@@ -344,9 +670,19 @@ class VisionTransformer(nn.Module):
     def forward_features(self, x):
         ## pre-extract [2, 4, 6, ..., 24] embeddings from pretrained Sapiens as frozen space embs
         if self.attention_type == 'time_only':
-            with torch.no_grad():
+            if self.use_spatial_cache:
+                ## x = [frames, cached embeddings [b, t, layers, p+1, d]]
+                x, x_spatial = x
+                x_spatial = rearrange(x_spatial.to(x.dtype), 'b t l n m -> l (b t) n m')
+            elif self.interleave_spatial:
+                ## Sapiens advances one layer per block in the block loop below
                 x_temp = rearrange(x, 'b c t h w -> (b t) c h w').detach()
-                x_spatial = self.pretrain_space_embs(x_temp)
+                x_spatial = iter_sapiens_space_embs(self.pretrain_space_embs, x_temp)
+                del x_temp
+            else:
+                with torch.no_grad():
+                    x_temp = rearrange(x, 'b c t h w -> (b t) c h w').detach()
+                    x_spatial = self.pretrain_space_embs(x_temp)
             # x_spatial.requires_grad = False
         # print('x_spatial len', len(x_spatial))
 
@@ -359,17 +695,8 @@ class VisionTransformer(nn.Module):
 
         ## resizing the positional embeddings in case they don't match the input at inference
         if x.size(1) != self.pos_embed.size(1):
-            pos_embed = self.pos_embed
-            cls_pos_embed = pos_embed[0,0,:].unsqueeze(0).unsqueeze(1)
-            other_pos_embed = pos_embed[0,1:,:].unsqueeze(0).transpose(1, 2)
-            P = int(other_pos_embed.size(2) ** 0.5)
             H = x.size(1) // W
-            other_pos_embed = other_pos_embed.reshape(1, x.size(2), P, P)
-            new_pos_embed = F.interpolate(other_pos_embed, size=(H, W), mode='nearest')
-            new_pos_embed = new_pos_embed.flatten(2)
-            new_pos_embed = new_pos_embed.transpose(1, 2)
-            new_pos_embed = torch.cat((cls_pos_embed, new_pos_embed), 1)
-            x = x + new_pos_embed
+            x = x + self._cached_embed('pos', (H, W), self.pos_embed, self._resize_pos_embed)
         else:
             x = x + self.pos_embed
         x = self.pos_drop(x)
@@ -382,10 +709,7 @@ class VisionTransformer(nn.Module):
             x = rearrange(x, '(b t) n m -> (b n) t m',b=B,t=T)
             ## Resizing time embeddings in case they don't match
             if T != self.time_embed.size(1):
-                time_embed = self.time_embed.transpose(1, 2)
-                new_time_embed = F.interpolate(time_embed, size=(T), mode='nearest')
-                new_time_embed = new_time_embed.transpose(1, 2)
-                x = x + new_time_embed
+                x = x + self._cached_embed('time', (T,), self.time_embed, self._resize_time_embed)
             else:
                 x = x + self.time_embed
             x = self.time_drop(x)
@@ -393,14 +717,37 @@ class VisionTransformer(nn.Module):
             x = torch.cat((cls_tokens, x), dim=1)
 
         ## Attention blocks
-        if(self.attention_type == 'time_only'):
+        if(self.attention_type == 'time_only' and self.interleave_spatial and not self.use_spatial_cache):
+            for idx, blk in enumerate(self.blocks):
+                with torch.no_grad():
+                    x_spatial_layer = next(x_spatial)
+                x = maybe_checkpoint(blk, self._checkpoint_block(idx), x, B, T, W, x_spatial_layer)
+            del x_spatial, x_spatial_layer
+        elif(self.attention_type == 'time_only'):
             for idx, blk in enumerate(self.blocks):
                 # print(idx)
-                x = blk(x, B, T, W, x_spatial[idx].detach())
+                x = maybe_checkpoint(blk, self._checkpoint_block(idx), x, B, T, W, x_spatial[idx].detach())
         else:
+            size = None
+            ## Indices in the batch of the clips still running through the blocks, and the clips that left early
+            remaining, exits = torch.arange(B, device=x.device), []
+            self.exit_preds = []
             for idx, blk in enumerate(self.blocks):
                 # print(idx)
-                x = blk(x, B, T, W)
+                x = maybe_checkpoint(blk, self._checkpoint_block(idx), x, B, T, W, size=size)
+                if self.tome_r[idx] > 0 and idx < self.depth - 1:
+                    x, size = bipartite_merge_tubes(x, size, T, self.tome_r[idx])
+                    ## merged tubes no longer form an H x W grid
+                    W = 1
+                if str(idx) in self.exit_heads:
+                    keep = self._early_exit(idx, x, remaining, exits)
+                    if keep is not None:
+                        ## Compact the batch to the clips that go on
+                        x, remaining, B = x[keep], remaining[keep], int(keep.sum())
+                        size = size[keep] if size is not None else None
+                        if B == 0:
+                            break
+            self._exits = (remaining, exits)
 
         ## Free redundant space in TPU
         # del x_spatial
@@ -416,6 +763,8 @@ class VisionTransformer(nn.Module):
     def forward(self, x):
         x = self.forward_features(x)
         x = self.head(x[:, 0])
+        if self._early_exit_enabled():
+            x = self._gather_exits(x, *self._exits)
         return x
 
 
@@ -436,7 +785,7 @@ class vit_base_patch16_224(nn.Module):
         super(vit_base_patch16_224, self).__init__()
         self.pretrained=True
         patch_size = 16
-        self.model = VisionTransformer(img_size=cfg.DATA.TRAIN_CROP_SIZE, num_classes=cfg.MODEL.NUM_CLASSES, patch_size=patch_size, embed_dim=768, depth=12, num_heads=12, mlp_ratio=4, qkv_bias=True, norm_layer=partial(nn.LayerNorm, eps=1e-6), drop_rate=0., attn_drop_rate=0., drop_path_rate=0.1, num_frames=cfg.DATA.NUM_FRAMES, attention_type=cfg.TIMESFORMER.ATTENTION_TYPE, **kwargs)
+        self.model = VisionTransformer(img_size=cfg.DATA.TRAIN_CROP_SIZE, num_classes=cfg.MODEL.NUM_CLASSES, patch_size=patch_size, embed_dim=768, depth=12, num_heads=12, mlp_ratio=4, qkv_bias=True, norm_layer=partial(nn.LayerNorm, eps=1e-6), drop_rate=0., attn_drop_rate=0., drop_path_rate=0.1, num_frames=cfg.DATA.NUM_FRAMES, attention_type=cfg.TIMESFORMER.ATTENTION_TYPE, fused_block=cfg.TIMESFORMER.FUSED_BLOCK, attn_backend=cfg.MODEL.ATTN_BACKEND, attn_chunk_size=cfg.MODEL.ATTN_CHUNK_SIZE, use_spatial_cache=cfg.TIMESFORMER.USE_SPATIAL_CACHE, interleave_spatial=cfg.TIMESFORMER.INTERLEAVE_SPATIAL, tome_r=cfg.TIMESFORMER.TOME_SCHEDULE or cfg.TIMESFORMER.TOME_R, activation_checkpoint=cfg.MODEL.ACTIVATION_CHECKPOINT, early_exit_blocks=cfg.TIMESFORMER.EARLY_EXIT_BLOCKS, early_exit_threshold=cfg.TEST.EARLY_EXIT_THRESHOLD, **kwargs)
 
         self.attention_type = cfg.TIMESFORMER.ATTENTION_TYPE
         self.model.default_cfg = default_cfgs['vit_base_patch16_224']
@@ -455,7 +804,7 @@ class vit_base_PS_224(nn.Module):
         super(vit_base_PS_224, self).__init__()
         self.pretrained=False
         patch_size = 16
-        self.model = VisionTransformer(img_size=cfg.DATA.TRAIN_CROP_SIZE, num_classes=cfg.MODEL.NUM_CLASSES, patch_size=patch_size, embed_dim=1024, depth=12, num_heads=16, mlp_ratio=4, qkv_bias=True, norm_layer=partial(nn.LayerNorm, eps=1e-6), drop_rate=0., attn_drop_rate=0., drop_path_rate=0.1, num_frames=cfg.DATA.NUM_FRAMES, attention_type=cfg.TIMESFORMER.ATTENTION_TYPE, **kwargs)
+        self.model = VisionTransformer(img_size=cfg.DATA.TRAIN_CROP_SIZE, num_classes=cfg.MODEL.NUM_CLASSES, patch_size=patch_size, embed_dim=1024, depth=12, num_heads=16, mlp_ratio=4, qkv_bias=True, norm_layer=partial(nn.LayerNorm, eps=1e-6), drop_rate=0., attn_drop_rate=0., drop_path_rate=0.1, num_frames=cfg.DATA.NUM_FRAMES, attention_type=cfg.TIMESFORMER.ATTENTION_TYPE, fused_block=cfg.TIMESFORMER.FUSED_BLOCK, attn_backend=cfg.MODEL.ATTN_BACKEND, attn_chunk_size=cfg.MODEL.ATTN_CHUNK_SIZE, use_spatial_cache=cfg.TIMESFORMER.USE_SPATIAL_CACHE, interleave_spatial=cfg.TIMESFORMER.INTERLEAVE_SPATIAL, tome_r=cfg.TIMESFORMER.TOME_SCHEDULE or cfg.TIMESFORMER.TOME_R, activation_checkpoint=cfg.MODEL.ACTIVATION_CHECKPOINT, early_exit_blocks=cfg.TIMESFORMER.EARLY_EXIT_BLOCKS, early_exit_threshold=cfg.TEST.EARLY_EXIT_THRESHOLD, **kwargs)
 
         self.attention_type = cfg.TIMESFORMER.ATTENTION_TYPE
         self.model.default_cfg = default_cfgs['vit_base_patch16_224']
@@ -518,10 +867,6 @@ class MotionPatchEmbed(nn.Module):
         x = self.proj(x).flatten(2).transpose(1, 2)
         return x
     
-from transformers import AutoImageProcessor, AutoModel
-from timesformer.models.moose import *
-from torchvision.transforms import Resize
-
 class MOOSE_Encoder(nn.Module):
     """ Vision Transformer """
     def __init__(self, raft_args, cfg):
@@ -529,6 +874,9 @@ class MOOSE_Encoder(nn.Module):
         self.cfg = cfg
         # self.device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
         self.motion_model = self._init_motion_model(raft_args)
+        self._padders = {}
+        if self.cfg.MODEL.MOTION_MODEL == "opencv":
+            self.flow_engine = OpticalFlowEngine(cfg.MODEL.FLOW_NUM_THREADS)
         # self.patch_embed = PatchEmbed(img_size=28, patch_size=2, in_chans=2, embed_dim=768) # Flow patches embedding
         self.visual_model = self._init_visual_model()
         # self.motion_feature_extractor = VisionTransformer(img_size=img_size, num_classes=num_classes, patch_size=motion_patch_size, embed_dim=embed_dim, depth=3, num_heads=12, mlp_ratio=1, qkv_bias=True, norm_layer=partial(nn.LayerNorm, eps=1e-6), drop_rate=0., attn_drop_rate=0., drop_path_rate=0.1, num_frames=num_frames)
@@ -537,6 +885,8 @@ class MOOSE_Encoder(nn.Module):
         # self.head = nn.Linear(embed_dim, num_classes) if num_classes > 0 else nn.Identity()
 
     def _init_motion_model(self, args):
+        from raft.raft import RAFT
+
         with torch.no_grad():
             motion_model = torch.nn.DataParallel(RAFT(args))
             for p in motion_model.parameters():
@@ -550,6 +900,8 @@ class MOOSE_Encoder(nn.Module):
 
     def _init_visual_model(self):
         if(self.cfg.MODEL.VISUAL_MODEL == "dino"):
+            import vision_transformer as vits
+
             with torch.no_grad():
                 vi_model = vits.__dict__['vit_base'](patch_size=16, num_classes=0)
                 for p in model.parameters():
@@ -604,31 +956,51 @@ class MOOSE_Encoder(nn.Module):
         # return ret
         
         with torch.no_grad():
-            x = rearrange(x, 'b c t w h -> (b t) c w h', b=b, t=t)
-            x = denomalizing_img(x)
-            if(self.cfg.MODEL.VISUAL_MODEL == "sapiens"):
-                x = Resize(224)(x)
-            x = rearrange(x, '(b t) c w h -> b t c w h', b=b, t=t)
+            x = self.preprocess_motion(x)
             if(self.cfg.MODEL.MOTION_MODEL == "opencv"):
-               ret = extract_optical_flow_sparse_to_dense_video(x)
+               ret = self.flow_engine(x)
                return ret
-            # print(f'b = {b}, t = {t}')
-            # flow_embs_batches = []
+            # Fold the t-1 frame pairs into the batch, so RAFT runs once.
+            image1 = rearrange(x[:, :-1], 'b t c w h -> (b t) c w h')
+            image2 = rearrange(x[:, 1:], 'b t c w h -> (b t) c w h')
+            image1, image2 = self._get_padder(image1.shape).pad(image1, image2)
+            micro_batch = self.cfg.MODEL.RAFT_MICRO_BATCH
+            if micro_batch <= 0:
+                micro_batch = image1.shape[0]
             flow_embs = []
-            for index in range(t-1): #loop over time
-                image1 = x[:,index,:]
-                image2 = x[:,index+1,:]
-                # print(image1.shape)
-                padder = InputPadder(image1.shape)
-                image1, image2 = padder.pad(image1, image2)
-                flow_low, flow_up = self.motion_model(image1, image2, iters=1, test_mode=True)
-                if(self.cfg.MODEL.VISUAL_MODEL == "sapiens"):
-                    flow_up = Resize(1024)(flow_up)
+            for i in range(0, image1.shape[0], micro_batch):
+                flow_low, flow_up = self.motion_model(image1[i:i + micro_batch], image2[i:i + micro_batch], iters=1, test_mode=True)
                 flow_embs.append(flow_up)
-            flow_embs = torch.stack(flow_embs)
+            flow_embs = torch.cat(flow_embs) if len(flow_embs) > 1 else flow_embs[0]
+            if(self.cfg.MODEL.VISUAL_MODEL == "sapiens"):
+                from torchvision.transforms import Resize
+                flow_embs = Resize(1024)(flow_embs)
 
-            ret = rearrange(flow_embs, 't b c w h -> b t c w h') #torch.stack(flow_embs)
+            ret = rearrange(flow_embs, '(b t) c w h -> b t c w h', b=b, t=t-1)
         return ret
+
+    def preprocess_motion(self, x):
+        '''
+            Denormalize (and resize for sapiens) every frame once for the motion model.
+            Same result as `denomalizing_img` per frame, as one fused op over the batch.
+            Inputs (b, c, t, w, h), outputs (b, t, c, w, h).
+        '''
+        b, c, t = x.shape[:3]
+        mean = x.new_tensor([0.45, 0.45, 0.45]).view(1, -1, 1, 1) * 225
+        std = x.new_tensor([0.225, 0.225, 0.225]).view(1, -1, 1, 1) * 225
+        x = torch.addcmul(mean, rearrange(x, 'b c t w h -> (b t) c w h'), std).float()
+        if(self.cfg.MODEL.VISUAL_MODEL == "sapiens"):
+            from torchvision.transforms import Resize
+            x = Resize(224)(x)
+        return rearrange(x, '(b t) c w h -> b t c w h', b=b, t=t)
+
+    def _get_padder(self, shape):
+        # The padding only depends on the spatial size of the frames.
+        key = tuple(shape[-2:])
+        if key not in self._padders:
+            from raft.utils.utils import InputPadder
+            self._padders[key] = InputPadder(shape)
+        return self._padders[key]
     
     def visual_forward(self, inputs):
         '''
@@ -663,38 +1035,73 @@ class MOOSE_Encoder(nn.Module):
         return features
         # print([features.shape])
 
-    def forward(self, inputs):
+    def forward(self, inputs, drop_last_frame=False, with_motion=True):
+        '''
+            Run both branches on one clip batch (b, c, t, w, h). With drop_last_frame the
+            visual backbone skips the last frame, which has no outgoing flow pair, so both
+            outputs have t-1 frames. Without with_motion, motion embeddings are None.
+        '''
+        if isinstance(inputs, (list,)):
+            inputs = inputs[0]
         with torch.no_grad():
-            visual_embeddings = self.visual_forward(inputs) # b x 1 x 197 x 768
-            motion_embeddings = self.motion_forward(inputs) # [b, t, 1, 2, 28, 28]
+            visual_inputs = inputs[:, :, :-1] if drop_last_frame else inputs
+            visual_embeddings = self.visual_forward(visual_inputs) # b x t x 197 x 768
+            motion_embeddings = self.motion_forward(inputs) if with_motion else None # [b, t-1, 2, w, h]
         return visual_embeddings, motion_embeddings
 
-import argparse
-parser = argparse.ArgumentParser()
-parser.add_argument('--model', help="restore checkpoint")
-parser.add_argument('--path', help="dataset for evaluation")
-parser.add_argument('--small', action='store_true', help='use small model')
-parser.add_argument('--mixed_precision', action='store_true', help='use mixed precision')
-parser.add_argument('--alternate_corr', action='store_true', help='use efficent correlation implementation')
+RAFT_CHECKPOINT = '/data2/hongn/RAFT/models/raft-things.pth'
+RAFT_DEMO_FRAMES = '/data2/hongn/RAFT/demo-frames/care'
+
+
+def get_raft_args(checkpoint_path=RAFT_CHECKPOINT):
+    """ RAFT options of the MOOSE motion model, built when the model is constructed rather than on import """
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', help="restore checkpoint")
+    parser.add_argument('--path', help="dataset for evaluation")
+    parser.add_argument('--small', action='store_true', help='use small model')
+    parser.add_argument('--mixed_precision', action='store_true', help='use mixed precision')
+    parser.add_argument('--alternate_corr', action='store_true', help='use efficent correlation implementation')
+
+    return parser.parse_args(['--model', checkpoint_path,
+                        '--path', RAFT_DEMO_FRAMES])
+
 
-raft_args = parser.parse_args(['--model', '/data2/hongn/RAFT/models/raft-things.pth', 
-                        '--path', '/data2/hongn/RAFT/demo-frames/care'])
-# from timesformer.models.moose import BidirectionalCrossAttention
-from mamba_ssm import Mamba
+def get_mamba_impl(impl):
+    """ Resolve MODEL.MAMBA_IMPL: `auto` is mamba_ssm when it is installed and a GPU is available, pytorch otherwise """
+    if(impl != 'auto'):
+        assert impl in ['mamba_ssm', 'pytorch'], f"No MAMBA_IMPL {impl} found!"
+        return impl
+    if(not torch.cuda.is_available()):
+        return 'pytorch'
+    import importlib.util
+    return 'mamba_ssm' if importlib.util.find_spec('mamba_ssm') is not None else 'pytorch'
 
 @MODEL_REGISTRY.register()
 class MOOSE(nn.Module):
-    def __init__(self, cfg, raft_args = raft_args, norm_layer=partial(nn.LayerNorm, eps=1e-6), mlp_ratio=1., act_layer=nn.GELU, drop=0., **kwargs):
+    def __init__(self, cfg, raft_args = None, norm_layer=partial(nn.LayerNorm, eps=1e-6), mlp_ratio=1., act_layer=nn.GELU, drop=0., **kwargs):
         super(MOOSE, self).__init__()
+        import vision_transformer as vits
+        from timesformer.models.moose import BidirectionalCrossAttention, CausalSelfAttention
+
         self.pretrained=False
         patch_size = 14 if(cfg.MODEL.VISUAL_MODEL == 'dinov2') else 16
         self.fusion_mode = cfg.MODEL.FUSION_MODE #"concat" # can be [concat, ofattention, biattention]
         self.st_masking = cfg.MODEL.ST_MASKING
         self.time_aggregation = cfg.MODEL.TIME_AGGREGATION
+        ## Steps kept in the key/value cache of forward_stream
+        self.causal_window = cfg.MODEL.CAUSAL_WINDOW or cfg.DATA.NUM_FRAMES - 1
+        self.use_feature_cache = cfg.MODEL.USE_FEATURE_CACHE
+        ## Recompute the fusion cross attention and MLP in backward instead of storing their activations
+        self.activation_checkpoint = cfg.MODEL.ACTIVATION_CHECKPOINT
         # self.model = MOOSE(raft_args, raft_args, num_classes=cfg.MODEL.NUM_CLASSES)
         # self.crossatt = CustomAttentionWithResidual(embed_size = 768)
-        with torch.no_grad():
-            self.moose_encoder = MOOSE_Encoder(raft_args, cfg)
+        ## The frozen encoder is not needed when its outputs are read from the feature cache
+        if self.use_feature_cache:
+            self.moose_encoder = None
+        else:
+            with torch.no_grad():
+                self.moose_encoder = MOOSE_Encoder(raft_args if raft_args is not None else get_raft_args(), cfg)
         # self.patch_embed = MotionPatchEmbed(img_size=224, patch_size=14, in_chans=2, embed_dim=768) # Flow patches embedding
         num_classes = cfg.MODEL.NUM_CLASSES
         visual_dim = 768 if(cfg.MODEL.VISUAL_MODEL == 'dinov2') else 1024
@@ -717,8 +1124,9 @@ class MOOSE(nn.Module):
         self.head = nn.Linear(fc_dim, num_classes) if num_classes > 0 else nn.Identity()
         # print("self.fusion_mode = onevisualmotion")
         
-        self.visual_mask = torch.ones((1, 257)).bool() if(cfg.MODEL.VISUAL_MODEL != 'sapiens') else torch.ones((1, 4097)).bool()
-        self.motion_mask = torch.ones((1, 257)).bool() if(cfg.MODEL.VISUAL_MODEL != 'sapiens') else torch.ones((1, 4097)).bool()
+        ## buffers follow the model to its device, broadcast over the batch by joint_cross_attn
+        self.register_buffer('visual_mask', torch.ones((1, 257)).bool() if(cfg.MODEL.VISUAL_MODEL != 'sapiens') else torch.ones((1, 4097)).bool(), persistent=False)
+        self.register_buffer('motion_mask', torch.ones((1, 257)).bool() if(cfg.MODEL.VISUAL_MODEL != 'sapiens') else torch.ones((1, 4097)).bool(), persistent=False)
 
         if(self.fusion_mode == "viattention"):
             self.joint_cross_attn = BidirectionalCrossAttention(
@@ -736,13 +1144,20 @@ class MOOSE(nn.Module):
             )
 
         if(self.time_aggregation == 'mamba'):
+            ## Both implementations have the same parameters, checkpoints load into either
+            if(get_mamba_impl(cfg.MODEL.MAMBA_IMPL) == 'mamba_ssm'):
+                from mamba_ssm import Mamba
+                mamba_kwargs = dict(device=torch.cuda.current_device())
+            else:
+                from timesformer.models.mamba import Mamba
+                mamba_kwargs = dict()
             self.mamba = Mamba(
                 # This module uses roughly 3 * expand * d_model^2 parameters
                 d_model=fc_dim, # Model dimension d_model
                 d_state=16,  # SSM state expansion factor
                 d_conv=4,    # Local convolution width
                 expand=2,    # Block expansion factor
-                device=torch.cuda.current_device()
+                **mamba_kwargs
             )
             for p in self.mamba.parameters():
                 p.requires_grad = True
@@ -750,16 +1165,27 @@ class MOOSE(nn.Module):
             self.causal = CausalSelfAttention(fc_dim, 3, 9*224)
 
 
-    def forward(self, x):
-        # assert False, "self.fusion_mode = onevisualmotion"
+    def _cross_attn(self, x, context, **kwargs):
+        return maybe_checkpoint(self.joint_cross_attn, self.training and self.activation_checkpoint > 0, x, context, **kwargs)
+
+    def _fusion_mlp(self, x):
+        return maybe_checkpoint(lambda v: self.mlp(self.norm2(v)), self.training and self.activation_checkpoint > 0, x)
+
+    def _fuse(self, x):
+        """ Visual-motion embeddings [b, t, p, d] of the frames (or cached features) in x, t = frames - 1 """
         with torch.no_grad():
-            visual_embeddings = self.moose_encoder.visual_forward(x)[:, :-1, :] # [b, t, p+1, d] Discard the last frame
+            if self.use_feature_cache:
+                ## x = [visual, (flow)] from FeatureCache, last frame already discarded
+                visual_embeddings = x[0].float()
+                flow_low = x[1].float() if len(x) > 1 else None
+            else:
+                ## The last frame is discarded before the visual backbone, not after
+                visual_embeddings, flow_low = self.moose_encoder(x, drop_last_frame=True, with_motion=self.fusion_mode != 'space_only') # [b, t, p+1, d]
             b = visual_embeddings.shape[0]
             t = visual_embeddings.shape[1]
             p = visual_embeddings.shape[2]
             visual_embeddings = rearrange(visual_embeddings, 'b t p d -> (b t) p d' ,b=b, t=t) 
             if(self.fusion_mode != 'space_only'):
-                flow_low = self.moose_encoder.motion_forward(x) # [b, t, c, w, h]
                 # visual_embeddings, flow_low = x[0], x[1]
                 # print(visual_embeddings.shape, flow_low.shape)
                 # assert False
@@ -777,38 +1203,38 @@ class MOOSE(nn.Module):
         if(self.fusion_mode == "ofattention"):
             # video_embeddings = self.crossatt(visual_embeddings, motion_embeddings)
             # video_embeddings = self.mlp(self.norm2(video_embeddings))
-            visual_embeddings, motion_embeddings = self.joint_cross_attn(
+            visual_embeddings, motion_embeddings = self._cross_attn(
                                     visual_embeddings,
                                     motion_embeddings,
-                                    mask = self.visual_mask.cuda(),
-                                    context_mask = self.motion_mask.cuda(),
+                                    mask = self.visual_mask,
+                                    context_mask = self.motion_mask,
                                     matrix_mask = self.st_masking
                                 )
-            video_embeddings = self.mlp(self.norm2(visual_embeddings))
+            video_embeddings = self._fusion_mlp(visual_embeddings)
         elif(self.fusion_mode == "viattention"):
-            motion_embeddings, visual_embeddings = self.joint_cross_attn(
+            motion_embeddings, visual_embeddings = self._cross_attn(
                                     motion_embeddings,
                                     visual_embeddings,
-                                    mask = self.visual_mask.cuda(),
-                                    context_mask = self.motion_mask.cuda(),
+                                    mask = self.visual_mask,
+                                    context_mask = self.motion_mask,
                                     matrix_mask = self.st_masking
                                 )
-            video_embeddings = self.mlp(self.norm2(motion_embeddings))
+            video_embeddings = self._fusion_mlp(motion_embeddings)
         elif(self.fusion_mode == "biconcat"):
-            visual_embeddings, motion_embeddings = self.joint_cross_attn(
+            visual_embeddings, motion_embeddings = self._cross_attn(
                                     visual_embeddings,
                                     motion_embeddings,
-                                    mask = self.visual_mask.cuda(),
-                                    context_mask = self.motion_mask.cuda(),
+                                    mask = self.visual_mask,
+                                    context_mask = self.motion_mask,
                                     matrix_mask = self.st_masking
                                 )
             video_embeddings = torch.concat((visual_embeddings, motion_embeddings),dim=2)
-            video_embeddings = self.mlp(self.norm2(video_embeddings))
+            video_embeddings = self._fusion_mlp(video_embeddings)
             # print(video_embeddings.shape, visual_embeddings.shape, motion_embeddings.shape)
             # assert False
         elif(self.fusion_mode == "concat"):
             video_embeddings = torch.concat((visual_embeddings, motion_embeddings),dim=2)
-            video_embeddings = self.mlp(self.norm2(video_embeddings))
+            video_embeddings = self._fusion_mlp(video_embeddings)
         elif(self.fusion_mode == "space_only"):
             video_embeddings = visual_embeddings
         elif(self.fusion_mode == "ofseq"):
@@ -817,17 +1243,21 @@ class MOOSE(nn.Module):
             visual_temp = visual_embeddings[:,0,:]
             motion_temp = motion_embeddings[:,0,:]
             for i in range(t): 
-                visual_temp, motion_temp = self.joint_cross_attn(
+                visual_temp, motion_temp = self._cross_attn(
                             visual_temp,
                             motion_temp,
-                            mask = self.visual_mask.cuda(),
-                            context_mask = self.motion_mask.cuda(),
+                            mask = self.visual_mask,
+                            context_mask = self.motion_mask,
                             matrix_mask = self.st_masking
                         )
         else:
             assert False, f"No fusion_mode {self.fusion_mode} found!"
 
-        video_embeddings = rearrange(video_embeddings, '(b t) p d -> b t p d' ,b=b, t=t) 
+        return rearrange(video_embeddings, '(b t) p d -> b t p d' ,b=b, t=t)
+
+    def forward(self, x):
+        # assert False, "self.fusion_mode = onevisualmotion"
+        video_embeddings = self._fuse(x)
         if(self.time_aggregation == 'mean'):
             video_embeddings = torch.mean(video_embeddings, dim=1)
             x = video_embeddings[:, 0, :] # Get the cls_token
@@ -838,12 +1268,9 @@ class MOOSE(nn.Module):
             # print(x.shape)
             # assert False, "get to MAMBA"
         elif(self.time_aggregation == 'causal'):
-            video_embeddings = rearrange(video_embeddings, 'b t p d -> (b p) t d' ,b=b, t=t)
-            res = self.causal(video_embeddings)
-            video_embeddings = video_embeddings + res
-            video_embeddings = rearrange(video_embeddings, '(b p) t d -> b t p d' ,b=b, t=t, p=p)
-            # print(video_embeddings.shape)
-            x = video_embeddings[:, -1, 0, :] # Get the cls_token
+            ## Every token attends only to its own past, and only the cls_token sequence reaches the head
+            cls_embeddings = video_embeddings[:, :, 0, :]
+            x = (cls_embeddings + self.causal(cls_embeddings))[:, -1] # Get the cls_token
             # print(x.shape)
             # assert False, "get to CAUSAL"
         else:
@@ -853,7 +1280,62 @@ class MOOSE(nn.Module):
 
         x = self.head(x)
         return x
-    
+
+    @torch.no_grad()
+    def forward_stream(self, x, cache=None):
+        """ Streaming inference with causal or mamba time aggregation. x holds only the new frames of a stream plus
+        the last frame of the previous call (the encoder drops the last frame, two frames make one step), or their
+        cached features. `cache` is the key/value cache (causal) or the convolution and SSM states (mamba, pytorch
+        implementation) returned by the previous call of the same stream, None for its first call. A causal step
+        attends to the last causal_window steps and a mamba step updates a fixed size state, so a call costs the same
+        however long the stream. Returns the logits of the newest step and the cache for the next call. """
+        assert self.time_aggregation in ['causal', 'mamba'], "forward_stream needs MODEL.TIME_AGGREGATION causal or mamba"
+        cls_embeddings = self._fuse(x)[:, :, 0, :]
+        if(self.time_aggregation == 'mamba'):
+            assert hasattr(self.mamba, 'forward_step'), "forward_stream needs MODEL.MAMBA_IMPL pytorch"
+            out, cache = self.mamba.forward_step(cls_embeddings, cache)
+            return self.head(out[:, -1]), cache
+        res, cache = self.causal.forward_step(cls_embeddings, cache, window=self.causal_window)
+        x = (cls_embeddings + res)[:, -1]
+        return self.head(x), cache
+
+
+SAPIENS_CONFIG = "/data2/hongn/sapiens/pretrain/configs/sapiens_mae/humans_300m_test/mae_sapiens_0.3b-p16_8xb512-coslr-1600e_humans_300m_test.py"
+# Sapiens layers used as frozen space embeddings by `time_only` blocks
+SAPIENS_OUT_INDICES = (0, 2, 4, 6, 8, 10, 12, 14, 16, 18, 20, 22, 24)
+
+
+def get_sapiens_space_embs(checkpoint_path):
+    """ Frozen Sapiens returning the embeddings of SAPIENS_OUT_INDICES, one [b, p+1, d] tensor per layer """
+    from mmpretrain import get_model
+
+    with torch.no_grad():
+        model = get_model(model=SAPIENS_CONFIG, pretrained=checkpoint_path, device='cpu', backbone=dict(out_indices=SAPIENS_OUT_INDICES))
+        model.requires_grad = False
+    return model
+
+
+def iter_sapiens_space_embs(space_embs, x):
+    """ Run the backbone of `space_embs` one layer at a time and yield each output of its out_indices as soon as
+    it is computed, so that only the current layer is alive. Mirrors VisionTransformer.forward of mmpretrain 1.2.0,
+    which space_embs(x) runs through MAE.extract_feat and MAEViT.forward(x, mask=None), so it gives the same outputs
+    in the same order; benchmark_time_only_memory asserts it. """
+    from mmpretrain.models.utils import resize_pos_embed
+
+    backbone = space_embs.backbone
+    B = x.shape[0]
+    x, patch_resolution = backbone.patch_embed(x)
+    if backbone.cls_token is not None:
+        x = torch.cat((backbone.cls_token.expand(B, -1, -1), x), dim=1)
+    x = x + resize_pos_embed(backbone.pos_embed, backbone.patch_resolution, patch_resolution, mode=backbone.interpolate_mode, num_extra_tokens=backbone.num_extra_tokens)
+    x = backbone.drop_after_pos(x)
+    x = backbone.pre_norm(x)
+    for i, layer in enumerate(backbone.layers):
+        x = layer(x)
+        if i == len(backbone.layers) - 1 and backbone.final_norm:
+            x = backbone.ln1(x)
+        if i in backbone.out_indices:
+            yield backbone._format_output(x, patch_resolution)
 
 
 def get_sapiens():
@@ -885,6 +1367,8 @@ def extract_optical_flow_sparse_to_dense_video(video_batch):
     Returns:
         torch.Tensor: Optical flow tensor of shape (B, T-1, 2, H, W)
     """
+    import cv2
+
     if video_batch.ndim != 5 or video_batch.shape[2] != 3:
         raise ValueError(f"Expected input shape (B, T, 3, H, W), but got {video_batch.shape}")
     
@@ -923,3 +1407,96 @@ def extract_optical_flow_sparse_to_dense_video(video_batch):
         flow_results.append(torch.stack(flows))  # (T-1, 2, H, W)
 
     return torch.stack(flow_results)  # (B, T-1, 2, H, W)
+
+
+class OpticalFlowEngine(object):
+    """
+    Parallel version of `extract_optical_flow_sparse_to_dense_video`. The batch
+    is converted to uint8 HWC frames in one op and copied to the host once,
+    every frame is converted to grayscale once, and all (b, t) frame pairs are
+    solved on a thread pool (OpenCV releases the GIL). Frames are scaled by
+    255 under the reference's rule, float32 or max() <= 1.0, decided for each
+    frame. The reference applies the rule of the first frame of a pair to
+    both, so the flows differ only for pairs whose frames get different rules,
+    e.g. a uint8 frame with max() <= 1.0 next to a regular one. Frames of
+    other dtypes above 1.0, e.g. float16 in [0, 255], which the reference
+    cannot convert, are cast to uint8.
+    Calls may run
+    concurrently, e.g. from loader or decoder threads: grayscale frames are
+    allocated per call, only the per-thread flow scratch, consumed within a
+    task, is reused across calls with the same shape.
+    """
+
+    def __init__(self, num_threads=0):
+        """
+        Args:
+            num_threads (int): number of worker threads, 0 for os.cpu_count().
+        """
+        self.num_threads = num_threads if num_threads > 0 else os.cpu_count()
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._scratch = threading.local()
+
+    def _get_pool(self):
+        # Created lazily, so the engine can be built before loader workers fork.
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(self.num_threads)
+        return self._pool
+
+    def _get_scratch(self, H, W):
+        flow = getattr(self._scratch, "flow", None)
+        if flow is None or flow.shape != (H, W, 2):
+            flow = np.empty((H, W, 2), dtype=np.float32)
+            self._scratch.flow = flow
+        return flow
+
+    def __call__(self, video_batch):
+        """
+        Args:
+            video_batch (torch.Tensor): Tensor of shape (B, T, 3, H, W)
+
+        Returns:
+            torch.Tensor: Optical flow tensor of shape (B, T-1, 2, H, W), on
+                the CPU like `extract_optical_flow_sparse_to_dense_video`.
+        """
+        import cv2
+
+        if video_batch.ndim != 5 or video_batch.shape[2] != 3:
+            raise ValueError(f"Expected input shape (B, T, 3, H, W), but got {video_batch.shape}")
+        B, T, C, H, W = video_batch.shape
+
+        # uint8 conversion of the reference with its rule per frame, for the whole batch at once.
+        scale = video_batch.flatten(2).amax(dim=-1) <= 1.0
+        if video_batch.dtype == torch.float32:
+            scale = torch.ones_like(scale)
+        video_batch = torch.where(
+            scale[:, :, None, None, None], (video_batch * 255).clamp(0, 255), video_batch
+        )
+        frames = (
+            video_batch.to(torch.uint8).permute(0, 1, 3, 4, 2).contiguous().cpu().numpy()
+        )
+        gray = np.empty((B, T, H, W), dtype=np.uint8)
+        out = torch.empty((B, T - 1, 2, H, W), dtype=torch.float32)
+        out_np = out.numpy()
+
+        def _to_gray(i):
+            b, t = divmod(i, T)
+            cv2.cvtColor(frames[b, t], cv2.COLOR_RGB2GRAY, dst=gray[b, t])
+
+        def _flow(i):
+            b, t = divmod(i, T - 1)
+            flow = self._get_scratch(H, W)
+            try:
+                flow = cv2.optflow.calcOpticalFlowSparseToDense(
+                    gray[b, t], gray[b, t + 1], flow=flow
+                )
+                out_np[b, t] = flow.transpose(2, 0, 1)
+            except cv2.error:
+                out_np[b, t] = 0
+
+        pool = self._get_pool()
+        # list() waits for the tasks and re-raises their exceptions.
+        list(pool.map(_to_gray, range(B * T)))
+        list(pool.map(_flow, range(B * (T - 1))))
+        return out
@@ -4,11 +4,16 @@ Functions for benchmarks.
 """
 
 import numpy as np
+import os
 import pprint
+import subprocess
+import sys
+import time
 import torch
 import tqdm
 from fvcore.common.timer import Timer
 
+import timesformer
 import timesformer.utils.logging as logging
 import timesformer.utils.misc as misc
 from timesformer.datasets import loader
@@ -101,3 +106,1125 @@ def benchmark_data_loading(cfg):
             np.std(epoch_times),
         )
     )
+
+
+def _sync(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def _latency_ms(fn, device, num_iters):
+    """
+    Average wall time of `fn()` in milliseconds after one warm-up call.
+    """
+    fn()
+    _sync(device)
+    timer = Timer()
+    for _ in range(num_iters):
+        fn()
+    _sync(device)
+    return timer.seconds() * 1000.0 / num_iters
+
+
+def _peak_memory_mb(fn, device):
+    """
+    Peak memory allocated while running `fn()`, in MB. Exact on GPU; on CPU it
+    is approximated by replaying the profiler's per-op allocations in order.
+    """
+    if device.type == "cuda":
+        _sync(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        base = torch.cuda.memory_allocated(device)
+        fn()
+        _sync(device)
+        return (torch.cuda.max_memory_allocated(device) - base) / 1024 ** 2
+    with torch.autograd.profiler.profile(profile_memory=True) as prof:
+        fn()
+    cur, peak = 0, 0
+    for evt in sorted(prof.function_events, key=lambda e: e.time_range.start):
+        cur += evt.self_cpu_memory_usage
+        peak = max(peak, cur)
+    return peak / 1024 ** 2
+
+
+def _benchmark_device(cfg):
+    return torch.device("cuda") if cfg.NUM_GPUS > 0 else torch.device("cpu")
+
+
+@torch.no_grad()
+def benchmark_attention_backends(cfg):
+    """
+    Compare latency, peak memory and numerical error of the `naive`, `sdpa`
+    and `chunked` backends of vit.Attention for every sequence length in
+    BENCHMARK.ATTN_SEQ_LENS. Fails if a backend differs from `naive` by more
+    than 1e-4.
+    Args:
+        cfg (CfgNode): configs. Details can be found in
+            lib/config/defaults.py
+    """
+    from timesformer.models.vit import ATTN_BACKENDS, Attention
+
+    setup_environment()
+    torch.manual_seed(cfg.RNG_SEED)
+    logging.setup_logging(cfg.OUTPUT_DIR)
+    device = _benchmark_device(cfg)
+
+    attn = Attention(
+        768, num_heads=12, qkv_bias=True, chunk_size=cfg.MODEL.ATTN_CHUNK_SIZE
+    ).to(device).eval()
+    for seq_len in cfg.BENCHMARK.ATTN_SEQ_LENS:
+        x = torch.randn(1, seq_len, 768, device=device)
+        attn.backend = "naive"
+        ref = attn(x)
+        for backend in ATTN_BACKENDS:
+            attn.backend = backend
+            max_err = (attn(x) - ref).abs().max().item()
+            latency = _latency_ms(
+                lambda: attn(x), device, cfg.BENCHMARK.NUM_ITERS
+            )
+            peak_mem = _peak_memory_mb(lambda: attn(x), device)
+            logger.info(
+                "Attention N={} backend={}: {:.2f} ms, peak {:.1f} MB, "
+                "max abs err vs naive {:.2e}.".format(
+                    seq_len, backend, latency, peak_mem, max_err
+                )
+            )
+            assert max_err < 1e-4, "Attention backend {} differs from naive".format(
+                backend
+            )
+
+
+def benchmark_normalize_on_device(cfg):
+    """
+    Compare the loader throughput of float32 clips normalized by the loader
+    with uint8 clips normalized on the device (DATA.NORMALIZE_ON_DEVICE). Each
+    run times BENCHMARK.NUM_ITERS train batches including the host to device
+    copy and the normalization.
+    Args:
+        cfg (CfgNode): configs. Details can be found in
+            lib/config/defaults.py
+    """
+    from timesformer.datasets.utils import normalize_on_device
+
+    setup_environment()
+    np.random.seed(cfg.RNG_SEED)
+    torch.manual_seed(cfg.RNG_SEED)
+    logging.setup_logging(cfg.OUTPUT_DIR)
+    device = _benchmark_device(cfg)
+
+    for on_device in [False, True]:
+        run_cfg = cfg.clone()
+        run_cfg.DATA.NORMALIZE_ON_DEVICE = on_device
+        dataloader = loader.construct_loader(run_cfg, "train")
+        num_iters = min(cfg.BENCHMARK.NUM_ITERS, len(dataloader) - 1)
+        num_clips, num_bytes = 0, 0
+        timer = Timer()
+        for cur_iter, (inputs, *_) in enumerate(dataloader):
+            if cur_iter == 0:
+                # Exclude worker start-up from the measurement.
+                _sync(device)
+                timer.reset()
+                continue
+            if cur_iter > num_iters:
+                break
+            pathways = inputs if isinstance(inputs, (list,)) else [inputs]
+            num_clips += pathways[0].size(0)
+            num_bytes += sum(x.numel() * x.element_size() for x in pathways)
+            inputs = [x.to(device, non_blocking=True) for x in pathways]
+            if on_device:
+                inputs = normalize_on_device(
+                    inputs, cfg.DATA.MEAN, cfg.DATA.STD
+                )
+        _sync(device)
+        seconds = timer.seconds()
+        logger.info(
+            "NORMALIZE_ON_DEVICE={}: {:.1f} clips/s, {:.1f} MB per clip "
+            "from the loader.".format(
+                on_device,
+                num_clips / seconds,
+                num_bytes / max(num_clips, 1) / 1024 ** 2,
+            )
+        )
+
+
+@torch.no_grad()
+def benchmark_optical_flow(cfg):
+    """
+    Compare the frame-pair throughput of the serial
+    `extract_optical_flow_sparse_to_dense_video` with the threaded
+    OpticalFlowEngine (MODEL.FLOW_NUM_THREADS), on a synthetic batch of
+    TRAIN.BATCH_SIZE clips of DATA.NUM_FRAMES frames of DATA.TRAIN_CROP_SIZE.
+    The max absolute difference of their flows must stay below 1e-4.
+    Args:
+        cfg (CfgNode): configs. Details can be found in
+            lib/config/defaults.py
+    """
+    from timesformer.models.vit import (
+        OpticalFlowEngine,
+        extract_optical_flow_sparse_to_dense_video,
+    )
+
+    setup_environment()
+    torch.manual_seed(cfg.RNG_SEED)
+    logging.setup_logging(cfg.OUTPUT_DIR)
+    device = _benchmark_device(cfg)
+
+    B, T = cfg.TRAIN.BATCH_SIZE, cfg.DATA.NUM_FRAMES
+    size = cfg.DATA.TRAIN_CROP_SIZE
+    # A smooth random image shifted by one pixel per frame gives real motion.
+    base = torch.rand(B, 3, size // 8, size // 8 + T, device=device)
+    base = torch.nn.functional.interpolate(
+        base, size=(size, size + 8 * T), mode="bilinear", align_corners=False
+    )
+    video = torch.stack([base[..., t:t + size] for t in range(T)], dim=1)
+
+    engine = OpticalFlowEngine(cfg.MODEL.FLOW_NUM_THREADS)
+    max_err = (
+        engine(video) - extract_optical_flow_sparse_to_dense_video(video)
+    ).abs().max().item()
+    num_pairs = B * (T - 1)
+    for name, fn in [
+        ("serial", lambda: extract_optical_flow_sparse_to_dense_video(video)),
+        ("threaded x{}".format(engine.num_threads), lambda: engine(video)),
+    ]:
+        latency = _latency_ms(fn, device, cfg.BENCHMARK.NUM_ITERS)
+        logger.info(
+            "Optical flow {}: {:.1f} ms per batch, {:.1f} pairs/s.".format(
+                name, latency, num_pairs * 1000.0 / latency
+            )
+        )
+    logger.info("Max abs flow difference: {:.2e}.".format(max_err))
+    assert max_err < 1e-4, "OpticalFlowEngine differs from the reference"
+
+
+@torch.no_grad()
+def benchmark_moose_encoder(cfg):
+    """
+    Per-stage timing of the frozen MOOSE encoder on a random batch of
+    TEST.BATCH_SIZE clips, comparing the previous path (per-frame
+    `denomalizing_img`, visual backbone on all T frames) with the shared
+    preprocessing of MOOSE_Encoder.forward(drop_last_frame=True).
+    Args:
+        cfg (CfgNode): configs. Details can be found in
+            lib/config/defaults.py
+    """
+    from einops import rearrange
+    from timesformer.models.moose import denomalizing_img
+    from timesformer.models.vit import MOOSE_Encoder, get_raft_args
+
+    setup_environment()
+    torch.manual_seed(cfg.RNG_SEED)
+    logging.setup_logging(cfg.OUTPUT_DIR)
+    device = _benchmark_device(cfg)
+
+    encoder = MOOSE_Encoder(get_raft_args(), cfg).to(device).eval()
+    size = cfg.DATA.TEST_CROP_SIZE
+    inputs = torch.randn(
+        cfg.TEST.BATCH_SIZE, 3, cfg.DATA.NUM_FRAMES, size, size, device=device
+    )
+    with_motion = cfg.MODEL.FUSION_MODE != "space_only"
+    stages = [
+        (
+            "denormalize, per frame",
+            lambda: denomalizing_img(
+                rearrange(inputs, "b c t w h -> (b t) c w h")
+            ),
+        ),
+        ("denormalize, fused", lambda: encoder.preprocess_motion(inputs)),
+        ("visual, T frames", lambda: encoder.visual_forward(inputs)),
+        (
+            "visual, T-1 frames",
+            lambda: encoder.visual_forward(inputs[:, :, :-1]),
+        ),
+        ("motion", lambda: encoder.motion_forward(inputs)),
+        (
+            "encoder, before",
+            lambda: (
+                encoder.visual_forward(inputs)[:, :-1],
+                encoder.motion_forward(inputs) if with_motion else None,
+            ),
+        ),
+        (
+            "encoder, shared",
+            lambda: encoder(
+                inputs, drop_last_frame=True, with_motion=with_motion
+            ),
+        ),
+    ]
+    for name, fn in stages:
+        latency = _latency_ms(fn, device, cfg.BENCHMARK.NUM_ITERS)
+        logger.info("MOOSE encoder {}: {:.2f} ms.".format(name, latency))
+
+
+def _update_stats_loop(meter, preds, labels, clip_ids):
+    """
+    Per-clip Python loop TestMeter.update_stats used before vectorization,
+    kept as the reference of `benchmark_test_meter`.
+    """
+    for ind in range(preds.shape[0]):
+        vid_id = int(clip_ids[ind]) // meter.num_clips
+        if meter.video_labels[vid_id].sum() > 0:
+            assert torch.equal(
+                meter.video_labels[vid_id].type(torch.FloatTensor),
+                labels[ind].type(torch.FloatTensor),
+            )
+        meter.video_labels[vid_id] = labels[ind]
+        if meter.ensemble_method == "sum":
+            meter.video_preds[vid_id] += preds[ind]
+        else:
+            meter.video_preds[vid_id] = torch.max(
+                meter.video_preds[vid_id], preds[ind]
+            )
+        meter.clip_count[vid_id] += 1
+
+
+def benchmark_test_meter(cfg):
+    """
+    Per-batch overhead of TestMeter.update_stats versus the per-clip loop it
+    replaces, for TEST.BATCH_SIZE clips of MODEL.NUM_CLASSES classes with
+    TEST.NUM_ENSEMBLE_VIEWS x TEST.NUM_SPATIAL_CROPS views per video. Both
+    ensemble methods must give identical meters.
+    Args:
+        cfg (CfgNode): configs. Details can be found in
+            lib/config/defaults.py
+    """
+    from timesformer.utils.meters import TestMeter
+
+    setup_environment()
+    torch.manual_seed(cfg.RNG_SEED)
+    logging.setup_logging(cfg.OUTPUT_DIR)
+
+    num_clips = cfg.TEST.NUM_ENSEMBLE_VIEWS * cfg.TEST.NUM_SPATIAL_CROPS
+    batch_size = cfg.TEST.BATCH_SIZE
+    num_batches = max(cfg.BENCHMARK.NUM_ITERS, 1)
+    num_videos = -(-num_batches * batch_size // num_clips)
+    num_cls = cfg.MODEL.NUM_CLASSES
+    clip_ids = torch.randperm(num_videos * num_clips)[
+        : num_batches * batch_size
+    ]
+    video_labels = torch.randint(1, num_cls, (num_videos,))
+    batches = [
+        (
+            torch.randn(len(ids), num_cls),
+            video_labels[ids // num_clips],
+            ids,
+        )
+        for ids in clip_ids.split(batch_size)
+    ]
+
+    for method in ["sum", "max"]:
+        results = []
+        for name, update in [
+            ("loop", _update_stats_loop),
+            ("vectorized", TestMeter.update_stats),
+        ]:
+            meter = TestMeter(
+                num_videos, num_clips, num_cls, num_batches,
+                ensemble_method=method,
+            )
+            timer = Timer()
+            for batch in batches:
+                update(meter, *batch)
+            logger.info(
+                "TestMeter.update_stats {} ({}): {:.3f} ms per batch of "
+                "{}.".format(
+                    name,
+                    method,
+                    timer.seconds() * 1000.0 / len(batches),
+                    batch_size,
+                )
+            )
+            results.append(meter)
+        loop, vectorized = results
+        identical = (
+            torch.equal(loop.video_preds, vectorized.video_preds)
+            and torch.equal(loop.video_labels, vectorized.video_labels)
+            and torch.equal(loop.clip_count, vectorized.clip_count)
+        )
+        logger.info("Identical results ({}): {}.".format(method, identical))
+        assert identical, "Vectorized update_stats differs ({})".format(method)
+
+
+def benchmark_time_only_memory(cfg):
+    """
+    Peak memory of a `time_only` model (TIMESFORMER.ATTENTION_TYPE) for every
+    batch size in BENCHMARK.BATCH_SIZES at DATA.NUM_FRAMES frames, with the
+    Sapiens space embeddings computed up front or interleaved with the blocks
+    (TIMESFORMER.INTERLEAVE_SPATIAL), for inference and a training step.
+    Fails if the interleaved Sapiens layers differ from the Sapiens forward.
+    Args:
+        cfg (CfgNode): configs. Details can be found in
+            lib/config/defaults.py
+    """
+    from timesformer.models import build_model
+    from timesformer.models.vit import iter_sapiens_space_embs
+
+    setup_environment()
+    torch.manual_seed(cfg.RNG_SEED)
+    logging.setup_logging(cfg.OUTPUT_DIR)
+    device = _benchmark_device(cfg)
+    assert cfg.TIMESFORMER.ATTENTION_TYPE == "time_only"
+
+    model = build_model(cfg)
+    vit = model.module.model if hasattr(model, "module") else model.model
+    size = cfg.DATA.TRAIN_CROP_SIZE
+
+    # interleave_spatial runs Sapiens one layer at a time, it must give the
+    # outputs of its forward
+    model.eval()
+    frames = torch.randn(2, 3, size, size, device=device)
+    with torch.no_grad():
+        expected = vit.pretrain_space_embs(frames)
+        layers = list(iter_sapiens_space_embs(vit.pretrain_space_embs, frames))
+    assert len(layers) == len(expected), "Interleaved Sapiens layers differ"
+    max_diff = max(
+        (layer - out).abs().max().item() for layer, out in zip(layers, expected)
+    )
+    logger.info(
+        "Interleaved Sapiens layers: max difference {:.2e} over {} "
+        "layers.".format(max_diff, len(layers))
+    )
+    assert max_diff < 1e-4, "Interleaved Sapiens layers differ"
+
+    def _inference(x):
+        with torch.no_grad():
+            model(x)
+
+    def _train_step(x):
+        model(x).sum().backward()
+        model.zero_grad(set_to_none=True)
+
+    for batch_size in cfg.BENCHMARK.BATCH_SIZES:
+        x = torch.randn(
+            batch_size, 3, cfg.DATA.NUM_FRAMES, size, size, device=device
+        )
+        for interleave in [False, True]:
+            vit.interleave_spatial = interleave
+            model.eval()
+            inference_mem = _peak_memory_mb(lambda: _inference(x), device)
+            model.train()
+            train_mem = _peak_memory_mb(lambda: _train_step(x), device)
+            logger.info(
+                "time_only B={} T={} interleave={}: peak {:.1f} MB "
+                "inference, {:.1f} MB train step.".format(
+                    batch_size,
+                    cfg.DATA.NUM_FRAMES,
+                    interleave,
+                    inference_mem,
+                    train_mem,
+                )
+            )
+
+
+def _import_times(module):
+    """
+    Import `module` in a fresh interpreter with `python -X importtime`.
+    Returns:
+        wall (float): wall time of the interpreter in seconds.
+        times (list): tuples of `(cumulative us, self us, imported module)`,
+            one per imported module.
+    """
+    root = os.path.dirname(os.path.dirname(timesformer.__file__))
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [root] + ([env["PYTHONPATH"]] if env.get("PYTHONPATH") else [])
+    )
+    start = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import " + module],
+        cwd=root,
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    wall = time.perf_counter() - start
+    if proc.returncode != 0:
+        logger.warning(
+            "Importing {} failed: {}".format(
+                module, proc.stderr.strip().splitlines()[-1:]
+            )
+        )
+    times = []
+    for line in proc.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        times.append((int(cumulative_us), int(self_us), name.strip()))
+    return wall, times
+
+
+def benchmark_startup(cfg):
+    """
+    Cold import time of every module in BENCHMARK.STARTUP_MODULES, each in a
+    fresh interpreter, with the BENCHMARK.STARTUP_TOP_K imports taking the
+    most time on their own (`python -X importtime` self time).
+    Args:
+        cfg (CfgNode): configs. Details can be found in
+            lib/config/defaults.py
+    """
+    logging.setup_logging(cfg.OUTPUT_DIR)
+    for module in cfg.BENCHMARK.STARTUP_MODULES:
+        wall, times = _import_times(module)
+        total = next((t[0] for t in times if t[2] == module), 0)
+        logger.info(
+            "Startup {}: {:.1f} ms import, {:.1f} ms interpreter wall time, "
+            "{} modules.".format(
+                module, total / 1000.0, wall * 1000.0, len(times)
+            )
+        )
+        slowest = sorted(times, key=lambda t: t[1], reverse=True)
+        for cumulative_us, self_us, name in slowest[
+            : cfg.BENCHMARK.STARTUP_TOP_K
+        ]:
+            logger.info(
+                "    {:<40} self {:8.1f} ms, cumulative {:8.1f} ms".format(
+                    name, self_us / 1000.0, cumulative_us / 1000.0
+                )
+            )
+
+
+@torch.no_grad()
+def benchmark_token_merging(cfg):
+    """
+    Throughput and clip top-1 accuracy of a `divided_space_time` model with
+    token merging for every r in BENCHMARK.TOME_RS. Throughput is measured on
+    random TEST.BATCH_SIZE batches, accuracy on the first
+    BENCHMARK.NUM_EVAL_BATCHES batches of the test split with the weights of
+    TEST.CHECKPOINT_FILE_PATH (or the last checkpoint in OUTPUT_DIR).
+    Args:
+        cfg (CfgNode): configs. Details can be found in
+            lib/config/defaults.py
+    """
+    import timesformer.datasets.utils as data_utils
+    import timesformer.utils.checkpoint as cu
+    import timesformer.utils.metrics as metrics
+    from timesformer.models import build_model
+
+    setup_environment()
+    torch.manual_seed(cfg.RNG_SEED)
+    logging.setup_logging(cfg.OUTPUT_DIR)
+    device = _benchmark_device(cfg)
+    assert cfg.TIMESFORMER.ATTENTION_TYPE == "divided_space_time"
+
+    model = build_model(cfg)
+    cu.load_test_checkpoint(cfg, model)
+    model.eval()
+    vit = model.module.model if hasattr(model, "module") else model.model
+    test_loader = loader.construct_loader(cfg, "test")
+    size = cfg.DATA.TEST_CROP_SIZE
+    x = torch.randn(
+        cfg.TEST.BATCH_SIZE, 3, cfg.DATA.NUM_FRAMES, size, size, device=device
+    )
+
+    for r in cfg.BENCHMARK.TOME_RS:
+        vit.set_tome_r(r)
+        latency = _latency_ms(lambda: model(x), device, cfg.BENCHMARK.NUM_ITERS)
+        num_correct, num_clips = 0, 0
+        for cur_iter, (inputs, labels, _, _) in enumerate(test_loader):
+            if 0 < cfg.BENCHMARK.NUM_EVAL_BATCHES <= cur_iter:
+                break
+            if isinstance(inputs, (list,)):
+                inputs = [i.to(device, non_blocking=True) for i in inputs]
+            else:
+                inputs = inputs.to(device, non_blocking=True)
+            if cfg.DATA.NORMALIZE_ON_DEVICE:
+                inputs = data_utils.normalize_on_device(
+                    inputs, cfg.DATA.MEAN, cfg.DATA.STD
+                )
+            preds = model(inputs)
+            num_correct += metrics.topks_correct(
+                preds, labels.to(device), (1,)
+            )[0].item()
+            num_clips += labels.size(0)
+        logger.info(
+            "Token merging r={}: {:.2f} ms per batch, {:.1f} clips/s, "
+            "clip top-1 {:.2f}% on {} clips.".format(
+                r,
+                latency,
+                cfg.TEST.BATCH_SIZE * 1000.0 / latency,
+                100.0 * num_correct / max(num_clips, 1),
+                num_clips,
+            )
+        )
+
+
+def benchmark_mixed_precision(cfg):
+    """
+    Latency and peak memory of inference and of a training step (forward,
+    cross entropy, backward) on a random TRAIN.BATCH_SIZE batch in fp32 and
+    with bfloat16 autocast, plus float16 autocast on GPU. On CPU this
+    compares CPU bf16 with fp32.
+    Args:
+        cfg (CfgNode): configs. Details can be found in
+            lib/config/defaults.py
+    """
+    from timesformer.models import build_model
+
+    setup_environment()
+    torch.manual_seed(cfg.RNG_SEED)
+    logging.setup_logging(cfg.OUTPUT_DIR)
+    device = _benchmark_device(cfg)
+
+    model = build_model(cfg)
+    size = cfg.DATA.TRAIN_CROP_SIZE
+    x = torch.randn(
+        cfg.TRAIN.BATCH_SIZE, 3, cfg.DATA.NUM_FRAMES, size, size, device=device
+    )
+    labels = torch.randint(
+        cfg.MODEL.NUM_CLASSES, (cfg.TRAIN.BATCH_SIZE,), device=device
+    )
+    dtypes = [None, "bfloat16"] + (["float16"] if device.type == "cuda" else [])
+
+    for dtype in dtypes:
+
+        def _autocast():
+            return torch.autocast(
+                device.type,
+                dtype=getattr(torch, dtype or "bfloat16"),
+                enabled=dtype is not None,
+            )
+
+        def _inference():
+            with torch.no_grad(), _autocast():
+                model(x)
+
+        def _train_step():
+            with _autocast():
+                loss = torch.nn.functional.cross_entropy(
+                    model(x).float(), labels
+                )
+            loss.backward()
+            model.zero_grad(set_to_none=True)
+
+        model.eval()
+        inference_ms = _latency_ms(_inference, device, cfg.BENCHMARK.NUM_ITERS)
+        inference_mem = _peak_memory_mb(_inference, device)
+        model.train()
+        train_ms = _latency_ms(_train_step, device, cfg.BENCHMARK.NUM_ITERS)
+        train_mem = _peak_memory_mb(_train_step, device)
+        logger.info(
+            "Mixed precision {} on {}: inference {:.1f} ms, peak {:.1f} MB; "
+            "train step {:.1f} ms, peak {:.1f} MB.".format(
+                dtype or "float32",
+                device.type,
+                inference_ms,
+                inference_mem,
+                train_ms,
+                train_mem,
+            )
+        )
+
+
+def benchmark_activation_checkpoint(cfg):
+    """
+    Peak memory and latency of a training step (forward, cross entropy,
+    backward) on a random TRAIN.BATCH_SIZE batch for every value of
+    MODEL.ACTIVATION_CHECKPOINT in BENCHMARK.ACTIVATION_CHECKPOINTS.
+    Args:
+        cfg (CfgNode): configs. Details can be found in
+            lib/config/defaults.py
+    """
+    from timesformer.models import build_model
+
+    setup_environment()
+    torch.manual_seed(cfg.RNG_SEED)
+    logging.setup_logging(cfg.OUTPUT_DIR)
+    device = _benchmark_device(cfg)
+
+    model = build_model(cfg)
+    model.train()
+    size = cfg.DATA.TRAIN_CROP_SIZE
+    x = torch.randn(
+        cfg.TRAIN.BATCH_SIZE, 3, cfg.DATA.NUM_FRAMES, size, size, device=device
+    )
+    labels = torch.randint(
+        cfg.MODEL.NUM_CLASSES, (cfg.TRAIN.BATCH_SIZE,), device=device
+    )
+
+    def _train_step():
+        loss = torch.nn.functional.cross_entropy(model(x), labels)
+        loss.backward()
+        model.zero_grad(set_to_none=True)
+
+    for every in cfg.BENCHMARK.ACTIVATION_CHECKPOINTS:
+        for module in model.modules():
+            if hasattr(module, "activation_checkpoint"):
+                module.activation_checkpoint = every
+        latency = _latency_ms(_train_step, device, cfg.BENCHMARK.NUM_ITERS)
+        peak_mem = _peak_memory_mb(_train_step, device)
+        logger.info(
+            "MODEL.ACTIVATION_CHECKPOINT={}: train step {:.1f} ms, "
+            "peak {:.1f} MB.".format(every, latency, peak_mem)
+        )
+
+
+@torch.no_grad()
+def benchmark_compile(cfg):
+    """
+    TEST.COMPILE on a random TEST.BATCH_SIZE batch for every backend in
+    BENCHMARK.COMPILE_BACKENDS: the first call with an empty cache directory
+    (cold), the first call of a new CompiledModel reusing that directory
+    (warm, in the same process) and the steady-state latency against the
+    eager model.
+    Args:
+        cfg (CfgNode): configs. Details can be found in
+            lib/config/defaults.py
+    """
+    import tempfile
+    from timesformer.models import build_model
+    from timesformer.utils.compilation import CompiledModel
+
+    setup_environment()
+    torch.manual_seed(cfg.RNG_SEED)
+    logging.setup_logging(cfg.OUTPUT_DIR)
+    device = _benchmark_device(cfg)
+
+    model = build_model(cfg)
+    model.eval()
+    size = cfg.DATA.TEST_CROP_SIZE
+    x = torch.randn(
+        cfg.TEST.BATCH_SIZE, 3, cfg.DATA.NUM_FRAMES, size, size, device=device
+    )
+    eager_ms = _latency_ms(lambda: model(x), device, cfg.BENCHMARK.NUM_ITERS)
+    logger.info("Eager: {:.1f} ms per batch.".format(eager_ms))
+
+    for backend in cfg.BENCHMARK.COMPILE_BACKENDS:
+        compile_cfg = cfg.clone()
+        compile_cfg.TEST.COMPILE_BACKEND = backend
+        compile_cfg.TEST.COMPILE_CACHE_DIR = tempfile.mkdtemp()
+        startup_ms = []
+        for _ in ("cold", "warm"):
+            if backend == "inductor":
+                torch._dynamo.reset()
+            compiled = CompiledModel(model, compile_cfg)
+            timer = Timer()
+            compiled(x)
+            _sync(device)
+            startup_ms.append(timer.seconds() * 1000.0)
+        compiled_ms = _latency_ms(
+            lambda: compiled(x), device, cfg.BENCHMARK.NUM_ITERS
+        )
+        logger.info(
+            "TEST.COMPILE_BACKEND={}: cold start {:.0f} ms, warm start {:.0f} "
+            "ms, {:.1f} ms per batch ({:.2f}x eager).".format(
+                backend,
+                startup_ms[0],
+                startup_ms[1],
+                compiled_ms,
+                eager_ms / compiled_ms,
+            )
+        )
+
+
+@torch.no_grad()
+def benchmark_cross_attention(cfg):
+    """
+    Latency and peak memory of the MOOSE BidirectionalCrossAttention with the
+    MODEL.ST_MASKING mask for every token count in
+    BENCHMARK.CROSS_ATTN_TOKENS, with fused attention kernels for both
+    directions and with the explicit similarity matrix, plus the one-off cost
+    of building the cached mask. The max absolute difference of the outputs
+    of the two paths must stay below 1e-4. The block-sparse arrow path is
+    turned off so both run on the dense mask, see benchmark_arrow_attention.
+    Args:
+        cfg (CfgNode): configs. Details can be found in
+            lib/config/defaults.py
+    """
+    from timesformer.models.moose import BidirectionalCrossAttention
+
+    setup_environment()
+    torch.manual_seed(cfg.RNG_SEED)
+    logging.setup_logging(cfg.OUTPUT_DIR)
+    device = _benchmark_device(cfg)
+    batch_size = cfg.BENCHMARK.CROSS_ATTN_BATCH_SIZE
+
+    for num_tokens in cfg.BENCHMARK.CROSS_ATTN_TOKENS:
+        attn = BidirectionalCrossAttention(
+            dim=cfg.BENCHMARK.CROSS_ATTN_DIM,
+            heads=8,
+            dim_head=64,
+            block_sparse=False,
+        ).to(device)
+        attn.eval()
+        x = torch.randn(
+            batch_size, num_tokens, cfg.BENCHMARK.CROSS_ATTN_DIM, device=device
+        )
+        context = torch.randn_like(x)
+        mask = torch.ones((1, num_tokens), dtype=torch.bool, device=device)
+
+        timer = Timer()
+        attn._matrix_mask(cfg.MODEL.ST_MASKING, num_tokens, num_tokens, device)
+        _sync(device)
+        mask_ms = timer.seconds() * 1000.0
+
+        def _forward():
+            return attn(
+                x,
+                context,
+                mask=mask,
+                context_mask=mask,
+                matrix_mask=cfg.MODEL.ST_MASKING,
+            )
+
+        outputs = {}
+        for fused in [True, False]:
+            attn.fused = fused
+            outputs[fused] = _forward()
+            latency = _latency_ms(_forward, device, cfg.BENCHMARK.NUM_ITERS)
+            peak_mem = _peak_memory_mb(_forward, device)
+            logger.info(
+                "Cross attention {} tokens, {}: {:.1f} ms, peak {:.1f} MB "
+                "(mask built once in {:.1f} ms).".format(
+                    num_tokens,
+                    "fused" if fused else "explicit",
+                    latency,
+                    peak_mem,
+                    mask_ms,
+                )
+            )
+        max_diff = max(
+            (fused - explicit).abs().max().item()
+            for fused, explicit in zip(outputs[True], outputs[False])
+        )
+        logger.info(
+            "Cross attention {} tokens: max difference {:.2e}.".format(
+                num_tokens, max_diff
+            )
+        )
+        assert max_diff < 1e-4, "Fused cross attention differs"
+
+
+@torch.no_grad()
+def benchmark_arrow_attention(cfg):
+    """
+    Scaling of the MOOSE BidirectionalCrossAttention with the `arrow` mask
+    over BENCHMARK.ARROW_ATTN_TOKENS: latency and peak memory of the
+    block-sparse path (band plus CLS row and column) and of the dense masked
+    path, and the max absolute difference of their outputs, which must stay
+    below 1e-4.
+    Args:
+        cfg (CfgNode): configs. Details can be found in
+            lib/config/defaults.py
+    """
+    from timesformer.models.moose import BidirectionalCrossAttention
+
+    setup_environment()
+    torch.manual_seed(cfg.RNG_SEED)
+    logging.setup_logging(cfg.OUTPUT_DIR)
+    device = _benchmark_device(cfg)
+
+    attn = BidirectionalCrossAttention(
+        dim=cfg.BENCHMARK.CROSS_ATTN_DIM, heads=8, dim_head=64
+    ).to(device)
+    attn.eval()
+    for num_tokens in cfg.BENCHMARK.ARROW_ATTN_TOKENS:
+        x = torch.randn(
+            cfg.BENCHMARK.CROSS_ATTN_BATCH_SIZE,
+            num_tokens,
+            cfg.BENCHMARK.CROSS_ATTN_DIM,
+            device=device,
+        )
+        context = torch.randn_like(x)
+        mask = torch.ones((1, num_tokens), dtype=torch.bool, device=device)
+
+        def _forward():
+            return attn(
+                x, context, mask=mask, context_mask=mask, matrix_mask="arrow"
+            )
+
+        stats = {}
+        for block_sparse in [True, False]:
+            attn.block_sparse = block_sparse
+            stats[block_sparse] = (
+                _forward(),
+                _latency_ms(_forward, device, cfg.BENCHMARK.NUM_ITERS),
+                _peak_memory_mb(_forward, device),
+            )
+        max_diff = max(
+            (sparse - dense).abs().max().item()
+            for sparse, dense in zip(stats[True][0], stats[False][0])
+        )
+        logger.info(
+            "Arrow attention {} tokens: block-sparse {:.1f} ms, peak {:.1f} "
+            "MB; dense {:.1f} ms, peak {:.1f} MB; max difference {:.2e}.".format(
+                num_tokens,
+                stats[True][1],
+                stats[True][2],
+                stats[False][1],
+                stats[False][2],
+                max_diff,
+            )
+        )
+        assert max_diff < 1e-4, "Block-sparse arrow attention differs"
+
+
+@torch.no_grad()
+def benchmark_causal_stream(cfg):
+    """
+    Per-frame latency of the MOOSE causal time aggregation when a stream has
+    reached each length in BENCHMARK.STREAM_STEPS: recomputing the whole
+    sequence with CausalSelfAttention.forward, as MOOSE.forward does, against
+    one CausalSelfAttention.forward_step with a key/value cache of
+    MODEL.CAUSAL_WINDOW steps. Runs CROSS_ATTN_BATCH_SIZE streams of the
+    768-dimensional MOOSE fusion embeddings. Fails if forward_step, one frame
+    at a time, differs from forward without a window or from forward with the
+    causal mask cut to a band of the window steps.
+    Args:
+        cfg (CfgNode): configs. Details can be found in
+            lib/config/defaults.py
+    """
+    import copy
+    from timesformer.models.moose import CausalSelfAttention
+
+    setup_environment()
+    torch.manual_seed(cfg.RNG_SEED)
+    logging.setup_logging(cfg.OUTPUT_DIR)
+    device = _benchmark_device(cfg)
+    window = cfg.MODEL.CAUSAL_WINDOW or cfg.DATA.NUM_FRAMES - 1
+
+    causal = CausalSelfAttention(768, 3, max(cfg.BENCHMARK.STREAM_STEPS))
+    causal = causal.to(device).eval()
+
+    # the same attention with its causal mask cut to the last `window` steps
+    banded = copy.deepcopy(causal)
+    banded.mask = torch.tril(banded.mask) * torch.triu(banded.mask, 1 - window)
+    x = torch.randn(
+        cfg.BENCHMARK.CROSS_ATTN_BATCH_SIZE,
+        min(max(cfg.BENCHMARK.STREAM_STEPS), 2 * window + 1),
+        768,
+        device=device,
+    )
+    for step_window, reference in [(None, causal), (window, banded)]:
+        cache, outputs = None, []
+        for step in range(x.size(1)):
+            y, cache = causal.forward_step(
+                x[:, step : step + 1], cache, window=step_window
+            )
+            outputs.append(y)
+        max_diff = (
+            (torch.cat(outputs, dim=1) - reference(x)).abs().max().item()
+        )
+        logger.info(
+            "Causal steps against forward over {} steps (window {}): max "
+            "difference {:.2e}.".format(x.size(1), step_window, max_diff)
+        )
+        assert max_diff < 1e-4, "Causal forward_step differs from forward"
+
+    for num_steps in cfg.BENCHMARK.STREAM_STEPS:
+        x = torch.randn(
+            cfg.BENCHMARK.CROSS_ATTN_BATCH_SIZE, num_steps, 768, device=device
+        )
+        _, cache = causal.forward_step(x[:, :-1], window=window)
+        recompute_ms = _latency_ms(
+            lambda: causal(x), device, cfg.BENCHMARK.NUM_ITERS
+        )
+        step_ms = _latency_ms(
+            lambda: causal.forward_step(x[:, -1:], cache, window=window),
+            device,
+            cfg.BENCHMARK.NUM_ITERS,
+        )
+        logger.info(
+            "Causal aggregation at step {}: recompute {:.2f} ms, cached "
+            "step (window {}) {:.2f} ms per frame.".format(
+                num_steps, recompute_ms, window, step_ms
+            )
+        )
+
+
+@torch.no_grad()
+def benchmark_mamba(cfg):
+    """
+    CPU-friendly Mamba time aggregation of MODEL.MAMBA_IMPL pytorch at every
+    sequence length of BENCHMARK.MAMBA_SEQ_LENS: latency of the chunked
+    parallel scan against the sequential reference scan, and of one recurrent
+    forward_step per frame of a stream. Fails if the parallel scan or the
+    recurrent steps differ from the reference, or from mamba_ssm when it is
+    installed and the benchmark runs on GPU. Runs CROSS_ATTN_BATCH_SIZE sequences of the
+    768-dimensional MOOSE fusion embeddings.
+    Args:
+        cfg (CfgNode): configs. Details can be found in
+            lib/config/defaults.py
+    """
+    import importlib.util
+    from timesformer.models.mamba import Mamba
+
+    setup_environment()
+    torch.manual_seed(cfg.RNG_SEED)
+    logging.setup_logging(cfg.OUTPUT_DIR)
+    device = _benchmark_device(cfg)
+
+    mamba = Mamba(d_model=768, d_state=16, d_conv=4, expand=2).to(device).eval()
+    reference = None
+    if device.type == "cuda" and importlib.util.find_spec("mamba_ssm"):
+        from mamba_ssm import Mamba as MambaSSM
+
+        reference = MambaSSM(d_model=768, d_state=16, d_conv=4, expand=2)
+        reference.load_state_dict(mamba.state_dict())
+        reference = reference.to(device).eval()
+    for seq_len in cfg.BENCHMARK.MAMBA_SEQ_LENS:
+        x = torch.randn(
+            cfg.BENCHMARK.CROSS_ATTN_BATCH_SIZE, seq_len, 768, device=device
+        )
+        out = mamba(x)
+        max_diffs = {
+            "sequential": (out - mamba(x, sequential=True)).abs().max(),
+            "recurrent": (out - mamba.forward_step(x)[0]).abs().max(),
+        }
+        if reference is not None:
+            max_diffs["mamba_ssm"] = (out - reference(x)).abs().max()
+        _, state = mamba.forward_step(x[:, :-1])
+        parallel_ms = _latency_ms(
+            lambda: mamba(x), device, cfg.BENCHMARK.NUM_ITERS
+        )
+        sequential_ms = _latency_ms(
+            lambda: mamba(x, sequential=True),
+            device,
+            cfg.BENCHMARK.NUM_ITERS,
+        )
+        step_ms = _latency_ms(
+            lambda: mamba.forward_step(x[:, -1:], state),
+            device,
+            cfg.BENCHMARK.NUM_ITERS,
+        )
+        logger.info(
+            "Mamba {} steps: parallel scan {:.2f} ms, sequential scan {:.2f} "
+            "ms, recurrent step {:.2f} ms per frame; max difference {}.".format(
+                seq_len,
+                parallel_ms,
+                sequential_ms,
+                step_ms,
+                ", ".join(
+                    "{} {:.2e}".format(name, diff.item())
+                    for name, diff in max_diffs.items()
+                ),
+            )
+        )
+        for name, diff in max_diffs.items():
+            assert diff.item() < 1e-4, "Mamba differs from {}".format(name)
+
+
+@torch.no_grad()
+def benchmark_early_exit(cfg):
+    """
+    Clip top-1 accuracy, average depth (blocks run per clip) and latency of a
+    VisionTransformer with the exit heads of TIMESFORMER.EARLY_EXIT_BLOCKS for
+    every TEST.EARLY_EXIT_THRESHOLD in BENCHMARK.EARLY_EXIT_THRESHOLDS, 0 for
+    the full model. Measured on the first BENCHMARK.NUM_EVAL_BATCHES batches
+    of the test split with the weights of TEST.CHECKPOINT_FILE_PATH (or the
+    last checkpoint in OUTPUT_DIR): exits depend on the clips, so random
+    inputs would not time them.
+    Args:
+        cfg (CfgNode): configs. Details can be found in
+            lib/config/defaults.py
+    """
+    import timesformer.datasets.utils as data_utils
+    import timesformer.utils.checkpoint as cu
+    import timesformer.utils.metrics as metrics
+    from timesformer.models import build_model
+
+    setup_environment()
+    torch.manual_seed(cfg.RNG_SEED)
+    logging.setup_logging(cfg.OUTPUT_DIR)
+    device = _benchmark_device(cfg)
+    assert cfg.TIMESFORMER.EARLY_EXIT_BLOCKS, "Set TIMESFORMER.EARLY_EXIT_BLOCKS"
+
+    model = build_model(cfg)
+    cu.load_test_checkpoint(cfg, model)
+    model.eval()
+    vit = model.module.model if hasattr(model, "module") else model.model
+    test_loader = loader.construct_loader(cfg, "test")
+    batches = []
+    for cur_iter, (inputs, labels, _, _) in enumerate(test_loader):
+        if 0 < cfg.BENCHMARK.NUM_EVAL_BATCHES <= cur_iter:
+            break
+        inputs = inputs.to(device, non_blocking=True)
+        if cfg.DATA.NORMALIZE_ON_DEVICE:
+            inputs = data_utils.normalize_on_device(
+                inputs, cfg.DATA.MEAN, cfg.DATA.STD
+            )
+        batches.append((inputs, labels.to(device)))
+
+    for threshold in cfg.BENCHMARK.EARLY_EXIT_THRESHOLDS:
+        vit.early_exit_threshold = threshold
+        num_correct, num_clips, num_blocks = 0, 0, 0
+        for inputs, labels in batches:
+            preds = model(inputs)
+            num_correct += metrics.topks_correct(preds, labels, (1,))[0].item()
+            num_clips += labels.size(0)
+            num_blocks += (
+                vit.exit_depth.sum().item()
+                if threshold > 0
+                else vit.depth * labels.size(0)
+            )
+        latency = _latency_ms(
+            lambda: [model(inputs) for inputs, _ in batches],
+            device,
+            cfg.BENCHMARK.NUM_ITERS,
+        ) / max(len(batches), 1)
+        logger.info(
+            "Early exit threshold {}: clip top-1 {:.2f}% on {} clips, "
+            "average depth {:.2f} of {} blocks, {:.2f} ms per batch.".format(
+                threshold,
+                100.0 * num_correct / max(num_clips, 1),
+                num_clips,
+                num_blocks / max(num_clips, 1),
+                vit.depth,
+                latency,
+            )
+        )
+
+
+@torch.no_grad()
+def benchmark_fused_block(cfg):
+    """
+    Parity and latency of vit.FusedBlock against vit.Block with shared weights
+    in eval mode, for every attention backend, on a random TEST.BATCH_SIZE
+    batch of DATA.NUM_FRAMES frames of TEST_CROP_SIZE / 16 patches with the
+    768-dimensional ViT-Base block. Also checks token merging sizes. Fails if
+    the blocks differ by more than 1e-4.
+    Args:
+        cfg (CfgNode): configs. Details can be found in
+            lib/config/defaults.py
+    """
+    from timesformer.models.vit import ATTN_BACKENDS, Block, FusedBlock
+
+    setup_environment()
+    torch.manual_seed(cfg.RNG_SEED)
+    logging.setup_logging(cfg.OUTPUT_DIR)
+    device = _benchmark_device(cfg)
+
+    B, T = cfg.TEST.BATCH_SIZE, cfg.DATA.NUM_FRAMES
+    W = cfg.DATA.TEST_CROP_SIZE // 16
+    x = torch.randn(B, 1 + W * W * T, 768, device=device)
+    size = torch.randint(1, 4, (B, W * W), device=device).float()
+    for backend in ATTN_BACKENDS:
+        kwargs = dict(
+            dim=768,
+            num_heads=12,
+            qkv_bias=True,
+            attn_backend=backend,
+            attn_chunk_size=cfg.MODEL.ATTN_CHUNK_SIZE,
+        )
+        block = Block(**kwargs).to(device).eval()
+        fused = FusedBlock(**kwargs).to(device).eval()
+        fused.load_state_dict(block.state_dict())
+        max_diff = max(
+            (block(x, B, T, W, size=s) - fused(x, B, T, W, size=s))
+            .abs()
+            .max()
+            .item()
+            for s in [None, size]
+        )
+        block_ms = _latency_ms(
+            lambda: block(x, B, T, W), device, cfg.BENCHMARK.NUM_ITERS
+        )
+        fused_ms = _latency_ms(
+            lambda: fused(x, B, T, W), device, cfg.BENCHMARK.NUM_ITERS
+        )
+        logger.info(
+            "Block backend={}: {:.2f} ms, FusedBlock {:.2f} ms; max "
+            "difference {:.2e}.".format(backend, block_ms, fused_ms, max_diff)
+        )
+        assert max_diff < 1e-4, "FusedBlock differs from Block"
@@ -0,0 +1,190 @@
+# Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved.
+
+"""
+Graph-compiled inference of TEST.COMPILE. The model is compiled once per input
+signature and the compiled artifacts are kept in TEST.COMPILE_CACHE_DIR, so
+test jobs sharing the directory skip recompilation.
+"""
+
+import hashlib
+import os
+import torch
+import torch.nn as nn
+from fvcore.common.file_io import PathManager
+
+import timesformer.utils.logging as logging
+
+logger = logging.get_logger(__name__)
+
+COMPILE_BACKENDS = ["trace", "inductor"]
+
+
+def _flatten(inputs):
+    if isinstance(inputs, (list, tuple)):
+        return [t for x in inputs for t in _flatten(x)]
+    return [inputs]
+
+
+def _autocast_dtype(device_type):
+    """
+    Autocast dtype of `device_type` as a string, None if autocast is off.
+    The per-device-type autocast queries only exist in torch>=2.4; older
+    versions have the per-device functions.
+    """
+    if hasattr(torch, "get_autocast_dtype"):
+        if not torch.is_autocast_enabled(device_type):
+            return None
+        return str(torch.get_autocast_dtype(device_type))
+    if device_type == "cpu":
+        if not torch.is_autocast_cpu_enabled():
+            return None
+        return str(torch.get_autocast_cpu_dtype())
+    if not torch.is_autocast_enabled():
+        return None
+    return str(torch.get_autocast_gpu_dtype())
+
+
+def input_signature(inputs):
+    """
+    Shapes and dtypes of the tensors of `inputs`, their device and the autocast
+    dtype, if any. A compiled graph is specialized on all of them.
+    """
+    tensors = _flatten(inputs)
+    return tuple((tuple(t.shape), str(t.dtype)) for t in tensors) + (
+        str(tensors[0].device),
+        _autocast_dtype(tensors[0].device.type),
+    )
+
+
+def _model_key(model, cfg):
+    """
+    Hash of everything a traced graph depends on besides the input signature:
+    the architecture, the model options and the torch version. Weights are
+    not part of it, they are loaded into the cached graph.
+    """
+    key = hashlib.sha1()
+    for part in (
+        torch.__version__,
+        type(model).__name__,
+        repr(model),
+        cfg.MODEL.dump(),
+        cfg.TIMESFORMER.dump(),
+        repr([(k, tuple(v.shape)) for k, v in model.state_dict().items()]),
+    ):
+        key.update(part.encode())
+    return key.hexdigest()
+
+
+def _clear_embed_caches(model):
+    # Cached embeddings would be traced as constants, not as functions of
+    # pos_embed / time_embed.
+    for module in model.modules():
+        if hasattr(module, "_embed_cache"):
+            module._embed_cache.clear()
+
+
+class CompiledModel(nn.Module):
+    """
+    Run `model` through a graph compiled for the input signature of the batch.
+    The first TEST.COMPILE_MAX_SHAPES signatures are compiled, other
+    signatures and signatures that fail to compile run the eager model.
+    """
+
+    def __init__(self, model, cfg):
+        """
+        Args:
+            model (nn.Module): the model to compile, in eval mode.
+            cfg (CfgNode): configs. Details can be found in
+                slowfast/config/defaults.py
+        """
+        super(CompiledModel, self).__init__()
+        assert (
+            cfg.TEST.COMPILE_BACKEND in COMPILE_BACKENDS
+        ), "Unknown TEST.COMPILE_BACKEND {}".format(cfg.TEST.COMPILE_BACKEND)
+        self.model = model.module if hasattr(model, "module") else model
+        self.backend = cfg.TEST.COMPILE_BACKEND
+        self.max_shapes = cfg.TEST.COMPILE_MAX_SHAPES
+        self.cache_dir = cfg.TEST.COMPILE_CACHE_DIR or os.path.join(
+            cfg.OUTPUT_DIR, "compile_cache"
+        )
+        self.model_key = _model_key(self.model, cfg)
+        # Input signature -> compiled callable, None to run eagerly.
+        self.compiled = {}
+        self.num_compiled = 0
+        self._inductor_model = None
+
+    def _trace(self, inputs, signature):
+        """
+        Traced graph of `signature`, loaded from the cache directory with the
+        current weights if it was traced before.
+        """
+        key = hashlib.sha1(
+            (self.model_key + repr(signature)).encode()
+        ).hexdigest()
+        path = os.path.join(self.cache_dir, "trace_{}.pt".format(key))
+        if PathManager.exists(path):
+            with PathManager.open(path, "rb") as f:
+                traced = torch.jit.load(
+                    f, map_location=_flatten(inputs)[0].device
+                )
+            traced.load_state_dict(self.model.state_dict())
+            logger.info(
+                "Loaded model traced for {} from {}.".format(signature, path)
+            )
+            return traced
+
+        _clear_embed_caches(self.model)
+        with torch.no_grad():
+            traced = torch.jit.trace(self.model, (inputs,), check_trace=False)
+        PathManager.mkdirs(self.cache_dir)
+        with PathManager.open(path, "wb") as f:
+            torch.jit.save(traced, f)
+        logger.info("Traced model for {} to {}.".format(signature, path))
+        return traced
+
+    def _inductor(self):
+        """
+        torch.compile of the model, specialized on every signature it sees.
+        Inductor writes its compiled graphs to the cache directory.
+        """
+        if self._inductor_model is None:
+            import torch._inductor.config
+
+            inductor_dir = os.path.join(self.cache_dir, "inductor")
+            PathManager.mkdirs(inductor_dir)
+            os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", inductor_dir)
+            torch._inductor.config.fx_graph_cache = True
+            self._inductor_model = torch.compile(self.model, dynamic=False)
+        return self._inductor_model
+
+    def forward(self, inputs, *args):
+        if args:
+            # Extra inputs, e.g. detection boxes, are not compiled.
+            return self.model(inputs, *args)
+        signature = input_signature(inputs)
+        if signature in self.compiled:
+            fn = self.compiled[signature]
+            return self.model(inputs) if fn is None else fn(inputs)
+
+        if self.num_compiled >= self.max_shapes:
+            logger.info("Running {} eagerly.".format(signature))
+            self.compiled[signature] = None
+            return self.model(inputs)
+        self.num_compiled += 1
+        try:
+            fn = (
+                self._inductor()
+                if self.backend == "inductor"
+                else self._trace(inputs, signature)
+            )
+            preds = fn(inputs)
+        except Exception as e:
+            logger.warning(
+                "Compiling for {} failed, running eagerly: {}".format(
+                    signature, e
+                )
+            )
+            fn = None
+            preds = self.model(inputs)
+        self.compiled[signature] = fn
+        return preds
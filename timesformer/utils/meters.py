@@ -316,27 +316,49 @@ class TestMeter(object):
             clip_ids (tensor): clip indexes of the current batch, dimension is
                 N.
         """
-        for ind in range(preds.shape[0]):
-            vid_id = int(clip_ids[ind]) // self.num_clips
-            if self.video_labels[vid_id].sum() > 0:
-                assert torch.equal(
-                    self.video_labels[vid_id].type(torch.FloatTensor),
-                    labels[ind].type(torch.FloatTensor),
+        if self.ensemble_method not in ["sum", "max"]:
+            raise NotImplementedError(
+                "Ensemble Method {} is not supported".format(
+                    self.ensemble_method
                 )
-            self.video_labels[vid_id] = labels[ind]
-            if self.ensemble_method == "sum":
-                self.video_preds[vid_id] += preds[ind]
-            elif self.ensemble_method == "max":
-                self.video_preds[vid_id] = torch.max(
-                    self.video_preds[vid_id], preds[ind]
-                )
-            else:
-                raise NotImplementedError(
-                    "Ensemble Method {} is not supported".format(
-                        self.ensemble_method
-                    )
-                )
-            self.clip_count[vid_id] += 1
+            )
+        vid_ids = clip_ids.long().to(self.clip_count.device) // self.num_clips
+        preds = preds.to(self.video_preds)
+        labels = labels.to(self.video_labels)
+
+        # Group the clips of every video, keeping their order in the batch.
+        # A clip is checked against the label stored by the previous clip of
+        # its video, or against the label of the meter for the first one.
+        order = torch.sort(vid_ids, stable=True)[1]
+        sorted_ids = vid_ids[order]
+        sorted_labels = labels[order]
+        first = torch.ones_like(sorted_ids, dtype=torch.bool)
+        first[1:] = sorted_ids[1:] != sorted_ids[:-1]
+        prev_labels = torch.where(
+            first.view((-1,) + (1,) * (labels.dim() - 1)),
+            self.video_labels[sorted_ids],
+            sorted_labels.roll(1, 0),
+        )
+        checked = prev_labels.reshape(len(order), -1).sum(1) > 0
+        assert torch.equal(
+            prev_labels[checked].type(torch.FloatTensor),
+            sorted_labels[checked].type(torch.FloatTensor),
+        )
+        # The last clip of every video sets its label.
+        last = torch.ones_like(first)
+        last[:-1] = first[1:]
+        self.video_labels[sorted_ids[last]] = sorted_labels[last]
+
+        if self.ensemble_method == "sum":
+            self.video_preds.index_add_(0, vid_ids, preds)
+        else:
+            self.video_preds.scatter_reduce_(
+                0,
+                vid_ids.view(-1, 1).expand_as(preds),
+                preds,
+                reduce="amax",
+            )
+        self.clip_count.index_add_(0, vid_ids, torch.ones_like(vid_ids))
 
     def log_iter_stats(self, cur_iter):
         """
@@ -24,14 +24,67 @@ from timesformer.models.batchnorm_helper import SubBatchNorm3d
 logger = logging.get_logger(__name__)
 
 
-def check_nan_losses(loss):
+def check_nan_losses(loss, mixed_precision=None):
     """
     Determine whether the loss is NaN (not a number).
     Args:
         loss (loss): loss to check whether is NaN.
+        mixed_precision (str): autocast dtype the loss was computed with, if
+            any. Infinite losses are then an overflow of the reduced
+            precision and raise as well.
     """
     if math.isnan(loss):
         raise RuntimeError("ERROR: Got NaN losses {}".format(datetime.now()))
+    if mixed_precision is not None and math.isinf(loss):
+        raise RuntimeError(
+            "ERROR: Got infinite losses with {} mixed precision {}".format(
+                mixed_precision, datetime.now()
+            )
+        )
+
+
+def get_autocast_dtype(cfg, training=True):
+    """
+    Autocast dtype of TRAIN.MIXED_PRECISION_DTYPE if TRAIN.MIXED_PRECISION,
+    of TEST.MIXED_PRECISION_DTYPE if TEST.MIXED_PRECISION for evaluation.
+    Returns:
+        dtype (str): "float16", "bfloat16", or None for fp32.
+    """
+    node = cfg.TRAIN if training else cfg.TEST
+    if not node.MIXED_PRECISION:
+        return None
+    assert node.MIXED_PRECISION_DTYPE in [
+        "float16",
+        "bfloat16",
+    ], "Unsupported mixed precision dtype {}".format(node.MIXED_PRECISION_DTYPE)
+    return node.MIXED_PRECISION_DTYPE
+
+
+def autocast(cfg, training=True):
+    """
+    Autocast context of the forward pass, on the GPU if cfg.NUM_GPUS else on
+    the CPU, see `get_autocast_dtype`. Disabled for fp32.
+    """
+    dtype = get_autocast_dtype(cfg, training)
+    return torch.autocast(
+        "cuda" if cfg.NUM_GPUS else "cpu",
+        dtype=getattr(torch, dtype or "bfloat16"),
+        enabled=dtype is not None,
+    )
+
+
+def build_grad_scaler(cfg):
+    """
+    GradScaler for dynamic loss scaling of fp16 training on the GPU. It is
+    disabled, and passes losses and optimizer steps through unchanged, for
+    fp32 and bf16, whose range does not need loss scaling.
+    """
+    dtype = get_autocast_dtype(cfg, training=True)
+    if dtype == "float16" and not cfg.NUM_GPUS:
+        logger.warning("float16 autocast on CPU runs without loss scaling.")
+    return torch.cuda.amp.GradScaler(
+        enabled=dtype == "float16" and cfg.NUM_GPUS > 0
+    )
 
 
 def params_count(model, ignore_bn=False):
@@ -0,0 +1,152 @@
+# Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved.
+
+"""
+ONNX export of the video models, written by tools/export_onnx.py, and the
+onnxruntime model of TEST.BACKEND `onnxruntime`. Running the exported graph
+needs neither the model code nor its training dependencies.
+"""
+
+import inspect
+import io
+import numpy as np
+import os
+import torch
+import torch.nn as nn
+from fvcore.common.file_io import PathManager
+
+import timesformer.utils.logging as logging
+from timesformer.datasets.utils import pack_pathway_output
+
+logger = logging.get_logger(__name__)
+
+
+def get_onnx_path(cfg):
+    """
+    ONNX.FILE_PATH, or OUTPUT_DIR/<MODEL.MODEL_NAME>.onnx if it is not set.
+    """
+    if cfg.ONNX.FILE_PATH != "":
+        return cfg.ONNX.FILE_PATH
+    return os.path.join(cfg.OUTPUT_DIR, "{}.onnx".format(cfg.MODEL.MODEL_NAME))
+
+
+def _as_list(inputs):
+    return list(inputs) if isinstance(inputs, (list, tuple)) else [inputs]
+
+
+def get_dummy_inputs(cfg, batch_size):
+    """
+    Random test clips of `batch_size` in the input format of the model: a
+    tensor for the VisionTransformer models, one tensor per pathway otherwise.
+    """
+    clips = [
+        torch.rand(
+            3,
+            cfg.DATA.NUM_FRAMES,
+            cfg.DATA.TEST_CROP_SIZE,
+            cfg.DATA.TEST_CROP_SIZE,
+        )
+        for _ in range(batch_size)
+    ]
+    if cfg.MODEL.ARCH in ["resformer", "vit"]:
+        return torch.stack(clips)
+    pathways = [pack_pathway_output(cfg, clip) for clip in clips]
+    return [torch.stack(pathway) for pathway in zip(*pathways)]
+
+
+def export_onnx(model, cfg, path_to_onnx):
+    """
+    Export `model` to ONNX with a dynamic batch axis. The inputs are named
+    `input_<pathway>` and the output `preds`.
+    Args:
+        model (nn.Module): model on CPU.
+        cfg (CfgNode): configs. Details can be found in
+            slowfast/config/defaults.py
+        path_to_onnx (str): path of the exported graph.
+    """
+    model.eval()
+    inputs = get_dummy_inputs(cfg, 1)
+    input_names = [
+        "input_{}".format(i) for i in range(len(_as_list(inputs)))
+    ]
+    dynamic_axes = {name: {0: "batch"} for name in input_names + ["preds"]}
+    export_kwargs = {}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        # torch>=2.5 can export with dynamo; keep the TorchScript exporter,
+        # which handles dynamic_axes.
+        export_kwargs["dynamo"] = False
+    buffer = io.BytesIO()
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            (inputs,),
+            buffer,
+            input_names=input_names,
+            output_names=["preds"],
+            dynamic_axes=dynamic_axes,
+            opset_version=cfg.ONNX.OPSET,
+            **export_kwargs
+        )
+    PathManager.mkdirs(os.path.dirname(path_to_onnx) or ".")
+    with PathManager.open(path_to_onnx, "wb") as f:
+        f.write(buffer.getvalue())
+
+
+class OnnxModel(nn.Module):
+    """
+    An exported graph run on CPU by onnxruntime, called like the model it was
+    exported from.
+    """
+
+    def __init__(self, cfg, path_to_onnx=None):
+        """
+        Args:
+            cfg (CfgNode): configs. Details can be found in
+                slowfast/config/defaults.py
+            path_to_onnx (str): exported graph, defaults to get_onnx_path.
+        """
+        super(OnnxModel, self).__init__()
+        import onnxruntime
+
+        path_to_onnx = path_to_onnx or get_onnx_path(cfg)
+        options = onnxruntime.SessionOptions()
+        if cfg.ONNX.INTRA_OP_THREADS > 0:
+            options.intra_op_num_threads = cfg.ONNX.INTRA_OP_THREADS
+        if cfg.ONNX.INTER_OP_THREADS > 0:
+            # Inter-op threads are only used by the parallel executor.
+            options.execution_mode = onnxruntime.ExecutionMode.ORT_PARALLEL
+            options.inter_op_num_threads = cfg.ONNX.INTER_OP_THREADS
+        with PathManager.open(path_to_onnx, "rb") as f:
+            self.session = onnxruntime.InferenceSession(
+                f.read(), options, providers=["CPUExecutionProvider"]
+            )
+        self.input_names = [x.name for x in self.session.get_inputs()]
+        logger.info("Loaded ONNX model {}.".format(path_to_onnx))
+
+    def forward(self, inputs):
+        feeds = {
+            name: x.detach().cpu().numpy()
+            for name, x in zip(self.input_names, _as_list(inputs))
+        }
+        return torch.from_numpy(self.session.run(None, feeds)[0])
+
+
+@torch.no_grad()
+def check_parity(model, onnx_model, cfg, batch_sizes=(1, 2)):
+    """
+    Max absolute difference between the outputs of `model` and `onnx_model`
+    on random clips of every batch size in `batch_sizes`.
+    Returns:
+        max_diffs (list): max absolute difference per batch size.
+    """
+    model.eval()
+    max_diffs = []
+    for batch_size in batch_sizes:
+        inputs = get_dummy_inputs(cfg, batch_size)
+        onnx_preds = onnx_model(inputs).numpy()
+        # The ResNet stages overwrite the pathway list they are given.
+        preds = model(inputs).float().numpy()
+        assert preds.shape == onnx_preds.shape, "{} vs {}".format(
+            preds.shape, onnx_preds.shape
+        )
+        max_diffs.append(float(np.abs(preds - onnx_preds).max()))
+    return max_diffs
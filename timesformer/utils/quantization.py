@@ -0,0 +1,127 @@
+# Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved.
+
+"""
+Int8 quantization of the nn.Linear layers of a model for CPU inference:
+the q/k/v and output projections of `Attention`, `Mlp`, `temporal_fc` and
+the classification head of the VisionTransformer models.
+"""
+
+import torch
+import torch.nn as nn
+from fvcore.common.file_io import PathManager
+
+import timesformer.datasets.utils as data_utils
+import timesformer.utils.logging as logging
+
+logger = logging.get_logger(__name__)
+
+QUANT_MODES = ["dynamic", "static"]
+
+
+def _set_engine():
+    engines = torch.backends.quantized.supported_engines
+    engine = "x86" if "x86" in engines else "fbgemm"
+    torch.backends.quantized.engine = engine
+    return engine
+
+
+def _wrap_linears(module, qconfig):
+    """
+    Replace every nn.Linear of `module` by a QuantWrapper, which quantizes
+    its input and dequantizes its output, so the rest of the model stays in
+    float.
+    """
+    for name, child in module.named_children():
+        if type(child) == nn.Linear:
+            wrapper = torch.ao.quantization.QuantWrapper(child)
+            wrapper.qconfig = qconfig
+            setattr(module, name, wrapper)
+        else:
+            _wrap_linears(child, qconfig)
+
+
+def _calibration_inputs(cfg, calib_loader):
+    for cur_iter, (inputs, *_) in enumerate(calib_loader):
+        if cur_iter >= cfg.QUANT.CALIBRATION_BATCHES:
+            return
+        if cfg.DATA.NORMALIZE_ON_DEVICE:
+            inputs = data_utils.normalize_on_device(
+                inputs, cfg.DATA.MEAN, cfg.DATA.STD
+            )
+        yield inputs
+
+
+@torch.no_grad()
+def quantize_model(model, cfg, calib_loader=None):
+    """
+    Quantize the nn.Linear layers of a float model to int8 with QUANT.MODE.
+    `dynamic` quantizes the weights and the activations on the fly per
+    batch. `static` also fixes the activation ranges from
+    QUANT.CALIBRATION_BATCHES batches of `calib_loader`, without it only the
+    quantized structure is built, to load a saved quantized state dict.
+    Args:
+        model (nn.Module): float model on CPU, it is modified in place.
+        cfg (CfgNode): configs. Details can be found in
+            slowfast/config/defaults.py
+        calib_loader (loader): loader of the calibration batches.
+    Returns:
+        model (nn.Module): the quantized model, in eval mode.
+    """
+    assert cfg.QUANT.MODE in QUANT_MODES, "Unknown QUANT.MODE {}".format(
+        cfg.QUANT.MODE
+    )
+    engine = _set_engine()
+    model = model.cpu().eval()
+    if cfg.QUANT.MODE == "dynamic":
+        return torch.ao.quantization.quantize_dynamic(
+            model, {nn.Linear}, dtype=torch.qint8
+        )
+
+    _wrap_linears(model, torch.ao.quantization.get_default_qconfig(engine))
+    torch.ao.quantization.prepare(model, inplace=True)
+    if calib_loader is not None:
+        for inputs in _calibration_inputs(cfg, calib_loader):
+            model(inputs)
+        logger.info(
+            "Calibrated int8 activations on {} batches.".format(
+                min(cfg.QUANT.CALIBRATION_BATCHES, len(calib_loader))
+            )
+        )
+    torch.ao.quantization.convert(model, inplace=True)
+    return model
+
+
+def save_quantized_model(model, cfg, path_to_checkpoint):
+    """
+    Save the state dict of a quantized model with its QUANT.MODE.
+    """
+    checkpoint = {
+        "model_state": model.state_dict(),
+        "quant_mode": cfg.QUANT.MODE,
+        "cfg": cfg.dump(),
+    }
+    with PathManager.open(path_to_checkpoint, "wb") as f:
+        torch.save(checkpoint, f)
+
+
+def load_quantized_model(model, cfg, calib_loader=None):
+    """
+    Int8 model of TEST.BACKEND `int8`. Loads QUANT.CHECKPOINT_FILE_PATH, as
+    written by tools/quantize_net.py, into the quantized structure of the
+    float `model`, or quantizes the float `model` if it is not set.
+    """
+    if cfg.QUANT.CHECKPOINT_FILE_PATH == "":
+        return quantize_model(model, cfg, calib_loader)
+    with PathManager.open(cfg.QUANT.CHECKPOINT_FILE_PATH, "rb") as f:
+        checkpoint = torch.load(f, map_location="cpu")
+    assert checkpoint["quant_mode"] == cfg.QUANT.MODE, (
+        "{} was quantized with QUANT.MODE {}".format(
+            cfg.QUANT.CHECKPOINT_FILE_PATH, checkpoint["quant_mode"]
+        )
+    )
+    model = quantize_model(model, cfg)
+    model.load_state_dict(checkpoint["model_state"])
+    logger.info(
+        "Loaded int8 model from {}.".format(cfg.QUANT.CHECKPOINT_FILE_PATH)
+    )
+    return model
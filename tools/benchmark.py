@@ -1,22 +1,65 @@
 # Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved
 """
-A script to benchmark data loading.
+A script to benchmark data loading and model components. The benchmark is
+selected with BENCHMARK.TYPE.
 """
 
 import timesformer.utils.logging as logging
-from timesformer.utils.benchmark import benchmark_data_loading
+from timesformer.utils.benchmark import (
+    benchmark_activation_checkpoint,
+    benchmark_arrow_attention,
+    benchmark_attention_backends,
+    benchmark_causal_stream,
+    benchmark_compile,
+    benchmark_cross_attention,
+    benchmark_data_loading,
+    benchmark_early_exit,
+    benchmark_fused_block,
+    benchmark_mamba,
+    benchmark_mixed_precision,
+    benchmark_moose_encoder,
+    benchmark_normalize_on_device,
+    benchmark_optical_flow,
+    benchmark_startup,
+    benchmark_test_meter,
+    benchmark_time_only_memory,
+    benchmark_token_merging,
+)
 from timesformer.utils.misc import launch_job
 from timesformer.utils.parser import load_config, parse_args
 
 logger = logging.get_logger(__name__)
 
+BENCHMARKS = {
+    "data_loading": benchmark_data_loading,
+    "attention": benchmark_attention_backends,
+    "normalize_on_device": benchmark_normalize_on_device,
+    "optical_flow": benchmark_optical_flow,
+    "moose_encoder": benchmark_moose_encoder,
+    "test_meter": benchmark_test_meter,
+    "time_only_memory": benchmark_time_only_memory,
+    "startup": benchmark_startup,
+    "token_merging": benchmark_token_merging,
+    "mixed_precision": benchmark_mixed_precision,
+    "activation_checkpoint": benchmark_activation_checkpoint,
+    "compile": benchmark_compile,
+    "cross_attention": benchmark_cross_attention,
+    "arrow_attention": benchmark_arrow_attention,
+    "causal_stream": benchmark_causal_stream,
+    "mamba": benchmark_mamba,
+    "early_exit": benchmark_early_exit,
+    "fused_block": benchmark_fused_block,
+}
+
 
 def main():
     args = parse_args()
     cfg = load_config(args)
 
     launch_job(
-        cfg=cfg, init_method=args.init_method, func=benchmark_data_loading
+        cfg=cfg,
+        init_method=args.init_method,
+        func=BENCHMARKS[cfg.BENCHMARK.TYPE],
     )
 
 
@@ -0,0 +1,84 @@
+# Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved.
+
+"""
+Pack the per-clip `k400_light` / `SSv2_light` pickles of a dataset into the
+memory-mapped clip store read with DATA.CLIP_STORE_DIR.
+"""
+
+import torch
+import tqdm
+
+import timesformer.utils.logging as logging
+from timesformer.datasets import build_dataset
+from timesformer.datasets.clip_store import ClipShardWriter
+from timesformer.datasets.kinetics import load_tensors_from_pickle
+from timesformer.datasets.utils import normalize_on_device, tensor_to_uint8
+from timesformer.utils.parser import load_config, parse_args
+
+logger = logging.get_logger(__name__)
+
+
+def to_store_dtype(frames, cfg):
+    """
+    Convert the frames of a pickle, uint8 or normalized float (legacy), to
+    DATA.CLIP_STORE_DTYPE.
+    Args:
+        frames (tensor): frames, `channel` x `num frames` x `height` x
+            `width`.
+        cfg (CfgNode): configs.
+    Returns:
+        frames (tensor): frames in the store dtype.
+    """
+    if cfg.DATA.CLIP_STORE_DTYPE == "float16":
+        return normalize_on_device(
+            frames.unsqueeze(0), cfg.DATA.MEAN, cfg.DATA.STD
+        )[0].half()
+    assert cfg.DATA.CLIP_STORE_DTYPE == "uint8", "Unsupported dtype {}".format(
+        cfg.DATA.CLIP_STORE_DTYPE
+    )
+    if frames.dtype == torch.uint8:
+        return frames
+    return tensor_to_uint8(frames, cfg.DATA.MEAN, cfg.DATA.STD)
+
+
+def convert_split(cfg, split):
+    """
+    Write the pickles of every dataset index of `split` into the clip store.
+    Views of a video that share one pickle are stored once.
+    """
+    dataset = build_dataset(
+        cfg.TEST.DATASET if split == "test" else cfg.TRAIN.DATASET, cfg, split
+    )
+    writer = ClipShardWriter(
+        cfg.DATA.CLIP_STORE_DIR,
+        split,
+        int(cfg.DATA.CLIP_STORE_SHARD_GB * 1024 ** 3),
+    )
+    clip_ids = {}
+    index_map = []
+    for index in tqdm.tqdm(range(len(dataset))):
+        path = dataset.get_light_path(index)
+        if path not in clip_ids:
+            frames, label, _ = load_tensors_from_pickle(path)
+            assert frames is not None, "Failed to load {}".format(path)
+            assert torch.is_tensor(frames), "Multi-pathway clips in {} are not supported".format(path)
+            clip_ids[path] = writer.add(to_store_dtype(frames, cfg), label)
+        index_map.append(clip_ids[path])
+    writer.close(index_map)
+
+
+def main():
+    args = parse_args()
+    cfg = load_config(args)
+    logging.setup_logging(cfg.OUTPUT_DIR)
+    assert cfg.DATA.CLIP_STORE_DIR != "", "DATA.CLIP_STORE_DIR not set"
+    splits = (["train", "val"] if cfg.TRAIN.ENABLE else []) + (
+        ["test"] if cfg.TEST.ENABLE else []
+    )
+    for split in splits:
+        logger.info("Converting {} split".format(split))
+        convert_split(cfg, split)
+
+
+if __name__ == "__main__":
+    main()
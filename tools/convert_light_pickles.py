@@ -0,0 +1,67 @@
+# Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved.
+
+"""
+Rewrite the legacy float32 `k400_light` / `SSv2_light` pickles of a dataset
+as uint8 pixels, the format written by save_tensors_to_pickle. Converted
+pickles take 4x less disk and page cache and are no longer converted on every
+load.
+"""
+
+import os
+import torch
+import tqdm
+
+import timesformer.utils.logging as logging
+from timesformer.datasets import build_dataset
+from timesformer.datasets.kinetics import (
+    load_tensors_from_pickle,
+    save_tensors_to_pickle,
+)
+from timesformer.utils.parser import load_config, parse_args
+
+logger = logging.get_logger(__name__)
+
+
+def convert_split(cfg, split):
+    """
+    Rewrite the float32 pickles of every dataset index of `split` in place.
+    Returns:
+        num_converted (int): number of pickles rewritten.
+    """
+    dataset = build_dataset(
+        cfg.TEST.DATASET if split == "test" else cfg.TRAIN.DATASET, cfg, split
+    )
+    paths = sorted({dataset.get_light_path(i) for i in range(len(dataset))})
+    num_converted = 0
+    for path in tqdm.tqdm(paths):
+        frames, label, index = load_tensors_from_pickle(path)
+        assert frames is not None, "Failed to load {}".format(path)
+        if frames.dtype == torch.uint8:
+            continue
+        # Write next to the pickle and swap, so an interrupted run leaves
+        # every pickle readable.
+        save_tensors_to_pickle(
+            path + ".tmp", frames, label, index, cfg.DATA.MEAN, cfg.DATA.STD
+        )
+        os.replace(path + ".tmp", path)
+        num_converted += 1
+    return num_converted
+
+
+def main():
+    args = parse_args()
+    cfg = load_config(args)
+    logging.setup_logging(cfg.OUTPUT_DIR)
+    splits = (["train", "val"] if cfg.TRAIN.ENABLE else []) + (
+        ["test"] if cfg.TEST.ENABLE else []
+    )
+    for split in splits:
+        logger.info(
+            "Converted {} {} pickles to uint8".format(
+                convert_split(cfg, split), split
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
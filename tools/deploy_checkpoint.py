@@ -0,0 +1,79 @@
+# Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved.
+
+"""
+Resize the positional and time embeddings of a trained VisionTransformer to
+the deployment geometry (DATA.TEST_CROP_SIZE, DATA.NUM_FRAMES) once and save
+them in a serving checkpoint, so the served model never interpolates them.
+"""
+
+import os
+import torch
+from fvcore.common.file_io import PathManager
+
+import timesformer.utils.checkpoint as cu
+import timesformer.utils.logging as logging
+from timesformer.models import build_model
+from timesformer.utils.parser import load_config, parse_args
+
+logger = logging.get_logger(__name__)
+
+
+def deploy_checkpoint(cfg):
+    """
+    Load the test checkpoint into a model built with the training geometry
+    (DATA.TRAIN_CROP_SIZE), bake the embeddings resized to DATA.TEST_CROP_SIZE
+    and DATA.NUM_FRAMES and write them to OUTPUT_DIR. The saved cfg has
+    DATA.TRAIN_CROP_SIZE set to DATA.TEST_CROP_SIZE, the model that loads the
+    checkpoint must be built with it.
+    Args:
+        cfg (CfgNode): configs. Details can be found in
+            slowfast/config/defaults.py
+    Returns:
+        path_to_checkpoint (str): path of the serving checkpoint.
+    """
+    logging.setup_logging(cfg.OUTPUT_DIR)
+    model = build_model(cfg)
+    cu.load_test_checkpoint(cfg, model)
+    model = model.module if hasattr(model, "module") else model
+    assert hasattr(model, "model") and hasattr(
+        model.model, "resize_embeddings"
+    ), "{} has no VisionTransformer to resize".format(cfg.MODEL.MODEL_NAME)
+    model.model.resize_embeddings(
+        img_size=cfg.DATA.TEST_CROP_SIZE, num_frames=cfg.DATA.NUM_FRAMES
+    )
+
+    deploy_cfg = cfg.clone()
+    deploy_cfg.DATA.TRAIN_CROP_SIZE = cfg.DATA.TEST_CROP_SIZE
+    checkpoint = {
+        "epoch": -1,
+        "model_state": cu.sub_to_normal_bn(model.state_dict()),
+        "cfg": deploy_cfg.dump(),
+    }
+    PathManager.mkdirs(cfg.OUTPUT_DIR)
+    path_to_checkpoint = os.path.join(
+        cfg.OUTPUT_DIR,
+        "checkpoint_deploy_{}x{}.pyth".format(
+            cfg.DATA.TEST_CROP_SIZE, cfg.DATA.NUM_FRAMES
+        ),
+    )
+    with PathManager.open(path_to_checkpoint, "wb") as f:
+        torch.save(checkpoint, f)
+    logger.info(
+        "Saved {} with embeddings for {}x{} crops of {} frames.".format(
+            path_to_checkpoint,
+            cfg.DATA.TEST_CROP_SIZE,
+            cfg.DATA.TEST_CROP_SIZE,
+            cfg.DATA.NUM_FRAMES,
+        )
+    )
+    return path_to_checkpoint
+
+
+def main():
+    args = parse_args()
+    cfg = load_config(args)
+    deploy_checkpoint(cfg)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+# Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved.
+
+"""
+Export the test checkpoint of a registered model (vit_base_patch16_224,
+TimePSformer, SlowFast, X3D, ...) to ONNX with a dynamic batch axis and check
+onnxruntime against PyTorch. The graph is run by test_net with TEST.BACKEND
+`onnxruntime`.
+"""
+
+import numpy as np
+import torch
+
+import timesformer.utils.checkpoint as cu
+import timesformer.utils.logging as logging
+import timesformer.utils.onnx_backend as onnx_backend
+from timesformer.models import build_model
+from timesformer.utils.parser import load_config, parse_args
+
+logger = logging.get_logger(__name__)
+
+
+def export_net(cfg):
+    """
+    Export the model of the test checkpoint to onnx_backend.get_onnx_path(cfg)
+    and fail if its outputs differ from PyTorch by more than ONNX.PARITY_ATOL.
+    Args:
+        cfg (CfgNode): configs. Details can be found in
+            slowfast/config/defaults.py
+    Returns:
+        path_to_onnx (str): path of the exported graph.
+    """
+    np.random.seed(cfg.RNG_SEED)
+    torch.manual_seed(cfg.RNG_SEED)
+    logging.setup_logging(cfg.OUTPUT_DIR)
+    assert cfg.NUM_GPUS == 0, "ONNX export runs on CPU, set NUM_GPUS 0"
+
+    model = build_model(cfg)
+    cu.load_test_checkpoint(cfg, model)
+    model.eval()
+    path_to_onnx = onnx_backend.get_onnx_path(cfg)
+    onnx_backend.export_onnx(model, cfg, path_to_onnx)
+    logger.info(
+        "Exported {} to {} with opset {}.".format(
+            cfg.MODEL.MODEL_NAME, path_to_onnx, cfg.ONNX.OPSET
+        )
+    )
+
+    onnx_model = onnx_backend.OnnxModel(cfg, path_to_onnx)
+    max_diffs = onnx_backend.check_parity(model, onnx_model, cfg)
+    logger.info(
+        "Max absolute difference of onnxruntime to PyTorch for batch sizes "
+        "1, 2: {}.".format(", ".join("{:.2e}".format(d) for d in max_diffs))
+    )
+    assert max(max_diffs) <= cfg.ONNX.PARITY_ATOL, (
+        "onnxruntime differs from PyTorch by more than ONNX.PARITY_ATOL "
+        "{}".format(cfg.ONNX.PARITY_ATOL)
+    )
+    return path_to_onnx
+
+
+def main():
+    args = parse_args()
+    cfg = load_config(args)
+    # Single process on purpose: the export runs on CPU.
+    export_net(cfg)
+
+
+if __name__ == "__main__":
+    main()
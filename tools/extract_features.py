@@ -0,0 +1,92 @@
+# Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved.
+
+"""
+Run the frozen MOOSE encoder once over the dataset splits and write the visual
+tokens and optical flow of every clip to the feature cache used by
+MODEL.USE_FEATURE_CACHE.
+"""
+
+import numpy as np
+import torch
+import tqdm
+
+import timesformer.utils.logging as logging
+from timesformer.datasets import build_dataset
+from timesformer.datasets.feature_cache import FeatureCacheWriter
+from timesformer.datasets.utils import normalize_on_device
+from timesformer.models.vit import MOOSE_Encoder, get_raft_args
+from timesformer.utils.parser import load_config, parse_args
+
+logger = logging.get_logger(__name__)
+
+
+@torch.no_grad()
+def extract_features(cfg):
+    """
+    Extract the features of the train/val splits if TRAIN.ENABLE and of the
+    test split if TEST.ENABLE into DATA.FEATURE_CACHE_DIR. Clips are read in
+    dataset order, so each split must sample its views deterministically.
+    Args:
+        cfg (CfgNode): configs. Details can be found in
+            slowfast/config/defaults.py
+    """
+    np.random.seed(cfg.RNG_SEED)
+    torch.manual_seed(cfg.RNG_SEED)
+    logging.setup_logging(cfg.OUTPUT_DIR)
+    assert cfg.DATA.FEATURE_CACHE_DIR != "", "DATA.FEATURE_CACHE_DIR not set"
+
+    device = torch.device("cuda") if cfg.NUM_GPUS else torch.device("cpu")
+    encoder = MOOSE_Encoder(get_raft_args(), cfg).to(device).eval()
+
+    splits = (["train", "val"] if cfg.TRAIN.ENABLE else []) + (
+        ["test"] if cfg.TEST.ENABLE else []
+    )
+    for split in splits:
+        dataset = build_dataset(
+            cfg.TEST.DATASET if split == "test" else cfg.TRAIN.DATASET,
+            cfg,
+            split,
+        )
+        data_loader = torch.utils.data.DataLoader(
+            dataset,
+            batch_size=cfg.TEST.BATCH_SIZE,
+            shuffle=False,
+            num_workers=cfg.DATA_LOADER.NUM_WORKERS,
+            pin_memory=cfg.DATA_LOADER.PIN_MEMORY,
+        )
+        writer = FeatureCacheWriter(
+            cfg.DATA.FEATURE_CACHE_DIR,
+            split,
+            cfg.DATA.FEATURE_CACHE_SHARD_SIZE,
+        )
+        logger.info("Extracting {} features of {} clips".format(split, len(dataset)))
+        for inputs, labels, _, _ in tqdm.tqdm(data_loader):
+            if isinstance(inputs, (list,)):
+                inputs = inputs[0]
+            inputs = inputs.to(device, non_blocking=True)
+            if cfg.DATA.NORMALIZE_ON_DEVICE:
+                inputs = normalize_on_device(inputs, cfg.DATA.MEAN, cfg.DATA.STD)
+            # Discard the last frame, as MOOSE.forward does.
+            visual, flow = encoder(
+                inputs,
+                drop_last_frame=True,
+                with_motion=cfg.MODEL.FUSION_MODE != "space_only",
+            )
+            for i in range(inputs.size(0)):
+                writer.add(
+                    labels[i],
+                    visual=visual[i],
+                    flow=None if flow is None else flow[i],
+                )
+        writer.close()
+
+
+def main():
+    args = parse_args()
+    cfg = load_config(args)
+    # Single process on purpose: every split is written to one set of shards.
+    extract_features(cfg)
+
+
+if __name__ == "__main__":
+    main()
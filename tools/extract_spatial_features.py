@@ -0,0 +1,91 @@
+# Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved.
+
+"""
+Run the frozen Sapiens space embeddings of `time_only` VisionTransformers once
+over the frames of the dataset splits and write them, per (video, frame
+index), to the store used by TIMESFORMER.USE_SPATIAL_CACHE.
+"""
+
+import numpy as np
+import torch
+import tqdm
+from einops import rearrange
+
+import timesformer.utils.logging as logging
+from timesformer.datasets import build_dataset
+from timesformer.datasets.feature_cache import FrameFeatureWriter
+from timesformer.datasets.utils import normalize_on_device
+from timesformer.models.vit import get_sapiens_space_embs
+from timesformer.utils.parser import load_config, parse_args
+
+logger = logging.get_logger(__name__)
+
+SAPIENS_CHECKPOINT = "/data2/hongn/sapiens/pretrain/checkpoints/sapiens_0.3b/sapiens_0.3b_epoch_1600_clean.pth"
+
+
+@torch.no_grad()
+def extract_spatial_features(cfg, checkpoint_path=SAPIENS_CHECKPOINT):
+    """
+    Extract the per-frame embeddings of the train/val splits if TRAIN.ENABLE
+    and of the test split if TEST.ENABLE into DATA.SPATIAL_CACHE_DIR. Clips
+    are keyed by `dataset.get_light_path`, so views and splits that share a
+    clip are extracted once.
+    Args:
+        cfg (CfgNode): configs. Details can be found in
+            slowfast/config/defaults.py
+        checkpoint_path (str): Sapiens checkpoint, the default of
+            VisionTransformer.
+    """
+    np.random.seed(cfg.RNG_SEED)
+    torch.manual_seed(cfg.RNG_SEED)
+    logging.setup_logging(cfg.OUTPUT_DIR)
+    assert cfg.DATA.SPATIAL_CACHE_DIR != "", "DATA.SPATIAL_CACHE_DIR not set"
+
+    device = torch.device("cuda") if cfg.NUM_GPUS else torch.device("cpu")
+    space_embs = get_sapiens_space_embs(checkpoint_path).to(device).eval()
+    writer = FrameFeatureWriter(
+        cfg.DATA.SPATIAL_CACHE_DIR, cfg.DATA.SPATIAL_CACHE_SHARD_SIZE
+    )
+
+    splits = (["train", "val"] if cfg.TRAIN.ENABLE else []) + (
+        ["test"] if cfg.TEST.ENABLE else []
+    )
+    for split in splits:
+        dataset = build_dataset(
+            cfg.TEST.DATASET if split == "test" else cfg.TRAIN.DATASET,
+            cfg,
+            split,
+        )
+        logger.info(
+            "Extracting {} spatial features of {} clips".format(
+                split, len(dataset)
+            )
+        )
+        for index in tqdm.tqdm(range(len(dataset))):
+            video = dataset.get_light_path(index)
+            if (video, 0) in writer:
+                continue
+            frames = dataset[index][0]
+            if cfg.DATA.NORMALIZE_ON_DEVICE:
+                frames = normalize_on_device(
+                    frames.unsqueeze(0), cfg.DATA.MEAN, cfg.DATA.STD
+                )[0]
+            # C T H W -> T C H W, one Sapiens batch per clip.
+            x_spatial = space_embs(
+                rearrange(frames, "c t h w -> t c h w").to(device)
+            )
+            x_spatial = torch.stack(list(x_spatial), dim=1)
+            for t in range(x_spatial.shape[0]):
+                writer.add(video, t, x_spatial[t])
+    writer.close()
+
+
+def main():
+    args = parse_args()
+    cfg = load_config(args)
+    # Single process on purpose: all splits are written to one store.
+    extract_spatial_features(cfg)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+# Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved.
+
+"""
+Export a trained model to an int8 model for CPU inference (QUANT.MODE) and
+report its accuracy and latency against the fp32 model on the val split.
+The exported checkpoint is run by test_net with TEST.BACKEND `int8` and
+QUANT.CHECKPOINT_FILE_PATH.
+"""
+
+import copy
+import numpy as np
+import os
+import time
+import torch
+from fvcore.common.file_io import PathManager
+
+import timesformer.datasets.utils as data_utils
+import timesformer.utils.checkpoint as cu
+import timesformer.utils.logging as logging
+import timesformer.utils.metrics as metrics
+import timesformer.utils.quantization as quantization
+from timesformer.datasets import loader
+from timesformer.models import build_model
+from timesformer.utils.parser import load_config, parse_args
+
+logger = logging.get_logger(__name__)
+
+
+@torch.no_grad()
+def evaluate(model, val_loader, cfg):
+    """
+    Clip top-1 accuracy and mean batch latency on the first
+    QUANT.EVAL_BATCHES batches of `val_loader`.
+    Returns:
+        top1 (float): clip top-1 accuracy in percent.
+        latency (float): mean forward time per batch in ms.
+        preds (tensor): top-1 class of every clip.
+    """
+    model.eval()
+    num_correct, num_clips, seconds = 0, 0, 0.0
+    preds_top1 = []
+    for cur_iter, (inputs, labels, _, _) in enumerate(val_loader):
+        if 0 < cfg.QUANT.EVAL_BATCHES <= cur_iter:
+            break
+        if cfg.DATA.NORMALIZE_ON_DEVICE:
+            inputs = data_utils.normalize_on_device(
+                inputs, cfg.DATA.MEAN, cfg.DATA.STD
+            )
+        start = time.perf_counter()
+        preds = model(inputs)
+        seconds += time.perf_counter() - start
+        num_correct += metrics.topks_correct(preds, labels, (1,))[0].item()
+        num_clips += labels.size(0)
+        preds_top1.append(preds.argmax(dim=1))
+    num_batches = max(len(preds_top1), 1)
+    return (
+        100.0 * num_correct / max(num_clips, 1),
+        seconds * 1000.0 / num_batches,
+        torch.cat(preds_top1) if preds_top1 else torch.zeros(0),
+    )
+
+
+def quantize_net(cfg):
+    """
+    Quantize the test checkpoint, save the int8 state dict to OUTPUT_DIR and
+    log the accuracy delta and speedup against fp32.
+    Args:
+        cfg (CfgNode): configs. Details can be found in
+            slowfast/config/defaults.py
+    """
+    np.random.seed(cfg.RNG_SEED)
+    torch.manual_seed(cfg.RNG_SEED)
+    logging.setup_logging(cfg.OUTPUT_DIR)
+    assert cfg.NUM_GPUS == 0, "Int8 export runs on CPU, set NUM_GPUS 0"
+
+    model = build_model(cfg)
+    cu.load_test_checkpoint(cfg, model)
+    model.eval()
+    val_loader = loader.construct_loader(cfg, "val")
+    int8_model = quantization.quantize_model(
+        copy.deepcopy(model), cfg, val_loader
+    )
+
+    PathManager.mkdirs(cfg.OUTPUT_DIR)
+    path_to_checkpoint = os.path.join(
+        cfg.OUTPUT_DIR, "checkpoint_int8_{}.pyth".format(cfg.QUANT.MODE)
+    )
+    quantization.save_quantized_model(int8_model, cfg, path_to_checkpoint)
+    logger.info("Saved int8 model to {}.".format(path_to_checkpoint))
+
+    fp32_top1, fp32_latency, fp32_preds = evaluate(model, val_loader, cfg)
+    int8_top1, int8_latency, int8_preds = evaluate(int8_model, val_loader, cfg)
+    logger.info(
+        "fp32: clip top-1 {:.2f}%, {:.1f} ms per batch.".format(
+            fp32_top1, fp32_latency
+        )
+    )
+    logger.info(
+        "int8 {}: clip top-1 {:.2f}% ({:+.2f}), {:.1f} ms per batch "
+        "({:.2f}x), top-1 agreement with fp32 {:.2f}%.".format(
+            cfg.QUANT.MODE,
+            int8_top1,
+            int8_top1 - fp32_top1,
+            int8_latency,
+            fp32_latency / max(int8_latency, 1e-9),
+            100.0 * (fp32_preds == int8_preds).float().mean().item()
+            if len(fp32_preds)
+            else 0.0,
+        )
+    )
+
+
+def main():
+    args = parse_args()
+    cfg = load_config(args)
+    # Single process on purpose: int8 inference runs on CPU.
+    quantize_net(cfg)
+
+
+if __name__ == "__main__":
+    main()
@@ -121,6 +121,8 @@ def train_epoch(
 
         logger.info('Compute the loss.')
         loss = loss_fun(preds, labels)
+        if cfg.TIMESFORMER.EARLY_EXIT_BLOCKS:
+            loss = loss + cfg.TIMESFORMER.EARLY_EXIT_LOSS_WEIGHT * losses.early_exit_loss(model, loss_fun, labels)
 
         if cfg.MIXUP.ENABLED:
             labels = hard_labels
@@ -0,0 +1,271 @@
+# Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved.
+
+"""
+Score long videos with overlapping sliding windows. Every video is decoded
+once by a decoder thread, its windows go through a bounded queue and are
+batched across videos for the model. Per-window logits and the temporally
+aggregated prediction of every video are written as json lines to OUTPUT_DIR.
+"""
+
+import json
+import numpy as np
+import os
+import queue
+import threading
+import time
+import torch
+from collections import deque
+from fvcore.common.file_io import PathManager
+
+import timesformer.utils.checkpoint as cu
+import timesformer.utils.logging as logging
+import timesformer.utils.misc as misc
+from timesformer.datasets import video_container as container
+from timesformer.datasets.stream import iter_video_windows
+from timesformer.datasets.utils import normalize_on_device
+from timesformer.models import build_model
+from timesformer.utils.parser import load_config, parse_args
+
+logger = logging.get_logger(__name__)
+
+# Number of most recent window latencies used for the percentiles.
+LATENCY_HISTORY = 1000
+
+
+def read_video_list(cfg):
+    """
+    Read `path [label]` lines from TEST.STREAM_VIDEO_LIST, or from the test
+    csv in DATA.PATH_TO_DATA_DIR if it is not set.
+    Returns:
+        videos (list): tuples of video path and label, -1 if missing.
+    """
+    path_to_file = cfg.TEST.STREAM_VIDEO_LIST or os.path.join(
+        cfg.DATA.PATH_TO_DATA_DIR, "test.csv"
+    )
+    videos = []
+    with PathManager.open(path_to_file, "r") as f:
+        for line in f.read().splitlines():
+            fields = line.split(cfg.DATA.PATH_LABEL_SEPARATOR)
+            videos.append(
+                (
+                    os.path.join(cfg.DATA.PATH_PREFIX, fields[0]),
+                    int(fields[1]) if len(fields) > 1 else -1,
+                )
+            )
+    return videos
+
+
+def decode_videos(cfg, videos, next_video, windows):
+    """
+    Decoder thread. Claims videos from `next_video` and puts their windows
+    into the bounded `windows` queue, followed by an end of video marker.
+    Args:
+        cfg (CfgNode): configs.
+        videos (list): video paths and labels.
+        next_video (iterator): shared iterator over video indices.
+        windows (Queue): queue of `(video_idx, start_frame, pathways,
+            ready_time)`; `pathways` is None for the end of video marker.
+    """
+    for video_idx in next_video:
+        path = videos[video_idx][0]
+        video_container = container.get_video_container(
+            path, cfg.DATA_LOADER.ENABLE_MULTI_THREAD_DECODE, "pyav"
+        )
+        if video_container is None:
+            logger.warning("Failed to open video {}".format(path))
+        else:
+            try:
+                for start, pathways in iter_video_windows(cfg, video_container):
+                    windows.put((video_idx, start, pathways, time.perf_counter()))
+            except Exception as e:
+                logger.warning("Failed to decode video {}: {}".format(path, e))
+            video_container.close()
+        windows.put((video_idx, None, None, time.perf_counter()))
+
+
+class VideoAggregator(object):
+    """
+    Running temporal aggregation of window logits with DATA.ENSEMBLE_METHOD.
+    Only one row per video that is being decoded is kept.
+    """
+
+    def __init__(self, ensemble_method):
+        assert ensemble_method in ["sum", "max"]
+        self.ensemble_method = ensemble_method
+        self._preds = {}
+        self._counts = {}
+
+    def update(self, video_idx, logits):
+        if video_idx not in self._preds:
+            self._preds[video_idx] = logits.clone()
+            self._counts[video_idx] = 0
+        elif self.ensemble_method == "sum":
+            self._preds[video_idx] += logits
+        else:
+            torch.max(self._preds[video_idx], logits, out=self._preds[video_idx])
+        self._counts[video_idx] += 1
+
+    def pop(self, video_idx):
+        """
+        Returns:
+            preds (tensor or None): aggregated logits, None if the video had
+                no window.
+            count (int): number of windows.
+        """
+        return self._preds.pop(video_idx, None), self._counts.pop(video_idx, 0)
+
+
+@torch.no_grad()
+def stream_test(cfg):
+    """
+    Run sliding-window inference on every video of the video list.
+    Args:
+        cfg (CfgNode): configs. Details can be found in
+            slowfast/config/defaults.py
+    """
+    np.random.seed(cfg.RNG_SEED)
+    torch.manual_seed(cfg.RNG_SEED)
+    logging.setup_logging(cfg.OUTPUT_DIR)
+
+    device = torch.device("cuda") if cfg.NUM_GPUS else torch.device("cpu")
+    model = build_model(cfg)
+    cu.load_test_checkpoint(cfg, model)
+    model = model.to(device).eval()
+
+    videos = read_video_list(cfg)
+    logger.info("Streaming inference on {} videos".format(len(videos)))
+    windows = queue.Queue(maxsize=cfg.TEST.STREAM_QUEUE_SIZE)
+    next_video = iter(range(len(videos)))
+    lock = threading.Lock()
+
+    def _claim():
+        while True:
+            with lock:
+                video_idx = next(next_video, None)
+            if video_idx is None:
+                return
+            yield video_idx
+
+    decoders = [
+        threading.Thread(
+            target=decode_videos,
+            args=(cfg, videos, _claim(), windows),
+            daemon=True,
+        )
+        for _ in range(cfg.TEST.STREAM_NUM_DECODERS)
+    ]
+    for thread in decoders:
+        thread.start()
+
+    aggregator = VideoAggregator(cfg.DATA.ENSEMBLE_METHOD)
+    latencies = deque(maxlen=LATENCY_HISTORY)
+    num_windows, num_labeled, num_correct = 0, 0, 0
+    batch = []
+    window_file = PathManager.open(
+        os.path.join(cfg.OUTPUT_DIR, "stream_windows.jsonl"), "w"
+    )
+    video_file = PathManager.open(
+        os.path.join(cfg.OUTPUT_DIR, "stream_videos.jsonl"), "w"
+    )
+
+    def _run_batch():
+        if not batch:
+            return
+        inputs = [
+            torch.stack([w[2][i] for w in batch]).to(device, non_blocking=True)
+            for i in range(len(batch[0][2]))
+        ]
+        inputs = normalize_on_device(inputs, cfg.DATA.MEAN, cfg.DATA.STD)
+        with misc.autocast(cfg, training=False):
+            preds = model(inputs[0] if cfg.MODEL.ARCH in ["vit"] else inputs)
+        preds = preds.float().cpu()
+        done = time.perf_counter()
+        for (video_idx, start, _, ready), logits in zip(batch, preds):
+            aggregator.update(video_idx, logits)
+            latencies.append(done - ready)
+            window_file.write(
+                json.dumps(
+                    {
+                        "video": videos[video_idx][0],
+                        "start_frame": start,
+                        "logits": logits.tolist(),
+                    }
+                )
+                + "\n"
+            )
+        del batch[:]
+
+    start_time = time.perf_counter()
+    finished_videos = 0
+    while finished_videos < len(videos):
+        item = windows.get()
+        video_idx, start, pathways, _ = item
+        if pathways is not None:
+            batch.append(item)
+            num_windows += 1
+            # Run full batches, and partial ones rather than wait on decoding.
+            if len(batch) == cfg.TEST.BATCH_SIZE or windows.empty():
+                _run_batch()
+            continue
+        # End of video: its windows are all queued before the marker.
+        _run_batch()
+        finished_videos += 1
+        preds, count = aggregator.pop(video_idx)
+        path, label = videos[video_idx]
+        record = {"video": path, "label": label, "num_windows": count}
+        if preds is not None:
+            pred = int(preds.argmax())
+            if label >= 0:
+                num_labeled += 1
+                num_correct += int(pred == label)
+            record.update(
+                {
+                    "pred": pred,
+                    "logits": (
+                        preds / count
+                        if cfg.DATA.ENSEMBLE_METHOD == "sum"
+                        else preds
+                    ).tolist(),
+                }
+            )
+        video_file.write(json.dumps(record) + "\n")
+    seconds = time.perf_counter() - start_time
+    for thread in decoders:
+        thread.join()
+    window_file.close()
+    video_file.close()
+
+    latency_ms = np.array(latencies) * 1000.0
+    logger.info(
+        "Scored {} windows of {} videos in {:.1f} s: {:.2f} windows/s.".format(
+            num_windows, len(videos), seconds, num_windows / max(seconds, 1e-9)
+        )
+    )
+    if len(latency_ms):
+        logger.info(
+            "Window latency (decoded to logits, last {}): mean {:.1f} ms, "
+            "p50 {:.1f} ms, p95 {:.1f} ms.".format(
+                len(latency_ms),
+                latency_ms.mean(),
+                np.percentile(latency_ms, 50),
+                np.percentile(latency_ms, 95),
+            )
+        )
+    if num_labeled:
+        logger.info(
+            "Video top-1 accuracy of the aggregated predictions: "
+            "{:.2f}% on {} labeled videos.".format(
+                100.0 * num_correct / num_labeled, num_labeled
+            )
+        )
+
+
+def main():
+    args = parse_args()
+    cfg = load_config(args)
+    # Single process: decoding threads feed one model.
+    stream_test(cfg)
+
+
+if __name__ == "__main__":
+    main()
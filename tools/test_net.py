@@ -7,14 +7,17 @@ import os
 import pickle
 import torch
 from fvcore.common.file_io import PathManager
-import cv2
 from einops import rearrange, reduce, repeat
 import scipy.io
 
+import timesformer.datasets.utils as data_utils
 import timesformer.utils.checkpoint as cu
+import timesformer.utils.compilation as compilation
 import timesformer.utils.distributed as du
 import timesformer.utils.logging as logging
 import timesformer.utils.misc as misc
+import timesformer.utils.onnx_backend as onnx_backend
+import timesformer.utils.quantization as quantization
 import timesformer.visualization.tensorboard_vis as tb
 from timesformer.datasets import loader
 from timesformer.models import build_model
@@ -66,11 +69,17 @@ def perform_test(test_loader, model, test_meter, cfg, writer=None):
                         val[i] = val[i].cuda(non_blocking=True)
                 else:
                     meta[key] = val.cuda(non_blocking=True)
+        if cfg.DATA.NORMALIZE_ON_DEVICE:
+            inputs = data_utils.normalize_on_device(
+                inputs, cfg.DATA.MEAN, cfg.DATA.STD
+            )
         test_meter.data_toc()
 
         if cfg.DETECTION.ENABLE:
             # Compute the predictions.
-            preds = model(inputs, meta["boxes"])
+            with misc.autocast(cfg, training=False):
+                preds = model(inputs, meta["boxes"])
+            preds = preds.float()
             ori_boxes = meta["ori_boxes"]
             metadata = meta["metadata"]
 
@@ -93,7 +102,9 @@ def perform_test(test_loader, model, test_meter, cfg, writer=None):
             test_meter.log_iter_stats(None, cur_iter)
         else:
             # Perform the forward pass.
-            preds = model(inputs)
+            with misc.autocast(cfg, training=False):
+                preds = model(inputs)
+            preds = preds.float()
 
             # Gather all the predictions across all the devices to perform ensemble.
             if cfg.NUM_GPUS > 1:
@@ -158,12 +169,36 @@ def test(cfg):
     logger.info("Test with config:")
     logger.info(cfg)
 
-    # Build the video model and print model statistics.
-    model = build_model(cfg)
-    if du.is_master_proc() and cfg.LOG_MODEL_INFO:
-        misc.log_model_info(model, cfg, use_train_input=False)
-
-    cu.load_test_checkpoint(cfg, model)
+    if cfg.TEST.BACKEND == "onnxruntime":
+        assert (
+            cfg.NUM_GPUS == 0
+        ), "TEST.BACKEND onnxruntime runs on CPU, set NUM_GPUS 0"
+        # The exported graph replaces both the model code and the checkpoint.
+        model = onnx_backend.OnnxModel(cfg)
+    else:
+        # Build the video model and print model statistics.
+        model = build_model(cfg)
+        if du.is_master_proc() and cfg.LOG_MODEL_INFO:
+            misc.log_model_info(model, cfg, use_train_input=False)
+
+        cu.load_test_checkpoint(cfg, model)
+        if cfg.TEST.BACKEND == "int8":
+            assert (
+                cfg.NUM_GPUS == 0
+            ), "TEST.BACKEND int8 runs on CPU, set NUM_GPUS 0"
+            calib_loader = (
+                loader.construct_loader(cfg, "val")
+                if cfg.QUANT.MODE == "static"
+                and cfg.QUANT.CHECKPOINT_FILE_PATH == ""
+                else None
+            )
+            model = quantization.load_quantized_model(model, cfg, calib_loader)
+        else:
+            assert (
+                cfg.TEST.BACKEND == "pytorch"
+            ), "Unknown TEST.BACKEND {}".format(cfg.TEST.BACKEND)
+        if cfg.TEST.COMPILE:
+            model = compilation.CompiledModel(model, cfg)
 
     # Create video testing loaders.
     test_loader = loader.construct_loader(cfg, "test")
@@ -7,6 +7,7 @@ import pprint
 import torch
 from fvcore.nn.precise_bn import get_bn_modules, update_bn_stats
 
+import timesformer.datasets.utils as data_utils
 import timesformer.models.losses as losses
 import timesformer.models.optimizer as optim
 import timesformer.utils.checkpoint as cu
@@ -27,7 +28,14 @@ logger = logging.get_logger(__name__)
 
 
 def train_epoch(
-    train_loader, model, optimizer, train_meter, cur_epoch, cfg, writer=None
+    train_loader,
+    model,
+    optimizer,
+    train_meter,
+    cur_epoch,
+    cfg,
+    writer=None,
+    scaler=None,
 ):
     """
     Perform the video training for one epoch.
@@ -42,11 +50,16 @@ def train_epoch(
             slowfast/config/defaults.py
         writer (TensorboardWriter, optional): TensorboardWriter object
             to writer Tensorboard log.
+        scaler (GradScaler, optional): loss scaler of float16 mixed
+            precision, see TRAIN.MIXED_PRECISION.
     """
     # Enable train mode.
     model.train()
     train_meter.iter_tic()
     data_size = len(train_loader)
+    if scaler is None:
+        scaler = misc.build_grad_scaler(cfg)
+    mixed_precision = misc.get_autocast_dtype(cfg, training=True)
 
     cur_global_batch_size = cfg.NUM_SHARDS * cfg.TRAIN.BATCH_SIZE
     num_iters = cfg.GLOBAL_BATCH_SIZE // cur_global_batch_size
@@ -66,6 +79,10 @@ def train_epoch(
                         val[i] = val[i].cuda(non_blocking=True)
                 else:
                     meta[key] = val.cuda(non_blocking=True)
+        if cfg.DATA.NORMALIZE_ON_DEVICE:
+            inputs = data_utils.normalize_on_device(
+                inputs, cfg.DATA.MEAN, cfg.DATA.STD
+            )
 
         # Update the learning rate.
         lr = optim.get_epoch_lr(cur_epoch + float(cur_iter) / data_size, cfg)
@@ -84,36 +101,46 @@ def train_epoch(
            inputs, labels = mixup_fn(inputs, labels)
            loss_fun = SoftTargetCrossEntropy()
 
-        if cfg.DETECTION.ENABLE:
-            preds = model(inputs, meta["boxes"])
-        else:
-            preds = model(inputs)
+        with misc.autocast(cfg, training=True):
+            if cfg.DETECTION.ENABLE:
+                preds = model(inputs, meta["boxes"])
+            else:
+                preds = model(inputs)
 
-        # Compute the loss.
-        loss = loss_fun(preds, labels)
+            # Compute the loss.
+            loss = loss_fun(preds, labels)
+            if cfg.TIMESFORMER.EARLY_EXIT_BLOCKS:
+                loss = loss + cfg.TIMESFORMER.EARLY_EXIT_LOSS_WEIGHT * (
+                    losses.early_exit_loss(model, loss_fun, labels)
+                )
+        preds = preds.float()
 
         if cfg.MIXUP.ENABLED:
             labels = hard_labels
 
         # check Nan Loss.
-        misc.check_nan_losses(loss)
+        misc.check_nan_losses(loss, mixed_precision)
 
 
         if cur_global_batch_size >= cfg.GLOBAL_BATCH_SIZE:
             # Perform the backward pass.
             optimizer.zero_grad()
-            loss.backward()
-            # Update the parameters.
-            optimizer.step()
+            scaler.scale(loss).backward()
+            # Update the parameters, skipped by the scaler on inf/NaN grads.
+            scaler.step(optimizer)
+            scaler.update()
         else:
             if cur_iter == 0:
                 optimizer.zero_grad()
-            loss.backward()
+            scaler.scale(loss).backward()
             if (cur_iter + 1) % num_iters == 0:
+                # Unscale the accumulated grads before averaging them.
+                scaler.unscale_(optimizer)
                 for p in model.parameters():
                     if(p.grad is not None):
                         p.grad /= num_iters
-                optimizer.step()
+                scaler.step(optimizer)
+                scaler.update()
                 optimizer.zero_grad()
 
         if cfg.DETECTION.ENABLE:
@@ -222,11 +249,17 @@ def eval_epoch(val_loader, model, val_meter, cur_epoch, cfg, writer=None):
                         val[i] = val[i].cuda(non_blocking=True)
                 else:
                     meta[key] = val.cuda(non_blocking=True)
+        if cfg.DATA.NORMALIZE_ON_DEVICE:
+            inputs = data_utils.normalize_on_device(
+                inputs, cfg.DATA.MEAN, cfg.DATA.STD
+            )
         val_meter.data_toc()
 
         if cfg.DETECTION.ENABLE:
             # Compute the predictions.
-            preds = model(inputs, meta["boxes"])
+            with misc.autocast(cfg, training=False):
+                preds = model(inputs, meta["boxes"])
+            preds = preds.float()
             ori_boxes = meta["ori_boxes"]
             metadata = meta["metadata"]
 
@@ -245,7 +278,9 @@ def eval_epoch(val_loader, model, val_meter, cur_epoch, cfg, writer=None):
             val_meter.update_stats(preds, ori_boxes, metadata)
 
         else:
-            preds = model(inputs)
+            with misc.autocast(cfg, training=False):
+                preds = model(inputs)
+            preds = preds.float()
 
             if cfg.DATA.MULTI_LABEL:
                 if cfg.NUM_GPUS > 1:
@@ -309,7 +344,9 @@ def eval_epoch(val_loader, model, val_meter, cur_epoch, cfg, writer=None):
     val_meter.reset()
 
 
-def calculate_and_update_precise_bn(loader, model, num_iters=200, use_gpu=True):
+def calculate_and_update_precise_bn(
+    loader, model, num_iters=200, use_gpu=True, mean=None, std=None
+):
     """
     Update the stats in bn layers by calculate the precise stats.
     Args:
@@ -317,6 +354,9 @@ def calculate_and_update_precise_bn(loader, model, num_iters=200, use_gpu=True):
         model (model): model to update the bn stats.
         num_iters (int): number of iterations to compute and update the bn stats.
         use_gpu (bool): whether to use GPU or not.
+        mean (list): if given, uint8 inputs are normalized on the device with
+            this mean and `std`, see DATA.NORMALIZE_ON_DEVICE.
+        std (list): per channel std used with `mean`.
     """
 
     def _gen_loader():
@@ -327,6 +367,8 @@ def calculate_and_update_precise_bn(loader, model, num_iters=200, use_gpu=True):
                         inputs[i] = inputs[i].cuda(non_blocking=True)
                 else:
                     inputs = inputs.cuda(non_blocking=True)
+            if mean is not None:
+                inputs = data_utils.normalize_on_device(inputs, mean, std)
             yield inputs
 
     # Update the bn stats.
@@ -415,10 +457,12 @@ def train(cfg):
 
     # Construct the optimizer.
     optimizer = optim.construct_optimizer(model, cfg)
+    # Create a GradScaler for mixed precision training.
+    scaler = misc.build_grad_scaler(cfg)
 
     # Load a checkpoint to resume training if applicable.
     if not cfg.TRAIN.FINETUNE:
-      start_epoch = cu.load_train_checkpoint(cfg, model, optimizer)
+      start_epoch = cu.load_train_checkpoint(cfg, model, optimizer, scaler)
     else:
       start_epoch = 0
       cu.load_checkpoint(cfg.TRAIN.CHECKPOINT_FILE_PATH, model)
@@ -469,7 +513,7 @@ def train(cfg):
                     last_checkpoint = cfg.TRAIN.CHECKPOINT_FILE_PATH
                 logger.info("Load from {}".format(last_checkpoint))
                 cu.load_checkpoint(
-                    last_checkpoint, model, cfg.NUM_GPUS > 1, optimizer
+                    last_checkpoint, model, cfg.NUM_GPUS > 1, optimizer, scaler
                 )
 
         # Shuffle the dataset.
@@ -477,7 +521,14 @@ def train(cfg):
 
         # Train for one epoch.
         train_epoch(
-            train_loader, model, optimizer, train_meter, cur_epoch, cfg, writer
+            train_loader,
+            model,
+            optimizer,
+            train_meter,
+            cur_epoch,
+            cfg,
+            writer,
+            scaler,
         )
 
         is_checkp_epoch = cu.is_checkpoint_epoch(
@@ -500,12 +551,21 @@ def train(cfg):
                 model,
                 min(cfg.BN.NUM_BATCHES_PRECISE, len(precise_bn_loader)),
                 cfg.NUM_GPUS > 0,
+                mean=cfg.DATA.MEAN if cfg.DATA.NORMALIZE_ON_DEVICE else None,
+                std=cfg.DATA.STD,
             )
         _ = misc.aggregate_sub_bn_stats(model)
 
         # Save a checkpoint.
         if is_checkp_epoch:
-            cu.save_checkpoint(cfg.OUTPUT_DIR, model, optimizer, cur_epoch, cfg)
+            cu.save_checkpoint(
+                cfg.OUTPUT_DIR,
+                model,
+                optimizer,
+                cur_epoch,
+                cfg,
+                scaler if cfg.TRAIN.MIXED_PRECISION else None,
+            )
         # Evaluate the model on validation set.
         if is_eval_epoch:
             eval_epoch(val_loader, model, val_meter, cur_epoch, cfg, writer)